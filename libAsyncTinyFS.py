@@ -0,0 +1,107 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from libTinyFS import tinyFS
+
+DEFAULT_ASYNC_WORKERS = 4
+
+class AsyncTinyFS:
+    """
+    ASYNCIO FRONT-END
+    Awaitable versions of the tinyFS calls, for use from an asyncio event loop.
+    Each call runs on a thread-safe tinyFS in a thread pool of 'max_workers'
+    threads, so disk I/O never blocks the loop and calls on different files
+    make progress at the same time. At most 'max_workers' calls are handed to
+    the pool at once; the rest wait in the event loop, so a burst of requests
+    does not pile up an unbounded queue of work behind the pool.
+
+    Concurrent reads of the same block are coalesced by the block cache: only
+    one of them goes to the disk. The same rule as tinyFS applies to file
+    descriptors: do not run two calls on one descriptor at the same time.
+
+    afs = AsyncTinyFS()
+    await afs.tfs_mount("tinyFSDisk")
+    fd = await afs.tfs_open("/hello")
+    data = await afs.tfs_read(fd, 100)
+    """
+
+    def __init__(self, fs=None, max_workers=DEFAULT_ASYNC_WORKERS, **kwargs):
+        # kwargs are passed on to tinyFS when one is not given
+        if fs is None:
+            fs = tinyFS(threadsafe=True, **kwargs)
+        elif not fs.threadsafe:
+            raise ValueError("AsyncTinyFS needs a tinyFS made with threadsafe=True")
+        self.fs = fs
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tinyfs")
+        self.slots = None # asyncio.Semaphore, made on first use inside the running loop
+
+    # Run fs.'method'(*args) on the thread pool and return its result
+    async def run(self, method, *args):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(getattr(self.fs, method), *args))
+
+    async def tfs_mkfs(self, *args):
+        return await self.run("tfs_mkfs", *args)
+
+    async def tfs_mount(self, filename, backend="file"):
+        return await self.run("tfs_mount", filename, backend)
+
+    async def tfs_unmount(self):
+        return await self.run("tfs_unmount")
+
+    async def tfs_open(self, name, compression=None):
+        return await self.run("tfs_open", name, compression)
+
+    async def tfs_close(self, FD):
+        return await self.run("tfs_close", FD)
+
+    async def tfs_write(self, FD, buffer):
+        return await self.run("tfs_write", FD, buffer)
+
+    async def tfs_pwrite(self, FD, offset, buffer):
+        return await self.run("tfs_pwrite", FD, offset, buffer)
+
+    async def tfs_append(self, FD, buffer):
+        return await self.run("tfs_append", FD, buffer)
+
+    async def tfs_delete(self, FD):
+        return await self.run("tfs_delete", FD)
+
+    async def tfs_readByte(self, FD, buffer):
+        return await self.run("tfs_readByte", FD, buffer)
+
+    async def tfs_read(self, FD, n):
+        return await self.run("tfs_read", FD, n)
+
+    async def tfs_readinto(self, FD, view):
+        return await self.run("tfs_readinto", FD, view)
+
+    async def tfs_seek(self, FD, offset):
+        return await self.run("tfs_seek", FD, offset)
+
+    async def tfs_bulk_write(self, files, compression=None):
+        return await self.run("tfs_bulk_write", files, compression)
+
+    async def tfs_bulk_read(self, names):
+        return await self.run("tfs_bulk_read", names)
+
+    async def tfs_mkdir(self, path):
+        return await self.run("tfs_mkdir", path)
+
+    async def tfs_readdir(self, path="/"):
+        return await self.run("tfs_readdir", path)
+
+    async def tfs_rename(self, old, new):
+        return await self.run("tfs_rename", old, new)
+
+    async def tfs_sync(self):
+        return await self.run("tfs_sync")
+
+    # Stop the thread pool, after waiting for calls already running
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
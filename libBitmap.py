@@ -0,0 +1,151 @@
+import math
+import re
+
+# Matches any byte of the bitmap that still has a free (0) bit in it
+NOT_FULL = re.compile(b"[^\xff]")
+
+class BlockBitmap:
+    """
+    FREE BLOCK BITMAP
+    One bit per block on the disk, indexed by absolute block number:
+    bit (b % 8) of byte (b // 8) is 1 if block b is in use and 0 if it is free.
+    Blocks the filesystem reserves (superblock, root inode, bitmap blocks) are
+    simply marked used when the disk is formatted. Padding bits past the last
+    block are also marked used so they can never be handed out.
+
+    Allocation is next-fit: the search starts at a cursor just past the last
+    block handed out instead of at block 0, so a run of allocations does not
+    rescan the full part of the disk every time. Full bytes are skipped with a
+    regular expression search instead of a Python loop.
+
+    Every byte that changes is recorded in 'dirty' so tinyFS only has to write
+    back the bitmap blocks that changed. A new bitmap starts out all dirty, one
+    loaded from disk all clean.
+    """
+
+    def __init__(self, num_blocks, data=None):
+        self.num_blocks = num_blocks
+        num_bytes = math.ceil(num_blocks / 8)
+        if data is None:
+            self.bits = bytearray(num_bytes)
+        else:
+            self.bits = bytearray(data[:num_bytes])
+        self.dirty = set() # indexes of bytes changed since mark_clean()
+        for block in range(num_blocks, num_bytes * 8):
+            self.set(block)
+        used = bin(int.from_bytes(self.bits, byteorder="little")).count("1")
+        self.num_free = num_bytes * 8 - used
+        self.cursor = 0
+        if data is None:
+            self.dirty = set(range(num_bytes))
+        else:
+            self.dirty = set()
+
+    def __str__(self):
+        return f"BlockBitmap({self.num_free}/{self.num_blocks} free, cursor {self.cursor})"
+
+    def is_free(self, block):
+        return (self.bits[block >> 3] >> (block & 7)) & 1 == 0
+
+    def set(self, block):
+        self.bits[block >> 3] |= 1 << (block & 7)
+        self.dirty.add(block >> 3)
+
+    def clear(self, block):
+        self.bits[block >> 3] &= ~(1 << (block & 7)) & 0xFF
+        self.dirty.add(block >> 3)
+
+    # Forget the changed bytes once they have been written back
+    def mark_clean(self):
+        self.dirty.clear()
+
+    # Mark blocks that are not handed out by allocate as used, e.g. reserved metadata blocks
+    def reserve(self, block_nums):
+        for block in block_nums:
+            if self.is_free(block):
+                self.set(block)
+                self.num_free -= 1
+
+    # First free block at or after 'start', or None
+    def next_free(self, start):
+        while start < self.num_blocks:
+            match = NOT_FULL.search(self.bits, start >> 3)
+            if match is None:
+                return None
+            byte_index = match.start()
+            block = max(start, byte_index * 8)
+            byte = self.bits[byte_index]
+            while block < (byte_index + 1) * 8:
+                if (byte >> (block & 7)) & 1 == 0:
+                    return block if block < self.num_blocks else None
+                block += 1
+            start = block
+        return None
+
+    # Start of the first run of 'count' free blocks within [lo, hi), or None
+    def find_run(self, count, lo, hi):
+        run_start = lo
+        run_length = 0
+        block = lo
+        while block < hi:
+            byte = self.bits[block >> 3]
+            if block & 7 == 0 and byte == 0xFF:
+                # Nothing free in this byte, jump to the next byte that has a free bit
+                run_length = 0
+                block = self.next_free(block)
+                if block is None:
+                    return None
+                continue
+            if block & 7 == 0 and byte == 0 and block + 8 <= hi:
+                if run_length == 0:
+                    run_start = block
+                run_length += 8
+                block += 8
+            elif (byte >> (block & 7)) & 1:
+                run_length = 0
+                block += 1
+                continue
+            else:
+                if run_length == 0:
+                    run_start = block
+                run_length += 1
+                block += 1
+            if run_length >= count:
+                return run_start
+        return None
+
+    # Allocate 'count' blocks and return their numbers, or None if there are not
+    # enough free blocks (in which case nothing is allocated). A single contiguous
+    # run is preferred so files get sequential layouts, otherwise the first free
+    # blocks after the cursor are used.
+    def allocate(self, count):
+        if count > self.num_free:
+            return None
+        if count == 0:
+            return []
+        start = self.find_run(count, self.cursor, self.num_blocks)
+        if start is None and self.cursor > 0:
+            start = self.find_run(count, 0, min(self.cursor + count, self.num_blocks))
+        if start is not None:
+            blocks = list(range(start, start + count))
+        else:
+            blocks = []
+            block = self.next_free(self.cursor)
+            while len(blocks) < count:
+                if block is None:
+                    # wrap around to the start of the disk
+                    block = self.next_free(0)
+                blocks.append(block)
+                self.set(block)
+                block = self.next_free(block + 1)
+        for block in blocks:
+            self.set(block)
+        self.num_free -= count
+        self.cursor = (blocks[-1] + 1) % self.num_blocks
+        return blocks
+
+    def free(self, block_nums):
+        for block in block_nums:
+            if not self.is_free(block):
+                self.clear(block)
+                self.num_free += 1
@@ -0,0 +1,451 @@
+from collections import OrderedDict
+import threading
+
+from libDisk import BLOCKSIZE, blockRuns
+from libLock import NoLock
+import libDisk as ld
+
+DEFAULT_CACHE_BLOCKS = 64
+
+class BlockCache:
+    """
+    BLOCK CACHE
+    Sits between tinyFS and libDisk and exposes the same readBlock/writeBlock
+    contract, minus the disk argument. Blocks are kept in an OrderedDict in
+    least-recently-used order: the front is evicted first, and every hit
+    moves a block to the back.
+
+    Writes are write-back: a written block is only marked dirty, and reaches
+    the disk when it is evicted or when sync() is called (tinyFS does this
+    on tfs_close, tfs_sync and tfs_unmount).
+
+    readBlockList/writeBlockList handle many blocks at once. Misses are read,
+    and sync writes dirty blocks, as runs of consecutive block numbers with
+    one libDisk readBlocks/writeBlocks call per run.
+
+    A capacity of 0 disables caching, every read and write goes straight to
+    the disk.
+
+    With 'journaled' set, writes are pinned instead: held outside the LRU
+    order, never evicted and never written by sync(), until checkpoint()
+    writes them home after the journal has logged them. Writes made with
+    journal=False (file data) are not pinned and behave as above.
+
+    'lock' (a threading.Lock) makes the cache safe to share between threads.
+    It only guards the cache's own bookkeeping: disk reads for misses happen
+    outside it so several threads can wait on the disk at once. A block read
+    that way is only cached if no thread cached it in the meantime, and if it
+    was not written while being read: a write marks any read of the block in
+    flight as stale (see cancel_read), since that read may have fetched the old
+    contents. Reads are also coalesced: a thread that misses on a block another
+    thread is already reading waits for that read instead of issuing its own.
+    """
+
+    def __init__(self, disk, capacity=DEFAULT_CACHE_BLOCKS, lib=ld, lock=None):
+        self.disk = disk
+        self.lib = lib
+        self.capacity = capacity
+        self.lock = lock if lock is not None else NoLock()
+        # block number -> PendingRead for misses being read right now, only
+        # used when the cache is shared between threads
+        self.coalesce = lock is not None
+        self.pending = {}
+        self.blocks = OrderedDict() # block number -> block contents
+        self.dirty = set() # block numbers that differ from the disk
+        self.journaled = False
+        self.pinned = {} # block number -> contents, writes waiting for a journal commit
+
+        # Counters, see stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self.coalesced = 0
+        self.prefetched = 0
+
+    def __str__(self):
+        return f"BlockCache({len(self.blocks)}/{self.capacity} blocks, {len(self.dirty)} dirty, {self.stats()})"
+
+    def readBlock(self, bNum, buffer):
+        with self.lock:
+            if bNum in self.pinned:
+                self.hits += 1
+                buffer['block'] = self.pinned[bNum]
+                return 0
+            if bNum in self.blocks:
+                self.hits += 1
+                self.blocks.move_to_end(bNum)
+                buffer['block'] = self.blocks[bNum]
+                return 0
+            waiting = self.pending.get(bNum)
+            if waiting is None:
+                self.misses += 1
+                reading = self.start_read([bNum])
+            else:
+                self.coalesced += 1
+        if waiting is not None:
+            return waiting.result(bNum, buffer)
+        error = self.lib.readBlock(self.disk, bNum, buffer)
+        with self.lock:
+            if error == 0:
+                self.fill(reading, bNum, buffer['block'])
+            self.finish_read(reading, bNum, error, buffer.get('block'))
+            self.end_read(reading, error)
+        return error
+
+    # journal=False marks the write as file data that the journal does not log
+    def writeBlock(self, bNum, buffer, journal=True):
+        # Blocks are always stored full size so a later read sees the same
+        # BLOCKSIZE bytes the disk would return. Short writes are zero filled.
+        data = bytes(buffer['block'][:BLOCKSIZE])
+        if len(data) < BLOCKSIZE:
+            data += bytes(BLOCKSIZE - len(data))
+        with self.lock:
+            self.cancel_read(bNum)
+            if self.journaled and journal:
+                self.pinned[bNum] = data
+                self.blocks.pop(bNum, None)
+                self.dirty.discard(bNum)
+                return 0
+            # a block that was metadata may have been freed and reused for data
+            self.pinned.pop(bNum, None)
+            if self.capacity == 0:
+                return self.lib.writeBlock(self.disk, bNum, {'block': data})
+            self.insert(bNum, data)
+            self.dirty.add(bNum)
+        return 0
+
+    # Gather the blocks in bNums, in list order, into buffer['block'].
+    def readBlockList(self, bNums, buffer):
+        data = bytearray(len(bNums) * BLOCKSIZE)
+        missing = {} # block number -> indexes in bNums, blocks this thread reads
+        waiting = {} # block number -> (PendingRead, indexes in bNums), blocks another thread is reading
+        with self.lock:
+            for i, bNum in enumerate(bNums):
+                if bNum in self.pinned:
+                    self.hits += 1
+                    data[i * BLOCKSIZE:(i + 1) * BLOCKSIZE] = self.pinned[bNum]
+                elif bNum in self.blocks:
+                    self.hits += 1
+                    self.blocks.move_to_end(bNum)
+                    data[i * BLOCKSIZE:(i + 1) * BLOCKSIZE] = self.blocks[bNum]
+                elif bNum in missing:
+                    missing[bNum].append(i)
+                elif bNum in self.pending:
+                    self.coalesced += 1
+                    waiting.setdefault(bNum, (self.pending[bNum], []))[1].append(i)
+                else:
+                    self.misses += 1
+                    missing[bNum] = [i]
+            reading = self.start_read(missing)
+        error = 0
+        # Finish every read this thread started before waiting on other threads, so
+        # two threads waiting on each other's blocks cannot deadlock
+        for _, bNum, count in blockRuns(sorted(missing)):
+            run = {}
+            if error == 0:
+                error = self.lib.readBlocks(self.disk, bNum, count, run)
+            with self.lock:
+                for j in range(count):
+                    block = None
+                    if error == 0:
+                        block = memoryview(run['block'])[j * BLOCKSIZE:(j + 1) * BLOCKSIZE]
+                        for i in missing[bNum + j]:
+                            data[i * BLOCKSIZE:(i + 1) * BLOCKSIZE] = block
+                        self.fill(reading, bNum + j, block)
+                    self.finish_read(reading, bNum + j, error, block)
+        with self.lock:
+            self.end_read(reading, error)
+        if error < 0:
+            return error
+        for bNum, (pending, indexes) in waiting.items():
+            block = {}
+            error = pending.result(bNum, block)
+            if error < 0:
+                return error
+            for i in indexes:
+                data[i * BLOCKSIZE:(i + 1) * BLOCKSIZE] = block['block']
+        buffer['block'] = data
+        return 0
+
+    # Read the blocks in bNums that are not cached into the cache without returning
+    # them, one readBlocks call per run of consecutive blocks. Used for read-ahead:
+    # blocks already cached or being read by another thread are skipped, and a
+    # thread that misses on a block while it is being prefetched waits for it.
+    def prefetch(self, bNums):
+        if self.capacity == 0:
+            return 0
+        with self.lock:
+            missing = sorted({bNum for bNum in bNums if bNum not in self.pinned and bNum not in self.blocks and bNum not in self.pending})
+            reading = self.start_read(missing)
+            self.prefetched += len(missing)
+        error = 0
+        for _, bNum, count in blockRuns(missing):
+            run = {}
+            if error == 0:
+                error = self.lib.readBlocks(self.disk, bNum, count, run)
+            with self.lock:
+                for j in range(count):
+                    block = None
+                    if error == 0:
+                        block = memoryview(run['block'])[j * BLOCKSIZE:(j + 1) * BLOCKSIZE]
+                        self.fill(reading, bNum + j, block)
+                    self.finish_read(reading, bNum + j, error, block)
+        with self.lock:
+            self.end_read(reading, error)
+        return error
+
+    # Write buffer['block'] (len(bNums) * BLOCKSIZE bytes) to the blocks in bNums.
+    # Unjournaled lists longer than the cache go straight to the disk, one call per
+    # run, instead of pushing each other out one write back at a time.
+    def writeBlockList(self, bNums, buffer, journal=True):
+        data = memoryview(buffer['block']).cast('B')
+        if len(bNums) > self.capacity and not (self.journaled and journal):
+            with self.lock:
+                for bNum in bNums:
+                    self.pinned.pop(bNum, None)
+                    self.blocks.pop(bNum, None)
+                    self.dirty.discard(bNum)
+            error = self.lib.writeBlockList(self.disk, bNums, {'block': data})
+            with self.lock:
+                # a read that started before the write finished may hold the old contents
+                for bNum in bNums:
+                    self.cancel_read(bNum)
+                    if bNum not in self.dirty:
+                        self.blocks.pop(bNum, None)
+            return error
+        for i, bNum in enumerate(bNums):
+            self.writeBlock(bNum, {'block': data[i * BLOCKSIZE:(i + 1) * BLOCKSIZE]}, journal)
+        return 0
+
+    # Register misses on the blocks in bNums as being read by this thread, see PendingRead
+    def start_read(self, bNums):
+        if not self.coalesce or not bNums:
+            return None
+        reading = PendingRead()
+        for bNum in bNums:
+            self.pending[bNum] = reading
+        return reading
+
+    # Record the data read for one block of a read started with start_read
+    def finish_read(self, reading, bNum, error, data):
+        if reading is None:
+            return
+        if self.pending.get(bNum) is reading:
+            del self.pending[bNum]
+        if error == 0:
+            reading.blocks[bNum] = data
+
+    # Cache block bNum as read from disk by 'reading' (None if reads are not
+    # tracked), unless it was cached or written in the meantime
+    def fill(self, reading, bNum, data):
+        if bNum in self.blocks or (reading is not None and bNum in reading.stale):
+            return
+        self.insert(bNum, data)
+
+    # Block bNum is being written: a read of it in flight may return the old
+    # contents, so it is not cached, and later misses read the block again
+    # instead of waiting for it
+    def cancel_read(self, bNum):
+        reading = self.pending.pop(bNum, None)
+        if reading is not None:
+            reading.stale.add(bNum)
+
+    # Wake any threads waiting on a read started with start_read
+    def end_read(self, reading, error):
+        if reading is None:
+            return
+        reading.error = error
+        reading.done.set()
+
+    # Add a block at the most recently used end, evicting from the other end
+    # until the cache is back within capacity.
+    def insert(self, bNum, data):
+        if self.capacity == 0:
+            return
+        self.blocks[bNum] = data
+        self.blocks.move_to_end(bNum)
+        while len(self.blocks) > self.capacity:
+            victim, victim_data = self.blocks.popitem(last=False)
+            self.evictions += 1
+            if victim in self.dirty:
+                self.write_back(victim, victim_data)
+
+    def write_back(self, bNum, data):
+        self.dirty.discard(bNum)
+        self.writebacks += 1
+        return self.lib.writeBlock(self.disk, bNum, {'block': data})
+
+    # Write every dirty block back to the disk, in block order so the
+    # writes sweep the disk once, with one writeBlocks call per run of
+    # consecutive blocks. Blocks stay cached.
+    def sync(self):
+        error = 0
+        with self.lock:
+            for _, bNum, count in blockRuns(sorted(self.dirty)):
+                data = b"".join(self.blocks[bNum + j] for j in range(count))
+                if self.lib.writeBlocks(self.disk, bNum, count, {'block': data}) < 0:
+                    error = -1
+                for j in range(count):
+                    self.dirty.discard(bNum + j)
+                self.writebacks += count
+        return error
+
+    # Write the pinned blocks in bNums home, once the journal has committed them,
+    # and keep them cached as clean blocks.
+    def checkpoint(self, bNums):
+        error = 0
+        with self.lock:
+            for _, bNum, count in blockRuns(sorted(bNums)):
+                data = b"".join(self.pinned[bNum + j] for j in range(count))
+                if self.lib.writeBlocks(self.disk, bNum, count, {'block': data}) < 0:
+                    error = -1
+                for j in range(count):
+                    self.insert(bNum + j, self.pinned.pop(bNum + j))
+                self.writebacks += count
+        return error
+
+    # Drop every cached block without writing anything back.
+    def invalidate(self):
+        with self.lock:
+            self.blocks.clear()
+            self.dirty.clear()
+            self.pinned.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'writebacks': self.writebacks,
+            'coalesced': self.coalesced,
+            'prefetched': self.prefetched,
+        }
+
+
+DEFAULT_CHUNK_CACHE = 16
+
+class ChunkCache:
+    """
+    DECOMPRESSED CHUNK CACHE
+    The last 'capacity' chunks of compressed files that were read or written, in
+    least-recently-used order, keyed by (inode block number, chunk index), so a
+    sequential or repeated read of a compressed file decompresses each chunk once.
+    tinyFS puts a chunk here whenever it writes one, and drops a file's chunks when
+    the file is truncated or deleted.
+    """
+
+    def __init__(self, capacity=DEFAULT_CHUNK_CACHE, lock=None):
+        self.capacity = capacity
+        self.lock = lock if lock is not None else NoLock()
+        self.chunks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # The cached chunk for 'key', or None
+    def get(self, key):
+        with self.lock:
+            data = self.chunks.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if self.capacity == 0:
+            return
+        with self.lock:
+            self.chunks[key] = data
+            self.chunks.move_to_end(key)
+            while len(self.chunks) > self.capacity:
+                self.chunks.popitem(last=False)
+
+    # Forget chunks 'first' and later of the file with inode block 'inode'
+    def drop(self, inode, first=0):
+        with self.lock:
+            for key in [key for key in self.chunks if key[0] == inode and key[1] >= first]:
+                del self.chunks[key]
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+
+    def stats(self):
+        return {'chunk_hits': self.hits, 'chunk_misses': self.misses}
+
+
+class PendingRead:
+    """
+    The blocks one readBlock or readBlockList call is reading from disk. The
+    thread that missed first reads them, any other thread that misses on one
+    of them meanwhile waits here for the same data instead of reading it again.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = 0
+        self.blocks = {} # block number -> data, filled in as runs are read
+        self.stale = set() # blocks written while being read, see BlockCache.cancel_read
+
+    # Wait for the read and put block bNum in buffer['block'], like readBlock
+    def result(self, bNum, buffer):
+        self.done.wait()
+        if self.error < 0:
+            return self.error
+        buffer['block'] = self.blocks[bNum]
+        return 0
+
+
+DEFAULT_DENTRY_ENTRIES = 1024
+
+# Returned by DentryCache.get for a path it knows nothing about. None is a valid
+# cached answer (the path does not exist), so it cannot double as "not cached".
+DENTRY_MISS = object()
+
+class DentryCache:
+    """
+    DENTRY CACHE
+    Maps full paths (b"/a/b/c") to inode block numbers so repeated lookups of a
+    path do not walk every directory along it again. Negative entries are cached
+    too: a path that does not exist maps to None. LRU eviction like BlockCache.
+
+    Entries have to be invalidated by the filesystem whenever a path stops
+    meaning what it did: on delete and rename, for the path and everything
+    under it, and on create, for the negative entry of the new path.
+    """
+
+    def __init__(self, capacity=DEFAULT_DENTRY_ENTRIES):
+        self.capacity = capacity
+        self.entries = OrderedDict() # path -> inode block number, or None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        if path in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return self.entries[path]
+        self.misses += 1
+        return DENTRY_MISS
+
+    def put(self, path, inode):
+        if self.capacity == 0:
+            return
+        self.entries[path] = inode
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    # Forget 'path' and every path below it
+    def invalidate(self, path):
+        prefix = path.rstrip(b"/") + b"/"
+        for cached in [p for p in self.entries if p == path or p.startswith(prefix)]:
+            del self.entries[cached]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,49 @@
+import lzma
+import zlib
+
+from libLayout import CHUNK_HEADER_LAYOUT
+
+"""
+CHUNK CODECS
+Compressed files are stored one chunk at a time, see tinyFS.File. A compressed
+chunk is a 4 byte header holding the length of the compressed bytes, followed by
+them. Only the codec number is kept on disk, in the inode, so a codec's settings
+must never change.
+"""
+
+COMPRESSION_CODECS = {
+    "none": 0,
+    "zlib": 1, # fast, decent ratio
+    "lzma": 2, # slower, better ratio
+}
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6}] # raw LZMA2, no container overhead per chunk
+
+def compress(codec, data):
+    if codec == COMPRESSION_CODECS["zlib"]:
+        return zlib.compress(data)
+    if codec == COMPRESSION_CODECS["lzma"]:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    raise ValueError(f"unknown codec {codec}")
+
+def decompress(codec, data):
+    if codec == COMPRESSION_CODECS["zlib"]:
+        return zlib.decompress(data)
+    if codec == COMPRESSION_CODECS["lzma"]:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    raise ValueError(f"unknown codec {codec}")
+
+# Header and compressed bytes for the chunk bytes 'raw', or None if that takes more
+# than 'limit' bytes
+def encode_chunk(codec, raw, limit):
+    payload = compress(codec, bytes(raw))
+    if CHUNK_HEADER_LAYOUT.size + len(payload) > limit:
+        return None
+    stored = bytearray(CHUNK_HEADER_LAYOUT.size + len(payload))
+    CHUNK_HEADER_LAYOUT.pack_into(stored, 0, len(payload))
+    stored[CHUNK_HEADER_LAYOUT.size:] = payload
+    return stored
+
+# The chunk bytes stored at the start of 'data' by encode_chunk
+def decode_chunk(codec, data):
+    length, = CHUNK_HEADER_LAYOUT.unpack_from(data)
+    return decompress(codec, bytes(data[CHUNK_HEADER_LAYOUT.size:CHUNK_HEADER_LAYOUT.size + length]))
@@ -1,7 +1,12 @@
 from os.path import exists
+import os
 
 BLOCKSIZE = 256
 
+# Every read and write is positional (os.pread/os.pwrite at bNum*BLOCKSIZE) instead of
+# a seek followed by read/write, so threads sharing one open disk never race on the
+# file offset.
+
 def openDisk(filename, nBytes=0):
     try:
         if exists(filename) and nBytes == 0:
@@ -12,29 +17,27 @@ def openDisk(filename, nBytes=0):
         # Write nBytes of 0
         init = bytes(nBytes)
         f.write(init)
+        # Blocks are written with os.pwrite from now on, bypassing the file buffer
+        f.flush()
     except:
         return -1
     return f
 
 def readBlock(disk, bNum, buffer):
     try:
-        disk.seek(bNum*BLOCKSIZE)
-        buffer['block'] = disk.read(BLOCKSIZE)
-        disk.seek(0)
+        buffer['block'] = os.pread(disk.fileno(), BLOCKSIZE, bNum*BLOCKSIZE)
     except:
         return -1
     return 0
 
 def writeBlock(disk, bNum, buffer):
     try:
-        disk.seek(bNum*BLOCKSIZE)
         data = bytearray(buffer['block'])
         # Only write BLOCKSIZE bytes to the disk
         if len(data) <= BLOCKSIZE:
-            disk.write(data)
+            os.pwrite(disk.fileno(), data, bNum*BLOCKSIZE)
         else:
-            disk.write(data[:BLOCKSIZE])
-        disk.seek(0)
+            os.pwrite(disk.fileno(), data[:BLOCKSIZE], bNum*BLOCKSIZE)
     except:
         return -1
     return 0
@@ -45,3 +48,65 @@ def closeDisk(disk):
     except:
         return -1
     return 0
+
+# Read 'count' consecutive blocks starting at bNum with a single positional read.
+# buffer['block'] is set to the count * BLOCKSIZE bytes read.
+def readBlocks(disk, bNum, count, buffer):
+    try:
+        data = bytearray(count*BLOCKSIZE)
+        os.preadv(disk.fileno(), [data], bNum*BLOCKSIZE)
+        buffer['block'] = data
+    except:
+        return -1
+    return 0
+
+# Write 'count' consecutive blocks starting at bNum from buffer['block'] with a
+# single positional write. Short buffers only write the blocks they cover.
+def writeBlocks(disk, bNum, count, buffer):
+    try:
+        data = memoryview(buffer['block']).cast('B')
+        os.pwrite(disk.fileno(), data[:count*BLOCKSIZE], bNum*BLOCKSIZE)
+    except:
+        return -1
+    return 0
+
+# Split a list of block numbers into runs of consecutive blocks, as
+# (index in the list, first block, length) tuples.
+def blockRuns(bNums):
+    runs = []
+    for i, bNum in enumerate(bNums):
+        if runs and runs[-1][1] + runs[-1][2] == bNum:
+            runs[-1][2] += 1
+        else:
+            runs.append([i, bNum, 1])
+    return runs
+
+# Gather the blocks in the list bNums, in list order, into buffer['block'].
+# Consecutive block numbers are merged into one readBlocks call.
+def readBlockList(disk, bNums, buffer):
+    data = bytearray(len(bNums)*BLOCKSIZE)
+    for i, bNum, count in blockRuns(bNums):
+        run = {}
+        if readBlocks(disk, bNum, count, run) < 0:
+            return -1
+        data[i*BLOCKSIZE:(i + count)*BLOCKSIZE] = run['block']
+    buffer['block'] = data
+    return 0
+
+# Scatter buffer['block'] (len(bNums) * BLOCKSIZE bytes) to the blocks in bNums.
+# Consecutive block numbers are merged into one writeBlocks call.
+def writeBlockList(disk, bNums, buffer):
+    data = memoryview(buffer['block']).cast('B')
+    for i, bNum, count in blockRuns(bNums):
+        if writeBlocks(disk, bNum, count, {'block': data[i*BLOCKSIZE:(i + count)*BLOCKSIZE]}) < 0:
+            return -1
+    return 0
+
+# Make every write so far durable (fsync). The journal calls this to order its
+# writes against the writes home.
+def syncDisk(disk):
+    try:
+        os.fsync(disk.fileno())
+    except:
+        return -1
+    return 0
@@ -0,0 +1,116 @@
+from os.path import exists
+import os
+import mmap
+
+from libDisk import BLOCKSIZE, blockRuns
+
+"""
+MEMORY-MAPPED DISK
+Drop-in alternative to libDisk with the same openDisk/readBlock/writeBlock/closeDisk
+contract, plus the multi-block readBlocks/writeBlocks/readBlockList/writeBlockList and syncDisk. The whole disk file is mapped into memory once, so reads and writes are
+plain memory copies instead of a seek + read/write system call pair.
+
+readBlock and readBlocks do not copy at all: buffer['block'] is a read-only memoryview slice of
+the mapping. The view always shows the current contents of the block, so callers
+that need a snapshot must copy it (bytes(buffer['block'])). Every view has to be
+dropped before closeDisk can unmap the disk.
+"""
+
+class MmapDisk:
+    def __init__(self, file, mapping):
+        self.file = file
+        self.map = mapping
+        self.view = memoryview(mapping)
+        self.readonly = self.view.toreadonly()
+        self.num_blocks = len(mapping) // BLOCKSIZE
+
+def openDisk(filename, nBytes=0):
+    try:
+        if exists(filename) and nBytes == 0:
+            f = open(filename, "r+b")
+        else:
+            f = open(filename, "w+b")
+            # Extending the file fills it with 0
+            f.truncate(nBytes)
+        mapping = mmap.mmap(f.fileno(), 0)
+    except:
+        return -1
+    return MmapDisk(f, mapping)
+
+def readBlock(disk, bNum, buffer):
+    if bNum < 0 or bNum >= disk.num_blocks:
+        return -1
+    start = bNum * BLOCKSIZE
+    buffer['block'] = disk.readonly[start:start + BLOCKSIZE]
+    return 0
+
+def writeBlock(disk, bNum, buffer):
+    if bNum < 0 or bNum >= disk.num_blocks:
+        return -1
+    try:
+        data = memoryview(buffer['block']).cast('B')
+        # Only write BLOCKSIZE bytes to the disk
+        if len(data) > BLOCKSIZE:
+            data = data[:BLOCKSIZE]
+        start = bNum * BLOCKSIZE
+        disk.view[start:start + len(data)] = data
+    except:
+        return -1
+    return 0
+
+def readBlocks(disk, bNum, count, buffer):
+    if bNum < 0 or bNum + count > disk.num_blocks:
+        return -1
+    start = bNum * BLOCKSIZE
+    buffer['block'] = disk.readonly[start:start + count * BLOCKSIZE]
+    return 0
+
+def writeBlocks(disk, bNum, count, buffer):
+    if bNum < 0 or bNum + count > disk.num_blocks:
+        return -1
+    try:
+        data = memoryview(buffer['block']).cast('B')[:count * BLOCKSIZE]
+        start = bNum * BLOCKSIZE
+        disk.view[start:start + len(data)] = data
+    except:
+        return -1
+    return 0
+
+# Gathering into one buffer has to copy, only readBlocks is zero-copy
+def readBlockList(disk, bNums, buffer):
+    data = bytearray(len(bNums) * BLOCKSIZE)
+    for i, bNum, count in blockRuns(bNums):
+        run = {}
+        if readBlocks(disk, bNum, count, run) < 0:
+            return -1
+        data[i * BLOCKSIZE:(i + count) * BLOCKSIZE] = run['block']
+    buffer['block'] = data
+    return 0
+
+def writeBlockList(disk, bNums, buffer):
+    data = memoryview(buffer['block']).cast('B')
+    for i, bNum, count in blockRuns(bNums):
+        if writeBlocks(disk, bNum, count, {'block': data[i * BLOCKSIZE:(i + count) * BLOCKSIZE]}) < 0:
+            return -1
+    return 0
+
+# Flush the mapping to the file and make it durable (msync + fsync)
+def syncDisk(disk):
+    try:
+        disk.map.flush()
+        os.fsync(disk.file.fileno())
+    except:
+        return -1
+    return 0
+
+def closeDisk(disk):
+    try:
+        disk.map.flush()
+        disk.readonly.release()
+        disk.view.release()
+        # Fails with BufferError while a block view from readBlock is still alive
+        disk.map.close()
+        disk.file.close()
+    except:
+        return -1
+    return 0
@@ -0,0 +1,136 @@
+import random
+import zlib
+
+from libDisk import BLOCKSIZE
+from libLayout import JOURNAL_HEADER_LAYOUT, pack_pointers, unpack_pointers
+
+DESCRIPTOR_MAGIC = b"TJDS"
+COMMIT_MAGIC = b"TJCM"
+JOURNAL_RECORD_HEADER = 12 # magic, sequence number, block count
+DESCRIPTOR_ENTRIES = (BLOCKSIZE - JOURNAL_RECORD_HEADER) // 4
+
+class Journal:
+    """
+    METADATA JOURNAL
+    A write-ahead log in 'num_blocks' reserved blocks starting at block 'start'.
+    It holds at most one transaction, always written from the first journal block:
+
+    descriptor block: 4 byte magic "TJDS", 4 byte sequence number, 4 byte count,
+    then 'count' 4 byte home block numbers (up to DESCRIPTOR_ENTRIES)
+    'count' blocks: the new contents of those home blocks, in the same order
+    ... more descriptor groups for large transactions ...
+    commit block: 4 byte magic "TJCM", 4 byte sequence number, 4 byte crc32 of
+    every descriptor and block image in the transaction
+
+    A transaction counts once its commit block is on disk. commit() writes the
+    whole record with one writeBlocks call and then syncs the disk, after which
+    tinyFS writes the blocks home, syncs again and calls clear(), which zeroes
+    the first block. If the process dies between commit() and clear(), replay()
+    at the next mount finds a complete record and writes it home again, which
+    is harmless if part of it already was. A torn record fails the crc check and
+    is ignored, leaving the previous consistent state.
+
+    Sequence numbers start at a random value so a new record can never be
+    mistaken for leftovers of an older one further into the journal.
+    """
+
+    def __init__(self, disk, lib, start, num_blocks):
+        self.disk = disk
+        self.lib = lib
+        self.start = start
+        self.num_blocks = num_blocks
+        self.sequence = random.getrandbits(32)
+        self.commits = 0
+
+    def __str__(self):
+        return f"Journal(blocks {self.start}-{self.start + self.num_blocks - 1}, {self.commits} commits)"
+
+    # Journal blocks needed for a transaction of 'count' blocks
+    def record_blocks(self, count):
+        return count + -(-count // DESCRIPTOR_ENTRIES) + 1
+
+    # Largest number of blocks one transaction can hold
+    @property
+    def capacity(self):
+        count = self.num_blocks
+        while count > 0 and self.record_blocks(count) > self.num_blocks:
+            count -= 1
+        return count
+
+    # Log 'blocks', a list of (home block number, BLOCKSIZE bytes) pairs, as one
+    # transaction and make it durable. Returns 0, or -1 if the disk failed.
+    def commit(self, blocks):
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        record = bytearray()
+        crc = 0
+        for first in range(0, len(blocks), DESCRIPTOR_ENTRIES):
+            group = blocks[first:first + DESCRIPTOR_ENTRIES]
+            descriptor = bytearray(BLOCKSIZE)
+            JOURNAL_HEADER_LAYOUT.pack_into(descriptor, 0, DESCRIPTOR_MAGIC, self.sequence, len(group))
+            pack_pointers(descriptor, JOURNAL_RECORD_HEADER, [bNum for bNum, _ in group])
+            crc = zlib.crc32(descriptor, crc)
+            record += descriptor
+            for _, data in group:
+                crc = zlib.crc32(data, crc)
+                record += data
+        commit = bytearray(BLOCKSIZE)
+        JOURNAL_HEADER_LAYOUT.pack_into(commit, 0, COMMIT_MAGIC, self.sequence, crc)
+        record += commit
+        count = len(record) // BLOCKSIZE
+        if self.lib.writeBlocks(self.disk, self.start, count, {'block': record}) < 0:
+            return -1
+        self.commits += 1
+        return self.lib.syncDisk(self.disk)
+
+    # Mark the journal empty once a committed transaction is home
+    def clear(self):
+        return self.lib.writeBlock(self.disk, self.start, {'block': bytes(BLOCKSIZE)})
+
+    # The (home block number, data) pairs of the committed transaction in the
+    # journal, or [] if there is none.
+    def read_transaction(self):
+        # A clean journal is told apart by its first block alone
+        buffer = {}
+        if self.lib.readBlock(self.disk, self.start, buffer) < 0 or bytes(buffer['block'][:4]) != DESCRIPTOR_MAGIC:
+            return []
+        if self.lib.readBlocks(self.disk, self.start, self.num_blocks, buffer) < 0:
+            return []
+        journal = memoryview(bytes(buffer['block']))
+        blocks = []
+        crc = 0
+        sequence = None
+        position = 0
+        while position < self.num_blocks:
+            block = journal[position * BLOCKSIZE:(position + 1) * BLOCKSIZE]
+            magic, block_sequence, count = JOURNAL_HEADER_LAYOUT.unpack_from(block)
+            if sequence is not None and block_sequence != sequence:
+                return []
+            sequence = block_sequence
+            if magic == COMMIT_MAGIC:
+                committed = count == crc # the commit block holds the crc instead
+                return blocks if committed and blocks else []
+            if magic != DESCRIPTOR_MAGIC:
+                return []
+            if count > DESCRIPTOR_ENTRIES or position + 1 + count >= self.num_blocks:
+                return []
+            crc = zlib.crc32(block, crc)
+            for i, bNum in enumerate(unpack_pointers(block, JOURNAL_RECORD_HEADER, count)):
+                data = journal[(position + 1 + i) * BLOCKSIZE:(position + 2 + i) * BLOCKSIZE]
+                crc = zlib.crc32(data, crc)
+                blocks.append((bNum, bytes(data)))
+            position += 1 + count
+        return []
+
+    # Write a committed transaction left in the journal home, and clear it.
+    # Returns the number of blocks replayed (0 if the journal was clean), or -1.
+    def replay(self):
+        blocks = self.read_transaction()
+        if not blocks:
+            return 0
+        for bNum, data in blocks:
+            if self.lib.writeBlock(self.disk, bNum, {'block': data}) < 0:
+                return -1
+        if self.lib.syncDisk(self.disk) < 0:
+            return -1
+        self.clear()
+        return len(blocks)
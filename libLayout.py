@@ -0,0 +1,71 @@
+import struct
+from functools import lru_cache
+
+"""
+ON-DISK LAYOUTS
+Precompiled struct codecs for every fixed-size record tinyFS and its journal keep
+on disk, all little endian. They pack straight into a block buffer with
+pack_into and read straight out of one with unpack_from, instead of building
+records out of to_bytes slices and concatenation. See tinyFS.write_superblock,
+tinyFS.Inode and tinyFS.Directory for what each field means.
+"""
+
+# magic, root inode, blocks, free blocks, bitmap spill blocks, inode format,
+# first journal block, journal blocks. The bitmap follows.
+SUPERBLOCK_LAYOUT = struct.Struct("<BIIIIBII")
+# file size, file type, number of data blocks. The block map follows.
+INODE_LAYOUT = struct.Struct("<QBI")
+# extent inodes: number of extents, first overflow block
+EXTENT_HEADER_LAYOUT = struct.Struct("<II")
+# directory header block: entries, level, split pointer
+DIR_HEADER_LAYOUT = struct.Struct("<III")
+# directory bucket block: next overflow block, entries in this block
+BUCKET_HEADER_LAYOUT = struct.Struct("<IH")
+# directory entry: inode block number, name padded with null bytes
+DIR_ENTRY_LAYOUT = struct.Struct("<I8s")
+# journal descriptor and commit blocks: magic, sequence number, count or crc32
+JOURNAL_HEADER_LAYOUT = struct.Struct("<4sII")
+# compressed file chunk: length of the compressed bytes, see libCompress
+CHUNK_HEADER_LAYOUT = struct.Struct("<I")
+
+# Codec for 'count' consecutive 4 byte block numbers
+@lru_cache(maxsize=None)
+def pointer_layout(count):
+    return struct.Struct(f"<{count}I")
+
+def pack_pointers(buffer, offset, block_nums):
+    pointer_layout(len(block_nums)).pack_into(buffer, offset, *block_nums)
+
+def unpack_pointers(buffer, offset, count):
+    return list(pointer_layout(count).unpack_from(buffer, offset))
+
+
+class Record:
+    """
+    A record with one attribute per field of LAYOUT, in order. Subclasses list
+    the fields in __slots__, so a record costs no per-instance dict.
+    """
+
+    __slots__ = ()
+    LAYOUT = None
+
+    def __init__(self, *fields):
+        for name, value in zip(self.__slots__, fields):
+            setattr(self, name, value)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.LAYOUT.unpack_from(buffer, offset))
+
+    def pack_into(self, buffer, offset=0):
+        self.LAYOUT.pack_into(buffer, offset, *(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Superblock(Record):
+    __slots__ = ("magic", "root", "num_blocks", "num_free", "spill_blocks", "inode_format", "journal_start", "journal_blocks")
+    LAYOUT = SUPERBLOCK_LAYOUT
+
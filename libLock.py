@@ -0,0 +1,69 @@
+import threading
+from contextlib import contextmanager, nullcontext
+
+class RWLock:
+    """
+    READER/WRITER LOCK
+    Any number of readers, or one writer. Used per inode by tinyFS in thread-safe
+    mode: reads of a file run in parallel, writes to it run alone.
+
+    Writers are preferred: once a writer is waiting, new readers wait behind it,
+    so a steady stream of readers cannot starve it. Not reentrant.
+
+    with lock.read(): ...
+    with lock.write(): ...
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class NoLock:
+    """
+    Stand-in for RWLock and threading locks when tinyFS is not in thread-safe
+    mode, so the same code runs without paying for locking.
+    """
+
+    def read(self):
+        return nullcontext()
+
+    def write(self):
+        return nullcontext()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
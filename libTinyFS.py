@@ -4,63 +4,271 @@ from logging import root
 # from numpy import block
 from libDisk import BLOCKSIZE
 import libDisk as ld
+import libDiskMmap as ldm
+from libCache import BlockCache, ChunkCache, DentryCache, DENTRY_MISS, DEFAULT_CACHE_BLOCKS, DEFAULT_DENTRY_ENTRIES, DEFAULT_CHUNK_CACHE
+from libBitmap import BlockBitmap
+from libLock import RWLock, NoLock
+from libJournal import Journal
+from libCompress import COMPRESSION_CODECS, encode_chunk, decode_chunk
+from libLayout import *
 from array import *
 import math
-from collections import deque
+import zlib
+from collections import deque, OrderedDict
+from bisect import bisect_right
+import functools
+import threading
+import time
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
 MAGIC_NUMBER = 0x5A
 SUPERBLOCK = 0x00
 ROOT_INODE = 0x01
 DEFAULT_DISK_SIZE = 10240
 DEFAULT_DISK_NAME = "tinyFSDisk"
-MAX_OPEN_FILES = 20
+DEFAULT_MAX_OPEN_FILES = 1024 # descriptors, the root directory's included
+DEFAULT_FILE_CACHE = 16 # closed files kept open, see tinyFS.closed_files
 MAX_FILENAME = 8
+BLOCK_NUMBER_SIZE = 4 # block numbers are stored as 32 bit little endian ints
+
+# Superblock layout, see tfs_mkfs
+SUPERBLOCK_HEADER = SUPERBLOCK_LAYOUT.size # 26 bytes
+SUPERBLOCK_BITMAP_BYTES = BLOCKSIZE - SUPERBLOCK_HEADER
+BITMAP_START = ROOT_INODE + 1 # first block the bitmap spills into
+
+# Inode layout, see Inode.encode
+INODE_HEADER = INODE_LAYOUT.size # 13 bytes
+INDIRECT_LEVELS = 3 # single, double and triple indirect pointers at the end of the inode
+INDIRECT_START = BLOCKSIZE - INDIRECT_LEVELS * BLOCK_NUMBER_SIZE
+NUM_DIRECT_BLOCKS = (INDIRECT_START - INODE_HEADER) // BLOCK_NUMBER_SIZE
+POINTERS_PER_BLOCK = BLOCKSIZE // BLOCK_NUMBER_SIZE
+MAX_FILE_BLOCKS = NUM_DIRECT_BLOCKS + sum(POINTERS_PER_BLOCK ** (level + 1) for level in range(INDIRECT_LEVELS))
+
+# Extent inode layout, see ExtentInode
+EXTENT_SIZE = 2 * BLOCK_NUMBER_SIZE # start block, length
+EXTENT_START = INODE_HEADER + EXTENT_HEADER_LAYOUT.size
+INODE_EXTENTS = (BLOCKSIZE - EXTENT_START) // EXTENT_SIZE
+EXTENTS_PER_BLOCK = (BLOCKSIZE - BLOCK_NUMBER_SIZE) // EXTENT_SIZE
+
+# Inode formats tfs_mkfs can make, and the superblock byte recording them
+INODE_FORMATS = {
+    "indirect": 0, # direct blocks plus indirect pointer blocks, see Inode
+    "extent": 1, # (start block, length) runs, see ExtentInode
+}
+
+# Directory layout, see Directory
+DIR_ENTRY_SIZE = BLOCK_NUMBER_SIZE + MAX_FILENAME # inode block number followed by the name
+DIR_BUCKET_HEADER = BUCKET_HEADER_LAYOUT.size # 6 bytes
+DIR_ENTRIES_PER_BLOCK = (BLOCKSIZE - DIR_BUCKET_HEADER) // DIR_ENTRY_SIZE
+INITIAL_BUCKETS = 1
+DIR_LOAD_FACTOR = 0.75 # split a bucket once the table is this full
+
+# Metadata journal, see libJournal.py
+DEFAULT_JOURNAL_BLOCKS = 64 # at most a quarter of the disk, 0 turns journaling off
+MIN_JOURNAL_BLOCKS = 3 # a descriptor, one block and a commit block
+COMMIT_BATCH = 64 # operations per group commit
+COMMIT_INTERVAL = 1.0 # seconds, commit sooner than COMMIT_BATCH if this much time has passed
+
+# Read-ahead, see File.readahead
+DEFAULT_READAHEAD_BLOCKS = 32 # largest window, also held to half the block cache
+READAHEAD_MIN_BLOCKS = 4 # first window once reads look sequential
+
+# Compressed files, see File.pwrite_compressed
+COMPRESSED_CHUNK_BLOCKS = 16 # logical blocks reserved per chunk
+CHUNK_SIZE = COMPRESSED_CHUNK_BLOCKS * BLOCKSIZE # bytes of file data per chunk
+ZERO_CHUNK = bytes(CHUNK_SIZE)
+
+# Bulk reads, see tinyFS.tfs_bulk_read
+BULK_READ_BLOCKS = 256 # data blocks read per call
+
+# Disk libraries tfs_mkfs/tfs_mount can use. Both have the same interface.
+DISK_BACKENDS = {
+    "file": ld, # seek + read/write on a regular file
+    "mmap": ldm, # memory-mapped file, zero-copy block reads
+}
+
+# Run a tinyFS method holding the filesystem's global lock, see tinyFS.lock
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+# Time a tfs_ call and count its disk I/O when the filesystem has a Tracer (see
+# libTrace.py). Goes outermost, so lock waits and group commits are included.
+def traced(method):
+    name = method.__name__
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.tracer is None:
+            return method(self, *args, **kwargs)
+        return self.tracer.call(name, method, self, *args, **kwargs)
+    return wrapper
+
+# Count a tinyFS call as one operation towards the next group commit, see tinyFS.end_op.
+# Goes outside @locked so the commit runs after the call has dropped the global lock.
+def group_commit(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.end_op()
+        return result
+    return wrapper
 
 class tinyFS:
 
-    def __init__(self):
+    def __init__(self, cache_blocks=DEFAULT_CACHE_BLOCKS, dentry_entries=DEFAULT_DENTRY_ENTRIES, threadsafe=False, tracer=None,
+                 readahead_blocks=DEFAULT_READAHEAD_BLOCKS, chunk_cache=DEFAULT_CHUNK_CACHE, max_open_files=DEFAULT_MAX_OPEN_FILES,
+                 file_cache=DEFAULT_FILE_CACHE):
         self.mounted = False
         self.current_fs = ""
         self.current_disk = None
+        self.disk_lib = ld
+
+        # Every block read and write goes through this cache while a disk is open.
+        # cache_blocks is its capacity in blocks, 0 disables caching.
+        self.cache_blocks = cache_blocks
+        self.cache = None
+
+        # Path -> inode block number lookups, see resolve(). dentry_entries is its capacity.
+        self.dentries = DentryCache(dentry_entries)
+        # Directory objects in use, by inode block number. Every open of a directory
+        # has to share one object, it holds the hash table header in memory.
+        self.directories = {}
+
+        """
+        INODE TABLE
+        Inodes in use, by inode block number, like a kernel's in-core inodes. Every open
+        file descriptor and every Directory object holds a reference on one of these, so
+        two descriptors for the same file share one Inode (size, block map and pointer
+        cache) while keeping their own file pointer. An inode is read from disk on its
+        first reference and written back, only if it changed, when its last reference
+        is dropped or the filesystem is unmounted. See get_inode and put_inode.
+        """
+        self.inodes = {}
+
+        """
+        LOCKING
+        With threadsafe=True one mounted tinyFS can be used from several threads.
+        self.lock is a global (reentrant) lock for the allocator, the file descriptor
+        table, the inode table and the namespace: open, close, delete, mkdir, readdir
+        and rename hold it throughout. File data is guarded by a reader/writer lock
+        per inode (Inode.lock), so reads of the same file run in parallel and reads
+        and writes of different files never wait on each other. The block cache has
+        its own lock, and libDisk uses positional reads and writes.
+        Lock order: an inode lock is always taken before the global lock, and several
+        inode locks are taken in inode block number order, see lock_inodes.
+        A file descriptor itself must only be used by one thread at a time, since
+        it holds the file pointer.
+        Without threadsafe every lock is a NoLock that does nothing.
+        """
+        self.threadsafe = threadsafe
+        self.lock = threading.RLock() if threadsafe else NoLock()
+
+        # Largest read-ahead window in blocks, 0 turns read-ahead off. In thread-safe
+        # mode read-ahead runs on a background thread (made on first use) while the
+        # reader carries on. See File.readahead.
+        self.readahead_blocks = min(readahead_blocks, cache_blocks // 2)
+        self.prefetcher = None
+
+        # Decompressed chunks of compressed files, chunk_cache is its capacity in
+        # chunks. See File.chunk.
+        self.chunks = ChunkCache(chunk_cache, self.cache_lock())
+
+        # A libTrace.Tracer that times every tfs_ call and counts its disk I/O and
+        # allocations, or None to run without instrumentation. See tfs_stats.
+        self.tracer = tracer
         
         """
-        FREE BLOCK TABLE
-        An array tracking whether a specific block is free or not. 
-        The array is 0 indexed and the free blocks start at BLOCK #2 because the 
-        superblock and root inode take up the first 2 blocks, 0 and 1 respectively. 
-        To see if a block is free, access the following way:
-        self.free_block_table[block_index - 2]
-        For example, to check if block 2, the first open block, is free we do:
-        self.free_block_table[2 - 2] -> self.free_block_table[0]
-
-        This table is loaded upon mounting a disk. It is adjusted here for all disk operations.
+        FREE BLOCK BITMAP
+        A BlockBitmap (see libBitmap.py) with one bit per block of the disk, indexed by
+        absolute block number. The superblock, root inode and any blocks the bitmap
+        spills into are marked used when the disk is formatted.
+        To see if a block is free:
+        self.bitmap.is_free(block_index)
+
+        This bitmap is loaded the first time it is needed after mounting a disk, see
+        load_bitmap. It is adjusted here for all disk operations.
         It is written back to the disk upon unmounting. 
         """
-        self.free_block_table = None
+        self.bitmap = None
+
+        # How inodes map their data blocks, one of INODE_FORMATS. Chosen at tfs_mkfs
+        # and read back from the superblock by tfs_mount.
+        self.inode_format = "indirect"
+        # Codec new files are compressed with, one of COMPRESSION_CODECS. Chosen at
+        # tfs_mkfs, tfs_open can pick another for each file it creates.
+        self.compression = "none"
+
+        """
+        METADATA JOURNAL
+        A Journal (see libJournal.py) in journal_blocks blocks reserved right after the
+        bitmap, or None if the disk was made without one. While it is on, every
+        metadata block write (superblock and bitmap, inodes, pointer and extent blocks,
+        directory blocks) is held in the block cache until a group commit logs all of
+        them as one transaction and only then writes them home. File data is written
+        before the commit (ordered mode) so metadata never points at stale data.
+        A commit happens after COMMIT_BATCH operations or COMMIT_INTERVAL seconds,
+        on tfs_sync and on tfs_unmount. tfs_mount replays a committed transaction that
+        did not make it home.
+        """
+        self.journal = None
+        self.journal_start = 0
+        self.journal_blocks = 0
+        self.ops = 0 # operations since the last commit
+        self.last_commit = time.monotonic()
+        self.pending_free = [] # blocks freed since the last commit, see free()
 
         """
         ROOT INODE STRUCTURE
-        First byte is the number of files in the directory
+        The root directory's data block holds filename/inode pairs, and its inode
+        size is the number of pairs * DIR_ENTRY_SIZE.
         Filename/inode pairs are stored as follows:
-        9 bytes: 
-        first byte is the block # of the inode
+        12 bytes: 
+        first 4 bytes are the block # of the inode
         next 8 bytes contain the filename: up to 8 characters
         This information is loaded into a self.file_table upon mounting.
         The Python dict is referenced and updated while the fs is mounted
         When unmounting, the Python dict is translated into the specified format
         and the block is written to the disk
         """
-        # self.file_table = None
-        self.file_table = [None] * MAX_OPEN_FILES # stores inode number at 
-        self.free_fds = deque(range(0, MAX_OPEN_FILES), maxlen=MAX_OPEN_FILES)
+
+        """
+        FILE DESCRIPTOR TABLE
+        file_table[fd] is the File (or Directory) open on descriptor fd, None if fd is
+        free. The table starts empty and grows by one slot when every slot is in use,
+        up to max_open_files slots (None for no limit), past which tfs_open returns
+        -15. free_fds holds the free slots, so taking and giving back a descriptor
+        costs the same however many are open. The root directory keeps one while the
+        filesystem is mounted.
+        """
+        self.max_open_files = max_open_files
+        self.file_table = []
+        self.free_fds = deque()
+
+        """
+        CLOSED FILE CACHE
+        The last file_cache regular files closed, by inode block number, least
+        recently closed first. Each keeps its File and the inode reference that came
+        with it, so the inode stays in the inode table with its block map and pointer
+        cache, and opening the file again reuses them instead of reading the inode.
+        The inode is still written back on close. Evicting a file drops its reference,
+        and deleting a file evicts it. 0 turns this off.
+        """
+        self.file_cache = file_cache
+        self.closed_files = OrderedDict()
+        self.file_hits = 0
+        self.file_misses = 0
 
 
     def __str__(self):
         return f"\
             Mounted: {self.current_fs}\n\
-            Open Blocks: {len(self.free_block_table)}\n\
-            Block table:\n\
-            {self.free_block_table}\n\
+            Open Blocks: {self.bitmap.num_free}\n\
+            Block bitmap:\n\
+            {self.bitmap}\n\
             File table:\n\
             {self.file_table}"
 
@@ -70,80 +278,122 @@ class tinyFS:
     # upon success, format the file to be mountable. This includes initializing all data 
     # to 0x00, setting magic numbers, initializing and writing the superblock and other 
     # metadata, etc. Must return a specified success/error code.
-    def tfs_mkfs(self, filename=DEFAULT_DISK_NAME, nBytes=DEFAULT_DISK_SIZE):
-        disk = ld.openDisk(filename, nBytes)
+    # 'backend' picks the disk library from DISK_BACKENDS, 'inode_format' picks how inodes map
+    # their data blocks from INODE_FORMATS.
+    # 'journal_blocks' is the size of the metadata journal, it is cut down to a quarter of
+    # the disk and dropped if that is too small to hold a transaction.
+    # 'compression' is the codec from COMPRESSION_CODECS new files are compressed with.
+    @traced
+    def tfs_mkfs(self, filename=DEFAULT_DISK_NAME, nBytes=DEFAULT_DISK_SIZE, backend="file", inode_format="indirect", journal_blocks=DEFAULT_JOURNAL_BLOCKS,
+                 compression="none"):
+        if backend not in DISK_BACKENDS or inode_format not in INODE_FORMATS or compression not in COMPRESSION_CODECS:
+            return -1
+        self.inode_format = inode_format
+        self.compression = compression
+        disk_lib = self.traced_disk(DISK_BACKENDS[backend])
+        disk = disk_lib.openDisk(filename, nBytes)
+        if disk == -1: # error
+            return disk # for now, return same error code
         self.current_disk = disk
-
-        """ if disk < 0: # error
-            return disk # for now, return same error code """
+        self.cache = BlockCache(disk, self.cache_blocks, disk_lib, self.cache_lock())
 
         # don't need to initialize data to 0x00 because we're doing it in ld.openDisk
         
-        
-        # num of total blocks minus superblock and root inode
-        num_free_blocks = int(nBytes/BLOCKSIZE - 2)
-
-        # Store array of unsigned ints, each one 2 bytes. 
-        # Index+2 corresponds to block number. Tracks whether or not the block is free. 
-        free_bytes = BLOCKSIZE - 3 # number of remaining bytes in the superblock
-        max_free_blocks = free_bytes # 1 byte to track each block
-        if num_free_blocks <= max_free_blocks:
-            self.free_block_table = [0]*num_free_blocks
-        else:
-            # Cannot support this disk size. Superblock does not have enough
-            # space to track free blocks
+        num_blocks = nBytes // BLOCKSIZE
+        # The bitmap starts in the superblock and spills into the blocks right after the root inode
+        bitmap_bytes = math.ceil(num_blocks / 8)
+        spill_blocks = math.ceil(max(0, bitmap_bytes - SUPERBLOCK_BITMAP_BYTES) / BLOCKSIZE)
+        # The journal comes right after the bitmap
+        journal_blocks = min(journal_blocks, num_blocks // 4)
+        if journal_blocks < MIN_JOURNAL_BLOCKS:
+            journal_blocks = 0
+        self.journal = None
+        self.journal_start = BITMAP_START + spill_blocks
+        self.journal_blocks = journal_blocks
+        reserved = [SUPERBLOCK, ROOT_INODE] + list(range(BITMAP_START, self.journal_start + journal_blocks))
+        # Also need room for the root directory's data block
+        if num_blocks < len(reserved) + 1 or num_blocks >= 2 ** (8 * BLOCK_NUMBER_SIZE):
+            # Cannot support this disk size
             return -2
+        self.bitmap = BlockBitmap(num_blocks)
+        self.bitmap.reserve(reserved)
 
         # create root directory first
-        # doing this in this order so free_block_table gets saved properly
+        # doing this in this order so the bitmap gets saved properly
+        self.inodes = {}
         root = self.create_directory(mode="new", block=ROOT_INODE, parent=ROOT_INODE)
-        data = {'block': root.inode.encode()}
-        ld.writeBlock(disk, ROOT_INODE, data)
-
-        # 1st byte of superblock is magic number
-        # 2nd byte of superblock is root inode block number
-        # 3rd byte of superblock is number of free blocks at disk creation
-        # remaining bytes are a table tracking the free blocks
+        root.write_inode()
+        self.inodes = {}
 
-        # 1 byte max is 255. num_free_blocks will always be less than 255. 
-        superblock_data = [MAGIC_NUMBER, ROOT_INODE, num_free_blocks] + self.free_block_table
-        superblock = {"block": array('B', superblock_data)}
-        ld.writeBlock(disk, SUPERBLOCK, superblock)
+        self.write_superblock()
+        self.cache.sync()
 
         self.current_disk = None
+        self.cache = None
 
         return disk
 
     # tfs_mount(char *filename) “mounts” a TinyFS file system located within ‘filename’. 
     # As part of the mount operation, tfs_mount should verify the file system is the correct
     # type. Only one file system may be mounted at a time.  Must return a specified success/error code.
-    def tfs_mount(self, filename):
-        disk = ld.openDisk(filename)
-        self.current_disk = disk
-
-        """
-        if disk < 0: # error
+    # 'backend' picks the disk library from DISK_BACKENDS, it does not have to match the one
+    # used by tfs_mkfs.
+    @traced
+    @locked
+    def tfs_mount(self, filename, backend="file"):
+        if backend not in DISK_BACKENDS:
+            return -1
+        self.disk_lib = self.traced_disk(DISK_BACKENDS[backend])
+        disk = self.disk_lib.openDisk(filename)
+        if disk == -1: # error
             return disk # for now, return same error code
-        """
+        self.current_disk = disk
+        self.cache = BlockCache(disk, self.cache_blocks, self.disk_lib, self.cache_lock())
         
 
         # Superblock
         superblock = {}
-        ld.readBlock(disk, SUPERBLOCK, superblock)
-        superblock_data = bytearray(superblock['block'])
+        self.cache.readBlock(SUPERBLOCK, superblock)
+        header = Superblock.unpack_from(superblock['block'])
         # Verify filesystem type
-        if superblock_data[0] != MAGIC_NUMBER:
+        if header.magic != MAGIC_NUMBER:
             # Incorrect filesystem type. Exit.
             return -3
-        num_free_blocks = superblock_data[2]
-        free_block_table = superblock_data[3:num_free_blocks + 3]
-        self.free_block_table = array('B', free_block_table)
-
-        root_directory = self.create_directory(mode="block", block=ROOT_INODE, parent=ROOT_INODE)
-        self.root_dir_fd = self.free_fds.popleft()
-        # store open file object, file pointer in file table
-        self.file_table[self.root_dir_fd] = (root_directory, 0)
-        print(root_directory)
+        self.journal_start = header.journal_start
+        self.journal_blocks = header.journal_blocks
+        self.journal = None
+        if self.journal_blocks > 0:
+            self.journal = Journal(disk, self.disk_lib, self.journal_start, self.journal_blocks)
+            # Finish a commit that was cut short, it may include the superblock
+            replayed = self.journal.replay()
+            if replayed < 0:
+                return -1
+            if replayed > 0:
+                self.cache.invalidate()
+                self.cache.readBlock(SUPERBLOCK, superblock)
+                header = Superblock.unpack_from(superblock['block'])
+            self.cache.journaled = True
+        self.ops = 0
+        self.last_commit = time.monotonic()
+        self.pending_free = []
+        self.root_number = header.root
+        for name, code in INODE_FORMATS.items():
+            if header.inode_format & 0x0F == code:
+                self.inode_format = name
+        for name, code in COMPRESSION_CODECS.items():
+            if header.inode_format >> 4 == code:
+                self.compression = name
+        self.chunks.clear()
+        # The bitmap, the root directory and every other inode are read on first use,
+        # so mounting reads the superblock (and the first journal block) whatever the
+        # size of the disk or the number of files, and never writes.
+        self.bitmap = None
+        self.inodes = {}
+        self.directories = {}
+        self.dentries.clear()
+        # The root directory keeps its descriptor, its Directory is made by open_directory
+        self.closed_files = OrderedDict()
+        self.root_dir_fd = self.allocate_fd((None, 0))
 
         self.mounted = True
         self.current_fs = filename
@@ -155,33 +405,31 @@ class tinyFS:
     # Use tfs_unmount to cleanly unmount the currently mounted file system.
     # Write updated superblock back to disk
     # Write updated root inode back to disk
+    @traced
+    @locked
     def tfs_unmount(self):
-        # superblock
-        superblock_data = [MAGIC_NUMBER, ROOT_INODE, len(self.free_block_table)] + list(self.free_block_table)
-        superblock = {"block": array('B', superblock_data)}
-        ld.writeBlock(self.current_disk, SUPERBLOCK, superblock)
-
-        # Root INODE
-        root_dir = self.file_table[self.root_dir_fd][0]
-        num_files = len(root_dir.files.keys())
-        data = bytearray()
-        for key,val in root_dir.files.items():
-
-            pair = [val]
-            pair = array('B', pair)
-            pair = bytearray(pair)
-            pair.extend(key)
-
-            for i in range(8 - len(key)):
-                pair.append(0)
-            data.extend(pair)
-        num_files = array('B', [num_files])
-        num_files = bytearray(num_files)
-        root_data = num_files + data
-        root_buffer = {"block": root_data}
-        ld.writeBlock(self.current_disk, ROOT_INODE, root_buffer)
+        # Files deleted while open are freed now, then the last commit writes back
+        # every other inode still in use and the superblock.
+        for inode in self.inodes.values():
+            if inode.unlinked:
+                self.release_inode(inode)
+        self.commit()
+        self.inodes = {}
+        self.closed_files = OrderedDict()
+        self.directories = {}
+        self.dentries.clear()
+        self.journal = None
+
+        # Let background read-ahead finish before the disk goes away
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=True)
+            self.prefetcher = None
+        # Drop the cache first, it may hold block views that keep an mmap disk open
+        self.cache = None
+        self.disk_lib.closeDisk(self.current_disk)
         
         # Reset values
+        self.release_fd(self.root_dir_fd)
         self.current_disk = None
         self.mounted = False
         self.current_fs = ""
@@ -191,129 +439,831 @@ class tinyFS:
     # a dynamic resource table entry for the file (the structure that tracks open files, 
     # the internal file pointer, etc.), and returns a file descriptor (integer) that can 
     # be used to reference this file while the filesystem is mounted.
-    def tfs_open(self, name):
-        root_dir = self.file_table[self.root_dir_fd][0]
-        
-        name = name.encode('utf-8')
-        if name in root_dir.files:
-            inode = root_dir.files[name]
-            if name[-1] == "/":
-                file = self.create_directory(mode="block", block=inode)
-            else:
-                file = self.create_file(mode="block", block=inode, name=name)
-
+    # 'name' is a path like "/a/b/c", names without a leading slash are looked up from the
+    # root directory. A path ending in a slash opens (or creates) a directory.
+    # A file created here is compressed with codec 'compression' from COMPRESSION_CODECS,
+    # or the filesystem's codec if None. It has no effect on files that already exist.
+    # Returns -15 if max_open_files descriptors are already open.
+    @traced
+    @group_commit
+    @locked
+    def tfs_open(self, name, compression=None):
+        if compression is not None and compression not in COMPRESSION_CODECS:
+            return -1
+        if not self.free_fds and self.max_open_files is not None and len(self.file_table) >= self.max_open_files:
+            return -15 # too many open files
+        components, is_dir = self.split_path(name)
+        if components is None:
+            return -9 # name too long
+        if not components:
+            file = self.open_directory(self.root_inode)
+            self.get_inode(file.inode.number)
         else:
-            # Find open block
-            inode = self.allocate(1)
-            if inode is None: 
-                # No free blocks.
-                return -4
-            inode = inode[0]
-            print(f"Writing")
-
-            # Update the file table
-            if name[-1] == "/":
-                file = self.create_directory(mode="new", block=inode)
+            inode = self.resolve(components)
+            if inode is None:
+                inode = self.create(components, is_dir, compression)
+                if inode < 0:
+                    return inode
+            file = self.open_directory(inode)
+            if file is None:
+                if is_dir:
+                    return -11 # not a directory
+                file = self.reopen_file(inode, self.join_path(components))
             else:
-                file = self.create_file(mode="new", block=inode, name=name)
-            
-            data = {'block': file.inode.encode()}
-            ld.writeBlock(self.current_disk, inode, data)
-            root_dir.add_file(name, inode)
+                # the descriptor holds its own reference on the shared directory inode
+                self.get_inode(inode)
+
+        return self.allocate_fd(file)
+
+    # Creates an empty directory at 'path'. Its parent directory must already exist.
+    @traced
+    @group_commit
+    @locked
+    def tfs_mkdir(self, path):
+        components, _ = self.split_path(path)
+        if components is None:
+            return -9 # name too long
+        if not components or self.resolve(components) is not None:
+            return -13 # already exists
+        error = self.create(components, True)
+        return error if error < 0 else 0
+
+    # Returns the names in the directory at 'path', without "." and "..".
+    # Directory contents come out in hash order, not sorted.
+    @traced
+    @locked
+    def tfs_readdir(self, path="/"):
+        components, _ = self.split_path(path)
+        if components is None:
+            return -9 # name too long
+        inode = self.resolve(components)
+        if inode is None:
+            return -10 # no such file or directory
+        directory = self.open_directory(inode)
+        if directory is None:
+            return -11 # not a directory
+        return [name.decode('utf-8') for name, _ in directory.entries() if name not in (b".", b"..")]
+
+    # Moves the file or directory at 'old' to 'new'. The new parent directory must exist
+    # and 'new' must not.
+    @traced
+    @group_commit
+    @locked
+    def tfs_rename(self, old, new):
+        old_components, _ = self.split_path(old)
+        new_components, _ = self.split_path(new)
+        if old_components is None or new_components is None:
+            return -9 # name too long
+        if not old_components or not new_components:
+            return -14 # cannot rename the root directory
+        if new_components[:len(old_components)] == old_components:
+            return -14 # cannot move a directory inside itself
+        inode = self.resolve(old_components)
+        if inode is None:
+            return -10 # no such file or directory
+        new_parent_inode = self.resolve(new_components[:-1])
+        if new_parent_inode is None:
+            return -10 # no such file or directory
+        new_parent = self.open_directory(new_parent_inode)
+        if new_parent is None:
+            return -11 # not a directory
+        if self.resolve(new_components) is not None:
+            return -13 # already exists
+        error = new_parent.add_file(new_components[-1], inode)
+        if error < 0:
+            return error
+        old_parent_inode = self.resolve(old_components[:-1])
+        self.open_directory(old_parent_inode).remove_file(old_components[-1])
+        directory = self.open_directory(inode)
+        if directory is not None and old_parent_inode != new_parent_inode:
+            directory.add_file(b"..", new_parent_inode)
+
+        old_path = self.join_path(old_components)
+        new_path = self.join_path(new_components)
+        self.dentries.invalidate(old_path)
+        self.dentries.invalidate(new_path)
+        self.dentries.put(new_path, inode)
+        # open files keep their paths for tfs_delete
+        for entry in self.file_table:
+            f = entry[0] if isinstance(entry, tuple) else entry
+            if isinstance(f, self.File) and f.name is not None and (f.name == old_path or f.name.startswith(old_path + b"/")):
+                f.name = new_path + f.name[len(old_path):]
+        return 0
 
-        fd = self.free_fds.popleft()
-        self.file_table[fd] = file
+    # Root directory inode block number
+    @property
+    def root_inode(self):
+        return self.root_number
+
+    # Free block bitmap, read from the superblock and the blocks it spills into the
+    # first time it is needed after mounting
+    @property
+    def bitmap(self):
+        if self.block_bitmap is None and self.mounted:
+            with self.lock:
+                if self.block_bitmap is None:
+                    self.block_bitmap = self.load_bitmap()
+        return self.block_bitmap
+
+    @bitmap.setter
+    def bitmap(self, bitmap):
+        self.block_bitmap = bitmap
+
+    def load_bitmap(self):
+        superblock = {}
+        self.cache.readBlock(SUPERBLOCK, superblock)
+        header = Superblock.unpack_from(superblock['block'])
+        bitmap = bytearray(superblock['block'][SUPERBLOCK_HEADER:])
+        if header.spill_blocks > 0:
+            spill = {}
+            self.cache.readBlockList(list(range(BITMAP_START, BITMAP_START + header.spill_blocks)), spill)
+            bitmap += spill['block']
+        return BlockBitmap(header.num_blocks, bitmap)
+
+    # Split a path into a list of name components (bytes), and whether it ends in a slash.
+    # Returns None for the components if one of them is longer than MAX_FILENAME.
+    def split_path(self, path):
+        is_dir = path.endswith("/") and path != "/"
+        components = [part.encode('utf-8') for part in path.split("/") if part != ""]
+        if any(len(part) > MAX_FILENAME for part in components):
+            return None, is_dir
+        return components, is_dir
+
+    def join_path(self, components):
+        return b"/" + b"/".join(components)
+
+    # Inode block number of the file or directory at 'components', or None if it does
+    # not exist. Each prefix of the path is looked up in the dentry cache first, and
+    # only walked (one directory lookup) when the cache does not know it.
+    def resolve(self, components):
+        if not components:
+            return self.root_inode
+        path = self.join_path(components)
+        inode = self.dentries.get(path)
+        if inode is not DENTRY_MISS:
+            return inode
+        parent = self.resolve(components[:-1])
+        directory = self.open_directory(parent) if parent is not None else None
+        inode = directory.lookup(components[-1]) if directory is not None else None
+        self.dentries.put(path, inode)
+        return inode
+
+    # The Directory object for inode block 'inode', or None if it is a regular file
+    def open_directory(self, inode):
+        if inode in self.directories:
+            return self.directories[inode]
+        is_directory = self.get_inode(inode).filetype == 1
+        directory = self.create_directory(mode="block", block=inode) if is_directory else None
+        self.put_inode(self.inodes[inode])
+        if directory is not None:
+            self.directories[inode] = directory
+        return directory
+
+    # Make a new empty file (or directory) at 'components' and return its inode block
+    # number, or an error code if the parent does not exist or there is no space.
+    # A file is compressed with 'compression', the filesystem's codec if None.
+    def create(self, components, is_dir, compression=None):
+        parent_inode = self.resolve(components[:-1])
+        if parent_inode is None:
+            return -10 # no such file or directory
+        parent = self.open_directory(parent_inode)
+        if parent is None:
+            return -11 # not a directory
+
+        # Find open block
+        inode = self.allocate(1)
+        if inode is None: 
+            # No free blocks.
+            return -4
+        inode = inode[0]
+
+        if is_dir:
+            file = self.create_directory(mode="new", block=inode, parent=parent_inode)
+            self.directories[inode] = file
+        else:
+            file = self.create_file(mode="new", block=inode)
+            file.inode.codec = COMPRESSION_CODECS[compression or self.compression]
+        file.inode.write()
         
-        return fd
+        error = parent.add_file(components[-1], inode)
+        if error < 0:
+            self.directories.pop(inode, None)
+            file.inode.unlinked = True
+            self.put_inode(file.inode)
+            return error
+        if not is_dir:
+            # tfs_open takes its own reference
+            self.put_inode(file.inode)
+        self.dentries.put(self.join_path(components), inode)
+        return inode
     
+    # Create the new files of tfs_bulk_write, 'groups' mapping each parent directory's
+    # inode to its [(components, data)]. Returns an error code and the paths of the
+    # compressed files that were created empty, for the caller to write.
+    def bulk_create(self, groups, codec):
+        inline_size = self.inode_class().INLINE_SIZE
+        max_blocks = self.inode_class().MAX_BLOCKS
+        planned = [] # (components, data, data blocks), grouped by parent
+        deferred = []
+        for entries in groups.values():
+            for components, data in entries:
+                count = 0
+                if len(data) > inline_size and codec:
+                    deferred.append(self.join_path(components))
+                    data = b""
+                elif len(data) > inline_size:
+                    count = math.ceil(len(data) / BLOCKSIZE)
+                    if count > max_blocks:
+                        return -8, [] # file too large
+                planned.append((components, data, count))
+        # each file's pointer blocks come right before its data blocks
+        map_blocks = [self.inode_class().map_blocks(count) for _, _, count in planned]
+        blocks = self.allocate(len(planned) + sum(count for _, _, count in planned) + sum(map_blocks))
+        if blocks is None:
+            return -4, [] # no space
+        data_blocks = [] # (block number, bytes) for every data block
+        inodes = []
+        used = len(planned) # blocks handed out so far, the inode blocks come first
+        for (components, data, count), pointers, number in zip(planned, map_blocks, blocks):
+            inode = self.create_inode(mode="new", block=number)
+            inode.codec = codec
+            inode.size = len(data)
+            inodes.append(inode)
+            if count == 0:
+                inode.inline = bytearray(data)
+                continue
+            inode.spare = blocks[used:used + pointers]
+            used += pointers
+            for j in range(count):
+                if inode.set_block(j, blocks[used + j]) < 0:
+                    # out of space for extent overflow blocks, undo everything
+                    inode.num_blocks = j
+                    for made in inodes:
+                        made.truncate(0)
+                    self.free(blocks[:len(planned)] + inode.spare + blocks[used + j:])
+                    return -4, [] # no space
+            inode.num_blocks = count
+            data_blocks.extend((blocks[used + j], data[j * BLOCKSIZE:(j + 1) * BLOCKSIZE]) for j in range(count))
+            used += count
+        # data first, then the inodes that point at it, each in block order
+        if data_blocks:
+            data_blocks.sort(key=lambda block: block[0])
+            contents = b"".join(data.ljust(BLOCKSIZE, b"\0") for _, data in data_blocks)
+            self.cache.writeBlockList([number for number, _ in data_blocks], {'block': contents}, journal=False)
+        by_number = sorted(inodes, key=lambda inode: inode.number)
+        self.cache.writeBlockList([inode.number for inode in by_number], {'block': b"".join(inode.encode() for inode in by_number)})
+        start = 0
+        for parent, entries in groups.items():
+            made = inodes[start:start + len(entries)]
+            error = self.open_directory(parent).add_files([(components[-1], inode.number) for (components, _), inode in zip(entries, made)])
+            if error < 0:
+                # directories updated so far keep their new files
+                for inode in inodes[start:]:
+                    self.release_inode(inode)
+                return error, []
+            for (components, _), inode in zip(entries, made):
+                self.dentries.put(self.join_path(components), inode.number)
+            start += len(entries)
+        return 0, deferred
+
     # Closes the file and removes dynamic resource table entry.
+    @traced
     def tfs_close(self, FD):
-        # Write updated INODE info to disk
-        f = self.file_table[FD]
-        data = {'block': f.inode.encode()}
-        ld.writeBlock(self.current_disk, f.inode.number, data)
-
-        # remove entry from file table, add file descriptor back to queue
-        if FD >=0 and FD < MAX_OPEN_FILES:
-            self.free_fds.appendleft(FD)
-            self.file_table[FD] = None
-        else:
-            # Invalid file descriptor
-            return -7
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        # Drop this descriptor's inode reference, the inode is written if it changed
+        with f.inode.lock.read(), self.lock:
+            self.release_fd(FD)
+            if isinstance(f, self.Directory) or f.inode.unlinked or self.file_cache <= 0:
+                self.put_inode(f.inode)
+            else:
+                self.cache_closed_file(f)
+        if self.journal is None:
+            self.cache.sync()
+        self.end_op()
 
     # Writes buffer ‘buffer’ of size ‘size’, which represents an entire file’s contents, 
     # to the file described by ‘FD’. Sets the file pointer to 0 (the start of file) when done. 
     # Returns success/error codes.
     # Caller must encode bytes
+    @traced
+    @group_commit
     def tfs_write(self, FD, buffer):
         # use file write() method
         data = buffer['bytes']
-        return self.file_table[FD].write(data, len(data))
-    
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        with f.inode.lock.write():
+            return f.write(data, len(data))
+
+    # Writes buffer['bytes'] into the file described by 'FD' starting at byte 'offset', only
+    # rewriting the blocks it covers. Writing past the end of the file grows it, and any gap
+    # reads back as zeros. The file pointer is left where it is. Returns success/error codes.
+    @traced
+    @group_commit
+    def tfs_pwrite(self, FD, offset, buffer):
+        if offset < 0:
+            return -6 # offset out of bounds
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        with f.inode.lock.write():
+            return f.pwrite(offset, buffer['bytes'])
+
+    # Writes buffer['bytes'] to the end of the file described by 'FD'. Only the last block
+    # and any new blocks are written. The file pointer is left where it is.
+    @traced
+    @group_commit
+    def tfs_append(self, FD, buffer):
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        with f.inode.lock.write():
+            return f.append(buffer['bytes'])
+
     # deletes a file and marks its blocks as free on disk.
+    # Directories can be deleted once they are empty. If the file is still open on
+    # other descriptors, its blocks are freed when the last of them is closed.
+    @traced
+    @group_commit
+    @locked
     def tfs_delete(self, FD):
-
-        # Remove from root dir table
-        root_dir = self.file_table[self.root_dir_fd][0]
-        # print(root_dir.files)
-        f = self.file_table[FD]
-        # print(f.name)
-
-        # print(self.free_block_table)
-
-        # Free file's inode
-        self.free([root_dir.files[f.name]])
-
-        del root_dir.files[f.name]
-
-        # print(root_dir.files)
-
-        # free blocks
-        self.free(f.inode.data_blocks)
-
-        # print(self.free_block_table)
-
-
-        # remove entry from file table, add file descriptor back to queue
-        if FD >=0 and FD < MAX_OPEN_FILES:
-            self.free_fds.appendleft(FD)
-            self.file_table[FD] = None
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        if isinstance(f, self.Directory):
+            if f.inode.number == self.root_inode:
+                return -14 # cannot delete the root directory
+            # already deleted through another descriptor (and maybe made again)
+            if f.inode.unlinked or self.directories.get(f.inode.number) is not f:
+                return -10 # no such file or directory
+            if f.num_files > 2:
+                return -12 # directory not empty
+            # Directories are shared and do not keep a path, find the entry through ".."
+            parent = self.open_directory(f.lookup(b".."))
+            name = next((name for name, inode in parent.entries() if inode == f.inode.number), None)
+            if name is None:
+                return -10 # no such file or directory
+            path = None
+            # drop the reference the directory object held
+            self.directories.pop(f.inode.number)
+            self.put_inode(f.inode)
         else:
-            # Invalid file descriptor
-            return -7
+            if f.inode.unlinked:
+                # already deleted through another descriptor, only drop this one
+                self.put_inode(f.inode)
+                self.release_fd(FD)
+                return
+            components, _ = self.split_path(f.name.decode('utf-8'))
+            parent_inode = self.resolve(components[:-1])
+            parent = self.open_directory(parent_inode) if parent_inode is not None else None
+            name = components[-1]
+            path = f.name
+            # the name may now belong to another file
+            if parent is None or parent.lookup(name) != f.inode.number:
+                return -10 # no such file or directory
+
+        parent.remove_file(name)
+        f.inode.unlinked = True
+        cached = self.closed_files.pop(f.inode.number, None)
+        if cached is not None:
+            self.put_inode(cached.inode)
+
+        if path is None:
+            self.dentries.clear()
+        else:
+            self.dentries.invalidate(path)
+
+        self.put_inode(f.inode)
+        self.release_fd(FD)
 
 
     # reads one byte from the file and copies it to ‘buffer’, using the current file pointer 
     # location and incrementing it by one upon success. If the file pointer is already at the 
     # end of the file then tfs_readByte() should return an error and not increment the file pointer.
+    @traced
     def tfs_readByte(self, FD, buffer):
-        return self.file_table[FD].readByte(buffer)
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        with f.inode.lock.read():
+            return f.readByte(buffer)
+
+    # Reads up to n bytes starting at the file pointer and returns them as bytes, advancing the
+    # file pointer the same way tfs_readByte() does. Returns fewer bytes if the end of the file
+    # is reached, and b"" if the file pointer is already there.
+    @traced
+    def tfs_read(self, FD, n):
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        with f.inode.lock.read():
+            return f.read(n)
+
+    # Like tfs_read(), but copies straight into the writable buffer 'view' (a memoryview, bytearray
+    # or array) instead of allocating. Returns the number of bytes copied.
+    @traced
+    def tfs_readinto(self, FD, view):
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        with f.inode.lock.read():
+            return f.readinto(view)
 
     # Change the file pointer location to offset (absolute). Returns success/error codes.
+    @traced
     def tfs_seek(self, FD, offset):
         # update file pointer in file_table
-        return self.file_table[FD].seek(offset)
+        f = self.fd_file(FD)
+        if f is None:
+            return -7 # bad file descriptor
+        with f.inode.lock.read():
+            return f.seek(offset)
+
+    # Writes many whole files at once. 'files' is a list of (path, bytes) pairs, and
+    # each ends up as if it was opened, written with tfs_write and closed; a path given
+    # twice gets its last contents. The new files are laid out together: one allocation
+    # covers all of them, their inode blocks first and then, in batch order, each file's
+    # pointer blocks (see Inode.map_blocks) followed by its data, so each lands
+    # contiguously, and the data and the inodes are each written in block order with one
+    # call. An extent file only needs overflow blocks, allocated apart, if that
+    # allocation came in pieces. Each parent directory gets all its new entries in one
+    # update, see Directory.add_files. Files that already exist, and new compressed
+    # files too big to be inline, go through tfs_write one by one afterwards. A file is
+    # compressed with 'compression' as for tfs_open.
+    # Returns 0, or an error code: -9, -10 or -11 for a bad path, in which case nothing
+    # is written, or -4, -8 or -15, in which case the batch may be partly written.
+    @traced
+    @group_commit
+    def tfs_bulk_write(self, files, compression=None):
+        if compression is not None and compression not in COMPRESSION_CODECS:
+            return -1
+        codec = COMPRESSION_CODECS[compression or self.compression]
+        contents = {} # path -> (components, data), in batch order
+        for name, data in files:
+            components, is_dir = self.split_path(name)
+            if components is None:
+                return -9 # name too long
+            if is_dir or not components:
+                return -11 # a directory, not a file
+            contents[self.join_path(components)] = (components, data)
+        with self.lock:
+            groups = {} # parent directory inode -> [(components, data)] of new files
+            rewrite = [] # paths of files written one by one
+            for path, (components, data) in contents.items():
+                inode = self.resolve(components)
+                if inode is not None:
+                    if self.open_directory(inode) is not None:
+                        return -11 # a directory, not a file
+                    rewrite.append(path)
+                    continue
+                parent = self.resolve(components[:-1])
+                if parent is None:
+                    return -10 # no such file or directory
+                if self.open_directory(parent) is None:
+                    return -11 # not a directory
+                groups.setdefault(parent, []).append((components, data))
+            error, deferred = self.bulk_create(groups, codec)
+            if error < 0:
+                return error
+        # compressed files created empty come after the files that were already there
+        for path in rewrite + deferred:
+            FD = self.tfs_open(path.decode('utf-8'), compression)
+            if FD < 0:
+                return FD
+            error = self.tfs_write(FD, {'bytes': contents[path][1]})
+            self.tfs_close(FD)
+            if error < 0:
+                return error
+        if self.journal is None:
+            self.cache.sync()
+        return 0
 
-    # Allocate a certain number of free blocks.
+    # Reads many whole files at once. Returns a list with, for each path in 'names', its
+    # contents as bytes, or an error code if it cannot be read (-9, -10, or -11 for a
+    # directory). The inode blocks of all of them are read in block order with one call,
+    # and then their data blocks in block order, BULK_READ_BLOCKS at a time, so files
+    # written by tfs_bulk_write come back in a few large reads. Compressed files are read
+    # through File.read. No descriptor is used and no file pointer moves.
+    @traced
+    def tfs_bulk_read(self, names):
+        results = [None] * len(names)
+        inodes = {} # index in names -> Inode
+        files = {} # index in names -> File, for compressed files
+        with self.lock:
+            numbers = {}
+            for i, name in enumerate(names):
+                components, _ = self.split_path(name)
+                if components is None:
+                    results[i] = -9 # name too long
+                    continue
+                inode = self.resolve(components)
+                if inode is None:
+                    results[i] = -10 # no such file or directory
+                    continue
+                numbers[i] = inode
+            unread = sorted(set(numbers.values()) - self.inodes.keys())
+            buffer = {}
+            if unread and self.cache.readBlockList(unread, buffer) < 0:
+                return [-1 if result is None else result for result in results]
+            blocks = {number: memoryview(buffer['block'])[j * BLOCKSIZE:(j + 1) * BLOCKSIZE] for j, number in enumerate(unread)}
+            for i, number in numbers.items():
+                inode = self.get_inode(number, contents=blocks.get(number))
+                if inode.filetype == 1:
+                    results[i] = -11 # a directory
+                    self.put_inode(inode)
+                    continue
+                inodes[i] = inode
+                if inode.codec and not inode.is_inline:
+                    files[i] = self.create_file(mode="block", block=number)
+        with ExitStack() as stack:
+            self.lock_inodes(stack, inodes.values())
+            pieces = [] # (data block, index in names, logical block)
+            for i, inode in inodes.items():
+                if inode.is_inline or inode.num_blocks == 0:
+                    results[i] = bytes(inode.inline[:inode.size])
+                elif i in files:
+                    results[i] = files[i].read(inode.size)
+                else:
+                    results[i] = bytearray(inode.num_blocks * BLOCKSIZE)
+                    pieces.extend((block, i, j) for j, block in enumerate(inode.data_blocks))
+            pieces.sort()
+            for start in range(0, len(pieces), BULK_READ_BLOCKS):
+                batch = pieces[start:start + BULK_READ_BLOCKS]
+                buffer = {}
+                if self.cache.readBlockList([block for block, _, _ in batch], buffer) < 0:
+                    for _, i, _ in batch:
+                        results[i] = -1 # disk error
+                    continue
+                data = memoryview(buffer['block'])
+                for k, (_, i, j) in enumerate(batch):
+                    if not isinstance(results[i], int):
+                        results[i][j * BLOCKSIZE:(j + 1) * BLOCKSIZE] = data[k * BLOCKSIZE:(k + 1) * BLOCKSIZE]
+            for i, inode in inodes.items():
+                if isinstance(results[i], bytearray):
+                    results[i] = bytes(memoryview(results[i])[:inode.size])
+            stack.enter_context(self.lock)
+            for i, inode in inodes.items():
+                if i in files:
+                    self.put_inode(files[i].inode)
+                self.put_inode(inode)
+        return results
+
+    # Write every change so far to disk without unmounting: inodes, the superblock and
+    # every dirty cached block, through the journal if there is one.
+    @traced
+    def tfs_sync(self):
+        return self.commit()
+
+    # Count one metadata operation, and commit if COMMIT_BATCH operations have piled
+    # up, COMMIT_INTERVAL has passed, or the pinned blocks would soon not fit in the
+    # journal. Must not be called holding the global lock, see commit.
+    # Without a journal this still makes a periodic tfs_sync.
+    def end_op(self):
+        with self.lock:
+            self.ops += 1
+            due = self.ops >= COMMIT_BATCH or time.monotonic() - self.last_commit >= COMMIT_INTERVAL
+            if self.journal is not None:
+                due = due or len(self.cache.pinned) >= self.journal.capacity // 2
+        if due:
+            self.commit()
+
+    # Group commit. Writes the inodes in use and the superblock, then file data, then
+    # logs every pinned metadata block in one journal transaction, writes them home
+    # and clears the journal. A transaction bigger than the journal is split into
+    # several, each atomic on its own. Without a journal this is a plain cache sync.
+    def commit(self):
+        with ExitStack() as stack:
+            # wait for writes in progress, inode locks come before the global lock
+            self.lock_inodes(stack, list(self.inodes.values()))
+            stack.enter_context(self.lock)
+            self.ops = 0
+            self.last_commit = time.monotonic()
+            for inode in self.inodes.values():
+                if not inode.unlinked:
+                    inode.write()
+            if self.pending_free:
+                self.bitmap.free(self.pending_free)
+                self.pending_free = []
+            self.write_superblock()
+            # ordered mode: file data is on disk before the metadata pointing at it
+            writebacks = self.cache.writebacks
+            error = self.cache.sync()
+            if self.journal is None:
+                return error
+            blocks = sorted(self.cache.pinned.items())
+            if not blocks and self.cache.writebacks > writebacks:
+                # only file data changed, it still has to be durable
+                return self.disk_lib.syncDisk(self.current_disk)
+            capacity = self.journal.capacity
+            for first in range(0, len(blocks), capacity):
+                transaction = blocks[first:first + capacity]
+                if self.journal.commit(transaction) < 0:
+                    return -1
+                self.cache.checkpoint([bNum for bNum, _ in transaction])
+                if self.disk_lib.syncDisk(self.current_disk) < 0:
+                    return -1
+                self.journal.clear()
+            return error
+
+    # Block cache counters: hits, misses, evictions, writebacks and coalesced reads,
+    # hits and misses of the decompressed chunk cache, and opens of regular files that
+    # found them in the closed file cache or not.
+    def tfs_cache_stats(self):
+        return dict(self.cache.stats(), **self.chunks.stats(), file_hits=self.file_hits, file_misses=self.file_misses)
+
+    # The tracer's per-call, disk I/O and allocator counters (see Tracer.report) along
+    # with the block cache counters and free blocks, or None without a tracer.
+    def tfs_stats(self):
+        if self.tracer is None:
+            return None
+        stats = self.tracer.report()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+            stats["free_blocks"] = self.bitmap.num_free
+        return stats
+
+    # Read the blocks in bNums into the block cache ahead of use. In thread-safe mode
+    # this is handed to the background prefetch thread and returns at once.
+    def prefetch(self, bNums):
+        if not self.threadsafe:
+            self.cache.prefetch(bNums)
+            return
+        with self.lock:
+            if self.prefetcher is None:
+                self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tinyfs-readahead")
+            self.prefetcher.submit(self.cache.prefetch, bNums)
+
+    # Disk library 'lib', reporting to the tracer if there is one
+    def traced_disk(self, lib):
+        return lib if self.tracer is None else self.tracer.wrap(lib)
+
+    # Write the superblock and the bitmap blocks it spills into.
+    # 1st byte of superblock is magic number
+    # bytes 1-4 are the root inode block number
+    # bytes 5-8 are the total number of blocks on the disk
+    # bytes 9-12 are the number of free blocks
+    # bytes 13-16 are the number of blocks the bitmap spills into, starting at BITMAP_START
+    # byte 17 is the inode format (see INODE_FORMATS) in the low 4 bits and the codec new
+    # files are compressed with (see COMPRESSION_CODECS) in the high 4 bits
+    # bytes 18-21 are the first journal block, bytes 22-25 the number of journal blocks (0 for none)
+    # remaining bytes are the start of the free block bitmap
+    # Only blocks holding changed bitmap bytes are written, along with the superblock for its
+    # free count, so the cost follows the number of allocations and frees, not the disk size.
+    # Nothing is written if the bitmap has not changed.
+    def write_superblock(self):
+        if self.block_bitmap is None or not self.block_bitmap.dirty:
+            return
+        bitmap = self.bitmap.bits
+        spill_blocks = math.ceil(max(0, len(bitmap) - SUPERBLOCK_BITMAP_BYTES) / BLOCKSIZE)
+        superblock_data = bytearray(BLOCKSIZE)
+        header = Superblock(MAGIC_NUMBER, ROOT_INODE, self.bitmap.num_blocks, self.bitmap.num_free, spill_blocks,
+                            INODE_FORMATS[self.inode_format] | COMPRESSION_CODECS[self.compression] << 4,
+                            self.journal_start, self.journal_blocks)
+        header.pack_into(superblock_data)
+        first_bytes = bitmap[:SUPERBLOCK_BITMAP_BYTES]
+        superblock_data[SUPERBLOCK_HEADER:SUPERBLOCK_HEADER + len(first_bytes)] = first_bytes
+        self.cache.writeBlock(SUPERBLOCK, {"block": superblock_data})
+        # Spill block i holds bitmap bytes from SUPERBLOCK_BITMAP_BYTES + i * BLOCKSIZE
+        changed = sorted({(byte - SUPERBLOCK_BITMAP_BYTES) // BLOCKSIZE for byte in self.bitmap.dirty if byte >= SUPERBLOCK_BITMAP_BYTES})
+        if changed:
+            spill = bytearray()
+            for i in changed:
+                start = SUPERBLOCK_BITMAP_BYTES + i * BLOCKSIZE
+                spill += self.pad(bitmap[start:start + BLOCKSIZE], BLOCKSIZE)
+            self.cache.writeBlockList([BITMAP_START + i for i in changed], {"block": spill})
+        self.bitmap.mark_clean()
+
+    # Allocate a certain number of free blocks, contiguous if possible.
     # Returns an array of the free block numbers, or None if not enough were found.
     def allocate(self, num_blocks):
-        i = 0
-        blocks = []
-        while i < len(self.free_block_table) and len(blocks) < num_blocks:
-            if self.free_block_table[i] == 0:
-                blocks.append(i + 2)
-            i += 1
-        for block in blocks:
-            self.free_block_table[block - 2] = 1
-        if len(blocks) == num_blocks:
+        with self.lock:
+            blocks = self.bitmap.allocate(num_blocks)
+            if blocks is None and self.pending_free:
+                # Out of space: give up on holding back freed blocks, see free()
+                self.bitmap.free(self.pending_free)
+                self.pending_free = []
+                blocks = self.bitmap.allocate(num_blocks)
+            if self.tracer is not None:
+                self.tracer.allocated(blocks)
             return blocks
-        return None
 
     # free a data block
+    # With a journal, freed blocks only go back to the bitmap at the next commit. Until
+    # then the free is not durable, and handing the block to another file whose data
+    # reaches the disk first would overwrite it under its committed owner.
     def free(self, block_nums):
-        for block in block_nums:
-            print(f"free {block}")
-            self.free_block_table[block - 2] = 0
+        if self.tracer is not None:
+            self.tracer.freed(len(block_nums))
+        with self.lock:
+            if self.journal is None:
+                self.bitmap.free(block_nums)
+            else:
+                self.pending_free.extend(block_nums)
+
+    # Give 'file' a free descriptor, growing the table if there is none. tfs_open checks
+    # max_open_files first.
+    def allocate_fd(self, file):
+        if self.free_fds:
+            fd = self.free_fds.popleft()
+        else:
+            fd = len(self.file_table)
+            self.file_table.append(None)
+        self.file_table[fd] = file
+        return fd
+
+    def release_fd(self, FD):
+        self.file_table[FD] = None
+        self.free_fds.appendleft(FD)
+
+    # The File (or Directory) open on descriptor 'FD', or None if it is not open
+    def fd_file(self, FD):
+        if not isinstance(FD, int) or FD < 0 or FD >= len(self.file_table):
+            return None
+        f = self.file_table[FD]
+        return f if isinstance(f, self.File) else None
+
+    # The File to open the regular file at inode block 'inode' through 'path' with: the
+    # one kept in closed_files along with its inode reference, or a new one
+    def reopen_file(self, inode, path):
+        file = self.closed_files.pop(inode, None)
+        if file is None:
+            self.file_misses += 1
+            return self.create_file(mode="block", block=inode, name=path)
+        self.file_hits += 1
+        file.name = path
+        file.position = 0
+        file.reset_readahead()
+        return file
+
+    # Keep closed regular file 'file' and its inode reference in closed_files, evicting
+    # the least recently closed one past file_cache
+    def cache_closed_file(self, file):
+        file.inode.write()
+        replaced = self.closed_files.pop(file.inode.number, None)
+        if replaced is not None:
+            self.put_inode(replaced.inode)
+        self.closed_files[file.inode.number] = file
+        while len(self.closed_files) > self.file_cache:
+            _, evicted = self.closed_files.popitem(last=False)
+            self.put_inode(evicted.inode)
+
+    # Take a reference on the inode at block 'block' through the inode table, reading it
+    # on first use, from 'contents' if the caller already has the block's bytes. With
+    # mode="new" a fresh inode of type 'filetype' is made there instead.
+    def get_inode(self, block, mode="block", filetype=0, contents=None):
+        if mode == "new" or block not in self.inodes:
+            inode = self.create_inode(mode=mode, block=block, filetype=filetype, contents=contents)
+            # a new inode has not been written yet
+            inode.dirty = mode == "new"
+            self.inodes[block] = inode
+        inode = self.inodes[block]
+        inode.refs += 1
+        return inode
+
+    # Drop a reference taken by get_inode. The last one writes the inode back if it
+    # changed, or frees it and its blocks if it was deleted in the meantime.
+    def put_inode(self, inode):
+        inode.refs -= 1
+        if inode.refs > 0:
+            return
+        if self.inodes.get(inode.number) is inode:
+            del self.inodes[inode.number]
+        if inode.unlinked:
+            self.release_inode(inode)
+        else:
+            inode.write()
+
+    # Free a deleted inode's data and pointer blocks and the inode block itself
+    def release_inode(self, inode):
+        self.chunks.drop(inode.number)
+        inode.truncate(0)
+        inode.dirty = False
+        self.free([inode.number])
+
+    # Take the read locks of 'inodes' into 'stack' (an ExitStack), once each and in
+    # inode block number order, the one order every holder of several inode locks
+    # uses so none of them can wait on each other in a cycle
+    def lock_inodes(self, stack, inodes):
+        for number, inode in sorted({inode.number: inode for inode in inodes}.items()):
+            stack.enter_context(inode.lock.read())
+
+    # Lock for the block cache, None when not thread-safe
+    def cache_lock(self):
+        return threading.Lock() if self.threadsafe else None
+
+    # Reader/writer lock for an inode's data
+    def inode_lock(self):
+        return RWLock() if self.threadsafe else NoLock()
+
+    # Inode class of the format the mounted filesystem was made with
+    def inode_class(self):
+        return self.ExtentInode if self.inode_format == "extent" else self.Inode
+
+    def create_inode(self, mode="new", block=None, filetype=0, contents=None):
+        return self.inode_class()(self, mode, filetype, block, contents)
 
     def create_file(self, mode="new", block=None, name=None):
         return self.File(self, mode, block, name)
@@ -321,6 +1271,15 @@ class tinyFS:
     def create_directory(self, mode="new", block=None, parent=ROOT_INODE):
         return self.Directory(self, mode, block, parent)
 
+    # Block numbers packed as BLOCK_NUMBER_SIZE byte little endian ints
+    def encode_pointers(self, block_nums):
+        data = bytearray(len(block_nums) * BLOCK_NUMBER_SIZE)
+        pack_pointers(data, 0, block_nums)
+        return data
+
+    def decode_pointers(self, data):
+        return unpack_pointers(data, 0, len(data) // BLOCK_NUMBER_SIZE)
+
     # pad bytes to ensure it is aligned to a certain size
     def pad(self, bytes, align):
         padding = b""
@@ -329,88 +1288,722 @@ class tinyFS:
         return bytes + padding
 
     class Inode:
+        """
+        INODE STRUCTURE
+        8 bytes: file size
+        1 byte: file type, 0 for regular file, 1 for directory, in the low 4 bits, and
+                the codec a regular file is compressed with in the high 4 bits
+        4 bytes: number of data blocks
+        The rest of the block maps the file's data blocks. This class is the
+        "indirect" inode format, see ExtentInode for the "extent" one:
+        NUM_DIRECT_BLOCKS * 4 bytes: direct block numbers
+        last 12 bytes: single, double and triple indirect block numbers, 0 if unused
+
+        An indirect block is a pointer block holding POINTERS_PER_BLOCK block numbers.
+        A single indirect block points at data blocks, a double indirect block points
+        at single indirect blocks, and so on. Logical block i of the file is found with
+        at most INDIRECT_LEVELS pointer block reads, and those reads are cached in
+        pointer_cache for as long as this Inode (and the File that owns it) is open.
+
+        INLINE DATA
+        A regular file of at most INLINE_SIZE bytes keeps its contents in the inode
+        block itself, in the bytes from INLINE_START that the block map of a file with
+        no data blocks leaves unused. Such a file has a size but 0 data blocks, which
+        no file with data blocks can have, so nothing else marks it. It costs one
+        block and one read instead of two. File.pwrite moves the data out to a data
+        block when the file grows past INLINE_SIZE, and back in when File.write
+        replaces it with something small enough.
+        """
+
+        MAX_BLOCKS = MAX_FILE_BLOCKS
+        INLINE_START = INODE_HEADER
+        INLINE_SIZE = INDIRECT_START - INODE_HEADER
 
-        def __init__(self, filesystem, mode="new", filetype = 0, block=None):
+        def __init__(self, filesystem, mode="new", filetype = 0, block=None, contents=None):
             self.fs = filesystem
             self.number = block
+            # pointer block number -> list of the block numbers stored in it
+            self.pointer_cache = {}
+            # blocks set aside for new pointer blocks, used before allocating, see map_blocks
+            self.spare = []
+            # In-core state, see tinyFS.get_inode: open references, whether the inode
+            # differs from its block on disk, and whether it was deleted while still open
+            self.refs = 0
+            self.dirty = False
+            self.unlinked = False
+            self.lock = self.fs.inode_lock()
             if mode == "block" and block is not None: # initialize using preexisting block
-                data = {}
-                ld.readBlock(self.fs.current_disk, block, data)
-                bytes = bytearray(data['block'])
-                self.size = int.from_bytes(bytes[:2], byteorder="little")
-                self.filetype = bytes[2] # 0 for regular file, 1 for directory
-                self.num_blocks = bytes[3]
-                self.data_blocks = list(bytes[4:4 + self.num_blocks]) # for now, just direct blocks
+                bytes = contents
+                if bytes is None:
+                    data = {}
+                    self.fs.cache.readBlock(block, data)
+                    bytes = data['block']
+                # filetype is 0 for a regular file, 1 for a directory
+                self.size, filetype, self.num_blocks = INODE_LAYOUT.unpack_from(bytes)
+                self.filetype = filetype & 0x0F
+                self.codec = filetype >> 4
+                self.decode_map(bytes)
+                self.inline = bytearray()
+                if self.is_inline:
+                    self.inline = bytearray(bytes[self.INLINE_START:self.INLINE_START + self.size])
             elif mode == "new": # create new Inode
                 self.size = 0
                 self.filetype = filetype
+                self.codec = 0 # see COMPRESSION_CODECS
                 self.num_blocks = 0
-                self.data_blocks = []
+                self.decode_map(None)
+                self.inline = bytearray()
             else: # wrong format
                 raise ValueError(f"unknown mode type {mode}")
 
         def encode(self):
-            # Give size 2 bytes
-            file_size = array("H", [self.size])
-            file_size = bytearray(file_size)
+            data = bytearray(BLOCKSIZE)
+            INODE_LAYOUT.pack_into(data, 0, self.size, self.filetype | self.codec << 4, self.num_blocks)
+            self.encode_map(data)
+            if self.is_inline:
+                data[self.INLINE_START:self.INLINE_START + self.size] = self.inline[:self.size]
+            return data
+
+        # Whether the file's contents are in 'inline' instead of data blocks
+        @property
+        def is_inline(self):
+            return self.num_blocks == 0 and self.size > 0
+
+        # Write the inode to its block if it has changed since it was read or last written
+        def write(self):
+            if self.dirty:
+                self.fs.cache.writeBlock(self.number, {'block': self.encode()})
+                self.dirty = False
+
+        # Load the block mapping from the inode block 'bytes', or start an empty one if None
+        def decode_map(self, bytes):
+            if bytes is None:
+                self.direct = []
+                self.indirect = [0] * INDIRECT_LEVELS
+                return
+            self.direct = unpack_pointers(bytes, INODE_HEADER, min(self.num_blocks, NUM_DIRECT_BLOCKS))
+            self.indirect = unpack_pointers(bytes, INDIRECT_START, INDIRECT_LEVELS)
+
+        # Store the block mapping into the inode block 'data'
+        def encode_map(self, data):
+            pack_pointers(data, INODE_HEADER, self.direct)
+            pack_pointers(data, INDIRECT_START, self.indirect)
+
+        # Block numbers stored in pointer block 'block'
+        def pointers(self, block):
+            if block not in self.pointer_cache:
+                data = {}
+                self.fs.cache.readBlock(block, data)
+                self.pointer_cache[block] = unpack_pointers(data['block'], 0, POINTERS_PER_BLOCK)
+            return self.pointer_cache[block]
+
+        def set_pointer(self, block, index, value):
+            pointers = self.pointers(block)
+            pointers[index] = value
+            self.fs.cache.writeBlock(block, {'block': self.fs.encode_pointers(pointers)})
+
+        # Number of pointer blocks a file of 'num_blocks' data blocks maps them with,
+        # so tinyFS.bulk_create can lay them out along with the data (see spare)
+        @classmethod
+        def map_blocks(cls, num_blocks):
+            count = 0
+            index = num_blocks - NUM_DIRECT_BLOCKS
+            for level in range(INDIRECT_LEVELS):
+                if index <= 0:
+                    break
+                mapped = min(index, POINTERS_PER_BLOCK ** (level + 1))
+                # one pointer block per POINTERS_PER_BLOCK ** depth blocks at each depth
+                count += sum(math.ceil(mapped / POINTERS_PER_BLOCK ** depth) for depth in range(1, level + 2))
+                index -= mapped
+            return count
+
+        # A block for a new pointer block, a spare one first, as a one element list
+        # like fs.allocate, or None if there is no space
+        def allocate_pointer_block(self):
+            if self.spare:
+                return [self.spare.pop(0)]
+            return self.fs.allocate(1)
+
+        # Which indirect level logical block 'index' is under, and its index within that level
+        def locate(self, index):
+            index -= NUM_DIRECT_BLOCKS
+            for level in range(INDIRECT_LEVELS):
+                span = POINTERS_PER_BLOCK ** (level + 1)
+                if index < span:
+                    return level, index
+                index -= span
+            raise IndexError(f"block {index} is past the largest file size")
+
+        # Absolute block number of logical block 'index' of the file, 0 if it is not mapped
+        def block_at(self, index):
+            if index < NUM_DIRECT_BLOCKS:
+                return self.direct[index] if index < len(self.direct) else 0
+            level, index = self.locate(index)
+            block = self.indirect[level]
+            for depth in range(level, -1, -1):
+                if block == 0:
+                    return 0
+                block = self.pointers(block)[(index // POINTERS_PER_BLOCK ** depth) % POINTERS_PER_BLOCK]
+            return block
+
+        # Map logical block 'index' of the file to absolute block 'value', allocating any
+        # pointer blocks on the way. Returns -4 if there is no space for them.
+        def set_block(self, index, value):
+            if index < NUM_DIRECT_BLOCKS:
+                if index >= len(self.direct):
+                    self.direct.extend([0] * (index + 1 - len(self.direct)))
+                self.direct[index] = value
+                return 0
+            level, index = self.locate(index)
+            if self.indirect[level] == 0:
+                new_block = self.allocate_pointer_block()
+                if new_block is None:
+                    return -4 # no space
+                self.indirect[level] = new_block[0]
+                self.pointer_cache[new_block[0]] = [0] * POINTERS_PER_BLOCK
+                self.fs.cache.writeBlock(new_block[0], {'block': bytes(BLOCKSIZE)})
+            block = self.indirect[level]
+            for depth in range(level, 0, -1):
+                slot = (index // POINTERS_PER_BLOCK ** depth) % POINTERS_PER_BLOCK
+                child = self.pointers(block)[slot]
+                if child == 0:
+                    new_block = self.allocate_pointer_block()
+                    if new_block is None:
+                        return -4 # no space
+                    child = new_block[0]
+                    self.pointer_cache[child] = [0] * POINTERS_PER_BLOCK
+                    self.fs.cache.writeBlock(child, {'block': bytes(BLOCKSIZE)})
+                    self.set_pointer(block, slot, child)
+                block = child
+            self.set_pointer(block, index % POINTERS_PER_BLOCK, value)
+            return 0
+
+        # Shrink the file to its first 'num_blocks' blocks, freeing the data blocks past
+        # that and any pointer blocks that no longer map anything.
+        def truncate(self, num_blocks):
+            freed = []
+            if num_blocks < len(self.direct):
+                freed.extend(block for block in self.direct[num_blocks:] if block != 0)
+                self.direct = self.direct[:num_blocks]
+            base = NUM_DIRECT_BLOCKS
+            for level in range(INDIRECT_LEVELS):
+                span = POINTERS_PER_BLOCK ** (level + 1)
+                if self.indirect[level] != 0 and base + span > num_blocks:
+                    self.truncate_pointers(self.indirect[level], level, base, num_blocks, freed)
+                    if base >= num_blocks:
+                        freed.append(self.indirect[level])
+                        self.pointer_cache.pop(self.indirect[level], None)
+                        self.indirect[level] = 0
+                base += span
+            self.fs.free(freed)
+            self.num_blocks = min(self.num_blocks, num_blocks)
+            self.dirty = True
+
+        # Clear the entries of pointer block 'block' that map logical blocks >= 'keep'.
+        # 'depth' is 0 for a block that points at data blocks, and 'base' is the first
+        # logical block it maps. Freed block numbers are added to 'freed'.
+        def truncate_pointers(self, block, depth, base, keep, freed):
+            span = POINTERS_PER_BLOCK ** depth
+            pointers = self.pointers(block)
+            changed = False
+            for slot, child in enumerate(pointers):
+                child_base = base + slot * span
+                if child == 0 or child_base + span <= keep:
+                    continue
+                if depth > 0:
+                    self.truncate_pointers(child, depth - 1, child_base, keep, freed)
+                if child_base >= keep:
+                    freed.append(child)
+                    self.pointer_cache.pop(child, None)
+                    pointers[slot] = 0
+                    changed = True
+            if changed and base < keep:
+                self.fs.cache.writeBlock(block, {'block': self.fs.encode_pointers(pointers)})
+
+        # Contiguous runs of absolute blocks backing logical blocks [first, first + count),
+        # as (start block, length) pairs in file order. Adjacent blocks are merged so
+        # each run can be read or written with one multi-block call.
+        def runs(self, first, count):
+            runs = []
+            for i in range(first, first + count):
+                block = self.block_at(i)
+                if runs and block != 0 and runs[-1][0] + runs[-1][1] == block:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([block, 1])
+            return [tuple(run) for run in runs]
+
+        # Absolute block numbers of logical blocks [first, first + count), in file order
+        def block_list(self, first, count):
+            return [start + i if start != 0 else 0 for start, length in self.runs(first, count) for i in range(length)]
 
-            # Everything else gets 1 byte
-            data1 = [self.filetype, self.num_blocks] + self.data_blocks
-            data = array('B', data1)
-            return file_size + bytearray(data)
+        # Block numbers of every data block, in file order
+        @property
+        def data_blocks(self):
+            return self.block_list(0, self.num_blocks)
 
         def __str__(self):
             return f"Inode(Size: {self.size}, Filetype: {self.filetype}, # Blocks: {self.num_blocks}, Blocks: {self.data_blocks})"
 
 
+    class ExtentInode(Inode):
+        """
+        EXTENT INODE STRUCTURE
+        Same header as Inode, but the data blocks are mapped as extents: runs of
+        contiguous blocks stored as (start block, length) pairs, so a file written
+        into one contiguous allocation needs a single 8 byte extent.
+        4 bytes: number of extents
+        4 bytes: first overflow extent block, 0 if unused
+        INODE_EXTENTS * 8 bytes: extents
+        Extents that do not fit in the inode continue in a chain of overflow blocks,
+        each holding the next overflow block number followed by EXTENTS_PER_BLOCK
+        extents. A start block of 0 is a hole.
+
+        All extents are loaded when the inode is, along with the first logical block
+        of each, so block_at is a binary search.
+        """
+
+        MAX_BLOCKS = 2 ** (8 * BLOCK_NUMBER_SIZE) - 1
+        INLINE_START = EXTENT_START
+        INLINE_SIZE = BLOCKSIZE - EXTENT_START
+
+        def decode_map(self, bytes):
+            self.overflow = [] # overflow extent block numbers, in chain order
+            self.extents = [] # [start block, length] pairs in file order
+            self.logical = [] # first logical block of each extent
+            if bytes is None:
+                return
+            num_extents, next_block = EXTENT_HEADER_LAYOUT.unpack_from(bytes, INODE_HEADER)
+            self.decode_extents(bytes, EXTENT_START, min(num_extents, INODE_EXTENTS))
+            while next_block != 0 and len(self.extents) < num_extents:
+                self.overflow.append(next_block)
+                data = {}
+                self.fs.cache.readBlock(next_block, data)
+                block = data['block']
+                next_block = unpack_pointers(block, 0, 1)[0]
+                self.decode_extents(block, BLOCK_NUMBER_SIZE, min(num_extents - len(self.extents), EXTENTS_PER_BLOCK))
+
+        # Load 'count' extents stored at byte 'offset' of 'data'
+        def decode_extents(self, data, offset, count):
+            pointers = unpack_pointers(data, offset, count * 2)
+            for i in range(0, len(pointers), 2):
+                self.logical.append(self.logical[-1] + self.extents[-1][1] if self.extents else 0)
+                self.extents.append([pointers[i], pointers[i + 1]])
+
+        # Writes the overflow blocks too, they are only allocated by set_block
+        def encode_map(self, data):
+            values = [value for extent in self.extents for value in extent]
+            EXTENT_HEADER_LAYOUT.pack_into(data, INODE_HEADER, len(self.extents), self.overflow[0] if self.overflow else 0)
+            pack_pointers(data, EXTENT_START, values[:INODE_EXTENTS * 2])
+            for i, block in enumerate(self.overflow):
+                start = (INODE_EXTENTS + i * EXTENTS_PER_BLOCK) * 2
+                next_block = self.overflow[i + 1] if i + 1 < len(self.overflow) else 0
+                block_data = bytearray(BLOCKSIZE)
+                pack_pointers(block_data, 0, [next_block] + values[start:start + EXTENTS_PER_BLOCK * 2])
+                self.fs.cache.writeBlock(block, {'block': block_data})
+
+        # Index of the extent holding logical block 'index', or None
+        def find_extent(self, index):
+            i = bisect_right(self.logical, index) - 1
+            if i < 0 or index >= self.logical[i] + self.extents[i][1]:
+                return None
+            return i
+
+        def block_at(self, index):
+            i = self.find_extent(index)
+            if i is None or self.extents[i][0] == 0:
+                return 0
+            return self.extents[i][0] + index - self.logical[i]
+
+        # A file's contiguous data blocks take one extent, which fits in the inode
+        @classmethod
+        def map_blocks(cls, num_blocks):
+            return 0
+
+        # Number of overflow blocks needed to hold 'num_extents' extents
+        def overflow_needed(self, num_extents):
+            return math.ceil(max(0, num_extents - INODE_EXTENTS) / EXTENTS_PER_BLOCK)
+
+        def set_block(self, index, value):
+            mapped = self.logical[-1] + self.extents[-1][1] if self.extents else 0
+            if index == mapped and self.extents:
+                last = self.extents[-1]
+                # Appending the block right after the last extent (or another hole after a hole)
+                if (value != 0 and last[0] != 0 and last[0] + last[1] == value) or (value == 0 and last[0] == 0):
+                    last[1] += 1
+                    return 0
+            if index == mapped:
+                if self.overflow_needed(len(self.extents) + 1) > len(self.overflow):
+                    new_block = self.fs.allocate(1)
+                    if new_block is None:
+                        return -4 # no space
+                    self.overflow.extend(new_block)
+                self.logical.append(mapped)
+                self.extents.append([value, 1])
+                return 0
+            if index > mapped:
+                extents = self.extents + [[0, index - mapped], [value, 1]]
+            else:
+                # Remapping a block inside the file: split its extent around it
+                i = self.find_extent(index)
+                start, length = self.extents[i]
+                offset = index - self.logical[i]
+                pieces = []
+                if offset > 0:
+                    pieces.append([start, offset])
+                pieces.append([value, 1])
+                if offset + 1 < length:
+                    pieces.append([start + offset + 1 if start != 0 else 0, length - offset - 1])
+                extents = self.extents[:i] + pieces + self.extents[i + 1:]
+            return self.set_extents(extents)
+
+        # Replace the extent list, merging neighbours and growing or shrinking the overflow chain
+        def set_extents(self, extents):
+            merged = []
+            for start, length in extents:
+                if length == 0:
+                    continue
+                if merged and ((start == 0 and merged[-1][0] == 0) or (start != 0 and merged[-1][0] != 0 and merged[-1][0] + merged[-1][1] == start)):
+                    merged[-1][1] += length
+                else:
+                    merged.append([start, length])
+            needed = self.overflow_needed(len(merged))
+            if needed > len(self.overflow):
+                new_blocks = self.fs.allocate(needed - len(self.overflow))
+                if new_blocks is None:
+                    return -4 # no space
+                self.overflow.extend(new_blocks)
+            elif needed < len(self.overflow):
+                self.fs.free(self.overflow[needed:])
+                self.overflow = self.overflow[:needed]
+            self.extents = merged
+            self.logical = []
+            total = 0
+            for start, length in merged:
+                self.logical.append(total)
+                total += length
+            return 0
+
+        def truncate(self, num_blocks):
+            freed = []
+            kept = []
+            for (start, length), first in zip(self.extents, self.logical):
+                keep = max(0, min(length, num_blocks - first))
+                if start != 0:
+                    freed.extend(range(start + keep, start + length))
+                if keep > 0:
+                    kept.append([start, keep])
+            self.fs.free(freed)
+            # Shrinking never needs new overflow blocks, so this cannot fail
+            self.set_extents(kept)
+            self.num_blocks = min(self.num_blocks, num_blocks)
+            self.dirty = True
+
+        def runs(self, first, count):
+            runs = []
+            i = self.find_extent(first)
+            index = first
+            while i is not None and i < len(self.extents) and index < first + count:
+                start, length = self.extents[i]
+                offset = index - self.logical[i]
+                run_length = min(length - offset, first + count - index)
+                runs.append((start + offset if start != 0 else 0, run_length))
+                index += run_length
+                i += 1
+            return runs
+
+        def __str__(self):
+            return f"ExtentInode(Size: {self.size}, Filetype: {self.filetype}, # Blocks: {self.num_blocks}, Extents: {self.extents})"
+
+
     class File:
         def __init__(self, filesystem, mode="new", block=None, name=None):
             self.fs = filesystem
             if mode == "block" and block is not None:
-                self.inode = self.fs.Inode(self.fs, mode="block", block=block)
+                self.inode = self.fs.get_inode(block)
             elif mode == "new":
-                self.inode = self.fs.Inode(self.fs, mode="new", block=block, filetype=0)
+                self.inode = self.fs.get_inode(block, mode="new", filetype=0)
             # Acts as a file pointer. Points to a byte within the file.
             self.position = 0
             self.name = name
+            self.reset_readahead()
+
+        """
+        READ-AHEAD
+        Each open file watches its own reads. A read that starts in the block the
+        last one ended in, or the one after it, is sequential: the window doubles
+        (from READAHEAD_MIN_BLOCKS up to fs.readahead_blocks) and the next 'window'
+        blocks past the read are prefetched into the block cache in one go. A read
+        anywhere else, like after a tfs_seek to a random spot, drops the window to
+        0 and nothing is prefetched until reads look sequential again. A new
+        prefetch is only issued once the reader is within half a window of the end
+        of the last one, so a scan keeps one window ahead with few, large reads.
+        """
+
+        def reset_readahead(self):
+            self.last_block = -1 # last logical block the previous read touched
+            self.readahead_window = 0
+            self.readahead_end = 0 # logical block read-ahead has been issued up to
+
+        # Note a read of logical blocks first..last (inclusive) and read ahead if the
+        # reads so far are sequential
+        def readahead(self, first, last):
+            if first == self.last_block and last == first:
+                return # still in the same block, e.g. readByte
+            sequential = first == self.last_block or first == self.last_block + 1
+            self.last_block = last
+            if not sequential:
+                self.readahead_window = 0
+                self.readahead_end = 0
+                return
+            limit = self.fs.readahead_blocks
+            if limit <= 0:
+                return
+            self.readahead_window = min(max(2 * self.readahead_window, READAHEAD_MIN_BLOCKS), limit)
+            if self.readahead_end - (last + 1) > self.readahead_window // 2:
+                return # still far enough ahead
+            start = max(last + 1, self.readahead_end)
+            end = min(last + 1 + self.readahead_window, self.inode.num_blocks)
+            if start >= end:
+                return
+            self.readahead_end = end
+            self.fs.prefetch([block for block in self.inode.block_list(start, end - start) if block != 0])
         
+        # Overwrite the entire file with the first 'size' bytes of 'bytes'.
         def write(self, bytes, size):
-            # ensure bytes are aligned to blocksize
-            bytes = self.fs.pad(bytes, BLOCKSIZE)
+            error = self.pwrite(0, bytes[:size], truncate=True)
+            if error < 0:
+                return error
+            # Set fp to 0
+            self.position = 0
+            return 0
+
+        # Write 'data' at byte 'offset', touching only the blocks in that range.
+        # Writing past the end grows the file, zero filling any gap. With truncate
+        # the file ends where the data ends and blocks past that are freed.
+        # Does not move the file pointer. Writing no bytes changes nothing, unless
+        # truncating.
+        def pwrite(self, offset, data, truncate=False):
+            if not data and not truncate:
+                return 0
+            old_size = self.inode.size
+            end = offset + len(data)
+            size = end if truncate else max(old_size, end)
+            if self.inode.filetype == 0 and size <= self.inode.INLINE_SIZE and (self.inode.num_blocks == 0 or (truncate and offset == 0)):
+                return self.pwrite_inline(offset, data, size)
+            if self.inode.is_inline:
+                # moving out of the inode: rewrite the inline bytes along with 'data'
+                inline = self.inode.inline
+                contents = inline[:old_size] + bytes(max(0, offset - old_size))
+                contents[offset:end] = data
+                if truncate:
+                    contents = contents[:end]
+                self.inode.size = 0
+                self.inode.inline = bytearray()
+                error = self.pwrite(0, contents, truncate)
+                if error < 0:
+                    self.inode.size = old_size
+                    self.inode.inline = inline
+                return error
+            if self.inode.codec:
+                return self.pwrite_compressed(offset, data, truncate)
             num_blocks = math.ceil(size / BLOCKSIZE)
-            if num_blocks > self.inode.num_blocks:
-                new_blocks = self.fs.allocate(num_blocks - self.inode.num_blocks)
-                if new_blocks:
-                    self.inode.data_blocks = self.inode.data_blocks + new_blocks
-                else:
+            if num_blocks > self.inode.MAX_BLOCKS:
+                return -8 # file too large
+            old_blocks = self.inode.num_blocks
+            if num_blocks > old_blocks:
+                new_blocks = self.fs.allocate(num_blocks - old_blocks)
+                if new_blocks is None:
                     return -4 # no space
-            i = 0
-            while i < num_blocks:
-                start = i * BLOCKSIZE
-                end = (i + 1) * BLOCKSIZE
+                for i, block in enumerate(new_blocks):
+                    if self.inode.set_block(old_blocks + i, block) < 0:
+                        # out of space for pointer blocks, undo the allocation
+                        self.fs.free(new_blocks[i:])
+                        self.inode.num_blocks = old_blocks + i
+                        self.inode.truncate(old_blocks)
+                        return -4 # no space
+                self.inode.num_blocks = num_blocks
+                self.inode.dirty = True
+
+            # Blocks from the old end of file on are written as well so the gap
+            # between the old end and 'offset' reads back as zeros.
+            first = min(offset, old_size) // BLOCKSIZE
+            last = math.ceil(end / BLOCKSIZE)
+            block_nums = self.inode.block_list(first, last - first)
+            blocks = bytearray((last - first) * BLOCKSIZE)
+            # Blocks that keep part of their old contents, and where that part ends
+            keep = {}
+            for i in range(first, last):
+                block_start = i * BLOCKSIZE
+                keep_end = min(block_start + BLOCKSIZE, old_size, size)
+                if i < old_blocks and (block_start < min(offset, keep_end) or end < keep_end):
+                    keep[i] = keep_end - block_start
+            if keep:
                 buffer = {}
-                buffer['block'] = bytes[start:end]
-                ld.writeBlock(self.fs.current_disk, self.inode.data_blocks[i], buffer)
-                i += 1
+                self.fs.cache.readBlockList([block_nums[i - first] for i in keep], buffer)
+                for j, (i, length) in enumerate(keep.items()):
+                    start = (i - first) * BLOCKSIZE
+                    blocks[start:start + length] = buffer['block'][j * BLOCKSIZE:j * BLOCKSIZE + length]
+            base = first * BLOCKSIZE
+            blocks[offset - base:end - base] = data
+            # a directory's blocks are metadata and go through the journal, file data does not
+            self.fs.cache.writeBlockList(block_nums, {'block': blocks}, journal=self.inode.filetype == 1)
+
             # if extra space, free unused blocks
-            self.fs.free(self.inode.data_blocks[i:])
-            self.inode.data_blocks = self.inode.data_blocks[:i]
+            if truncate:
+                self.inode.truncate(num_blocks)
+            if size != old_size:
+                self.inode.size = size
+                self.inode.dirty = True
+            return 0
+
+        # pwrite for a file whose new 'size' fits in the inode. Data blocks it had are
+        # freed, File.write only moves a file back inline when it replaces all of it.
+        def pwrite_inline(self, offset, data, size):
+            inline = self.inode.inline if self.inode.is_inline else bytearray()
+            inline = inline[:size] + bytes(max(0, size - len(inline)))
+            inline[offset:offset + len(data)] = data
+            if self.inode.num_blocks > 0:
+                self.fs.chunks.drop(self.inode.number)
+                self.inode.truncate(0)
+            self.inode.inline = inline
             self.inode.size = size
-            self.inode.num_blocks = i
-            # Set fp to 0
-            self.position = 0
+            self.inode.dirty = True
             return 0
 
+        """
+        COMPRESSED FILES
+        A regular file with a codec (see COMPRESSION_CODECS) is stored in chunks of
+        CHUNK_SIZE bytes, each compressed on its own, so reading any byte only reads
+        and decompresses the chunk holding it. Chunk c owns logical blocks
+        c * COMPRESSED_CHUNK_BLOCKS up to the next chunk's: its compressed form (see
+        libCompress.encode_chunk) fills the first of them and the rest are holes,
+        with no data block behind them. A chunk that does not compress by at least a
+        block is stored as is, in all of them. A chunk of zeros is all holes, so gaps
+        in a sparse file take no space. Writing rewrites each chunk it touches whole.
+        Decompressed chunks are kept in fs.chunks, and sequential reads are served
+        from there instead of block read-ahead.
+        """
+
+        # pwrite for a compressed file
+        def pwrite_compressed(self, offset, data, truncate):
+            old_size = self.inode.size
+            end = offset + len(data)
+            size = end if truncate else max(old_size, end)
+            num_chunks = math.ceil(size / CHUNK_SIZE)
+            if num_chunks * COMPRESSED_CHUNK_BLOCKS > self.inode.MAX_BLOCKS:
+                return -8 # file too large
+            # Chunks past the old end are holes and the old last chunk is zero past
+            # old_size, so a gap between them and 'offset' reads back as zeros already.
+            view = memoryview(data)
+            for c in range(offset // CHUNK_SIZE, math.ceil(end / CHUNK_SIZE)):
+                start = c * CHUNK_SIZE
+                if start >= old_size or (offset <= start and end >= start + CHUNK_SIZE):
+                    raw = bytearray(CHUNK_SIZE) # nothing to keep
+                else:
+                    raw = bytearray(self.chunk(c))
+                low = max(offset, start)
+                high = min(end, start + CHUNK_SIZE)
+                raw[low - start:high - start] = view[low - offset:high - offset]
+                if size < start + CHUNK_SIZE:
+                    raw[size - start:] = bytes(start + CHUNK_SIZE - size)
+                error = self.store_chunk(c, raw, min(CHUNK_SIZE, size - start))
+                if error < 0:
+                    return error
+            if truncate and num_chunks * COMPRESSED_CHUNK_BLOCKS < self.inode.num_blocks:
+                self.fs.chunks.drop(self.inode.number, num_chunks)
+                self.inode.truncate(num_chunks * COMPRESSED_CHUNK_BLOCKS)
+            self.inode.num_blocks = max(self.inode.num_blocks, num_chunks * COMPRESSED_CHUNK_BLOCKS)
+            if size != old_size:
+                self.inode.size = size
+            self.inode.dirty = True
+            return 0
+
+        # Compress chunk 'c' from its first 'length' bytes in 'raw' (zero past that) and
+        # store it, reusing the blocks it had and freeing or allocating the difference
+        def store_chunk(self, c, raw, length):
+            slot = c * COMPRESSED_CHUNK_BLOCKS
+            old = self.chunk_blocks(c)
+            old_blocks = [block for block in old if block != 0]
+            if raw == ZERO_CHUNK:
+                stored = b""
+            else:
+                stored = encode_chunk(self.inode.codec, raw[:length], CHUNK_SIZE - BLOCKSIZE)
+                if stored is None:
+                    stored = raw
+            count = math.ceil(len(stored) / BLOCKSIZE)
+            if count > len(old_blocks):
+                new_blocks = self.fs.allocate(count - len(old_blocks))
+                if new_blocks is None:
+                    return -4 # no space
+                blocks = old_blocks + new_blocks
+            else:
+                blocks = old_blocks[:count]
+                if count < len(old_blocks):
+                    self.fs.free(old_blocks[count:])
+            for i in range(COMPRESSED_CHUNK_BLOCKS):
+                block = blocks[i] if i < count else 0
+                if block != old[i] and (block != 0 or slot + i < self.inode.num_blocks):
+                    if self.inode.set_block(slot + i, block) < 0:
+                        return -4 # out of space for pointer blocks
+            self.inode.num_blocks = max(self.inode.num_blocks, slot + count)
+            self.inode.dirty = True
+            if count:
+                self.fs.cache.writeBlockList(blocks, {'block': self.fs.pad(stored, BLOCKSIZE)}, journal=False)
+            self.fs.chunks.put((self.inode.number, c), bytes(raw))
+            return 0
+
+        # Block numbers of chunk 'c', 0 for holes
+        def chunk_blocks(self, c):
+            slot = c * COMPRESSED_CHUNK_BLOCKS
+            if slot >= self.inode.num_blocks:
+                return [0] * COMPRESSED_CHUNK_BLOCKS
+            blocks = self.inode.block_list(slot, min(COMPRESSED_CHUNK_BLOCKS, self.inode.num_blocks - slot))
+            return blocks + [0] * (COMPRESSED_CHUNK_BLOCKS - len(blocks))
+
+        # The CHUNK_SIZE bytes of chunk 'c', read with one disk call and decompressed
+        # unless fs.chunks has them
+        def chunk(self, c):
+            key = (self.inode.number, c)
+            raw = self.fs.chunks.get(key)
+            if raw is None:
+                blocks = [block for block in self.chunk_blocks(c) if block != 0]
+                if not blocks:
+                    raw = ZERO_CHUNK
+                else:
+                    buffer = {}
+                    self.fs.cache.readBlockList(blocks, buffer)
+                    if len(blocks) == COMPRESSED_CHUNK_BLOCKS:
+                        raw = bytes(buffer['block']) # stored uncompressed
+                    else:
+                        raw = decode_chunk(self.inode.codec, buffer['block'])
+                        raw += bytes(CHUNK_SIZE - len(raw))
+                self.fs.chunks.put(key, raw)
+            return raw
+
+        # Write 'data' at the end of the file.
+        def append(self, data):
+            return self.pwrite(self.inode.size, data)
+
         def readByte(self, buffer):
             if self.position >= self.inode.size:
                 # file pointer is past the file
                 return -5
+            if self.inode.is_inline:
+                buffer['byte'] = self.inode.inline[self.position]
+                self.position += 1
+                return 0
+            if self.inode.codec:
+                buffer['byte'] = self.chunk(self.position // CHUNK_SIZE)[self.position % CHUNK_SIZE]
+                self.position += 1
+                return 0
             # Relative block num
-            block_num = self.position // BLOCKSIZE
+            index = self.position // BLOCKSIZE
             # Absolute block num
-            block_num = self.inode.data_blocks[block_num]
+            block_num = self.inode.block_at(index)
             local_buffer = {}
-            ld.readBlock(self.fs.current_disk, block_num, local_buffer)
+            self.fs.cache.readBlock(block_num, local_buffer)
+            self.readahead(index, index)
             block = local_buffer['block']
             block = bytearray(block)
             byte_index = self.position % BLOCKSIZE
@@ -418,6 +2011,44 @@ class tinyFS:
             self.position += 1
             return 0
 
+        # Copy bytes starting at the file pointer into the writable buffer 'view',
+        # reading each block in the span once, with one multi-block read per run
+        # of contiguous blocks. Advances the file pointer by the
+        # number of bytes copied and returns it (0 at the end of the file).
+        def readinto(self, view):
+            view = memoryview(view).cast('B')
+            count = min(len(view), self.inode.size - self.position)
+            if count <= 0:
+                return 0
+            if self.inode.is_inline:
+                view[:count] = self.inode.inline[self.position:self.position + count]
+                self.position += count
+                return count
+            if self.inode.codec:
+                copied = 0
+                while copied < count:
+                    c, start = divmod(self.position + copied, CHUNK_SIZE)
+                    length = min(CHUNK_SIZE - start, count - copied)
+                    view[copied:copied + length] = memoryview(self.chunk(c))[start:start + length]
+                    copied += length
+                self.position += count
+                return count
+            first = self.position // BLOCKSIZE
+            last = (self.position + count - 1) // BLOCKSIZE + 1
+            buffer = {}
+            self.fs.cache.readBlockList(self.inode.block_list(first, last - first), buffer)
+            self.readahead(first, last - 1)
+            byte_index = self.position % BLOCKSIZE
+            view[:count] = memoryview(buffer['block'])[byte_index:byte_index + count]
+            self.position += count
+            return count
+
+        # Read up to n bytes from the file pointer, fewer if the file ends first.
+        def read(self, n):
+            data = bytearray(max(0, min(n, self.inode.size - self.position)))
+            self.readinto(data)
+            return bytes(data)
+
         def seek(self, position):
             if position >= 0 and position < self.inode.size:
                 self.position = position
@@ -428,60 +2059,258 @@ class tinyFS:
 
 
     class Directory(File):
-        
-        MAX_FILES_PER_DIRECTORY = BLOCKSIZE // 9 # number of name/inode pairs that can fit within one data block
+        """
+        DIRECTORY STRUCTURE
+        A directory is a hash table of name/inode pairs using linear hashing, so it
+        can grow one bucket at a time without ever rehashing the whole table.
+
+        Logical block 0 is the header:
+        4 bytes: number of entries
+        4 bytes: level, there are INITIAL_BUCKETS * 2**level buckets before splitting
+        4 bytes: split pointer, the next bucket to split
+        Logical block 1 + i is bucket i:
+        4 bytes: next overflow block number, 0 if none
+        2 bytes: number of entries in this block
+        DIR_ENTRIES_PER_BLOCK * 12 bytes: entries, 4 bytes of Inode block number
+        followed by an 8 byte name padded with null bytes
+        Overflow blocks have the same layout and are chained off a full bucket.
+
+        A name hashes (crc32) to bucket h % (INITIAL_BUCKETS * 2**level), or to
+        h % (INITIAL_BUCKETS * 2**(level + 1)) if that bucket has already been split.
+        When the table is more than DIR_LOAD_FACTOR full, the bucket at the split
+        pointer is split in two. Lookups read one bucket chain, and inserts and deletes
+        only rewrite the bucket blocks they change and the header.
+        """
 
         def __init__(self, filesystem, mode="new", block=None, parent=ROOT_INODE):
             if block is None:
                 raise ValueError("must provide Inode block number for directory")
 
             self.num_files = 0
-            self.files = {}
+            self.level = 0
+            self.split = 0
             if mode == "block" and block is not None:
                 super().__init__(filesystem=filesystem, mode=mode, block=block)
-                self.files = {}
-                num_files = self.inode.size // 9 # 1 byte for Inode number + 8 bytes for file name = 9 bytes per file
-
                 data = {}
-                ld.readBlock(self.fs.current_disk, self.inode.data_blocks[0], data)
-                bytes = data['block']
-                for i in range(num_files):
-                    start = 9 * i
-                    end = 9 * (i + 1)
-                    pair = bytes[start:end]
-                    # first byte of each 9 byte sequence is the block number of the Inode
-                    inode_block_num = pair[0]
-                    inode_name = []
-                    for j in range(1, 9):
-                        # look for null terminator
-                        if pair[j] == 0:
-                            break
-                        inode_name.append(pair[j].to_bytes(1, byteorder='big'))
-                    inode_name = b"".join(inode_name)
-                    self.add_file(inode_name, inode_block_num)
-                    i += 1
+                self.fs.cache.readBlock(self.inode.block_at(0), data)
+                self.num_files, self.level, self.split = DIR_HEADER_LAYOUT.unpack_from(data['block'])
 
             elif mode == "new":
                 self.fs = filesystem
+                self.position = 0
+                self.name = None
+                self.reset_readahead()
+                self.inode = self.fs.get_inode(block, mode="new", filetype=1)
+                # header and an empty bucket for each initial bucket
+                self.write(bytes((1 + INITIAL_BUCKETS) * BLOCKSIZE), (1 + INITIAL_BUCKETS) * BLOCKSIZE)
                 # initialize with pointers to self and parent
-                self.inode = self.fs.Inode(self.fs, "new", filetype=1)
-                self.write(b"\0" * BLOCKSIZE, BLOCKSIZE)
-                self.add_file(self.fs.pad(b".", MAX_FILENAME), block)
-                self.add_file(self.fs.pad(b"..", MAX_FILENAME), parent)
-        
+                self.add_file(b".", block)
+                self.add_file(b"..", parent)
+
+        @property
+        def num_buckets(self):
+            return (INITIAL_BUCKETS << self.level) + self.split
+
+        def bucket_of(self, name):
+            h = zlib.crc32(name)
+            bucket = h % (INITIAL_BUCKETS << self.level)
+            if bucket < self.split:
+                bucket = h % (INITIAL_BUCKETS << (self.level + 1))
+            return bucket
+
+        def write_header(self):
+            header = bytearray(BLOCKSIZE)
+            DIR_HEADER_LAYOUT.pack_into(header, 0, self.num_files, self.level, self.split)
+            self.fs.cache.writeBlock(self.inode.block_at(0), {'block': header})
+
+        # Write the inode, needed whenever the directory grows
+        def write_inode(self):
+            self.inode.write()
+
+        # The blocks of a bucket's chain as [block number, next block number, [(name, inode), ...]]
+        def read_chain(self, bucket):
+            chain = []
+            block_num = self.inode.block_at(1 + bucket)
+            while block_num != 0:
+                data = {}
+                self.fs.cache.readBlock(block_num, data)
+                block = data['block']
+                next_block, count = BUCKET_HEADER_LAYOUT.unpack_from(block)
+                entries = []
+                for i in range(count):
+                    inode, name = DIR_ENTRY_LAYOUT.unpack_from(block, DIR_BUCKET_HEADER + i * DIR_ENTRY_SIZE)
+                    entries.append((name.rstrip(b"\0"), inode))
+                chain.append([block_num, next_block, entries])
+                block_num = next_block
+            return chain
+
+        def write_chain_block(self, block_num, next_block, entries):
+            data = bytearray(BLOCKSIZE)
+            BUCKET_HEADER_LAYOUT.pack_into(data, 0, next_block, len(entries))
+            for i, (name, inode) in enumerate(entries):
+                # the 8s field pads the name with null bytes
+                DIR_ENTRY_LAYOUT.pack_into(data, DIR_BUCKET_HEADER + i * DIR_ENTRY_SIZE, inode, name)
+            self.fs.cache.writeBlock(block_num, {'block': data})
+
+        # Inode block number for 'name', or None if it is not in this directory
+        def lookup(self, name):
+            for block_num, next_block, entries in self.read_chain(self.bucket_of(name)):
+                for entry_name, inode in entries:
+                    if entry_name == name:
+                        return inode
+            return None
+
+        # Every (name, inode) pair in the directory, one bucket chain at a time
+        def entries(self):
+            for bucket in range(self.num_buckets):
+                for block_num, next_block, entries in self.read_chain(bucket):
+                    yield from entries
+
         def add_file(self, filename, inode):
-            if self.num_files > self.MAX_FILES_PER_DIRECTORY:
-                return -1 # too many files
-            data = {}
-            start = self.num_files * 9
-            end = start + 9
-            error = ld.readBlock(self.fs.current_disk, self.inode.data_blocks[0], data)
-            # print(error)
-            bytes = data['block']
-            bytes = bytes[:start] + inode.to_bytes(1, byteorder='big') + filename
+            if len(filename) > MAX_FILENAME:
+                return -9 # name too long
+            chain = self.read_chain(self.bucket_of(filename))
+            for link in chain:
+                for i, (name, _) in enumerate(link[2]):
+                    if name == filename:
+                        # already here, just point it at the new inode
+                        link[2][i] = (filename, inode)
+                        self.write_chain_block(*link)
+                        return 0
+            for link in chain:
+                if len(link[2]) < DIR_ENTRIES_PER_BLOCK:
+                    link[2].append((filename, inode))
+                    self.write_chain_block(*link)
+                    break
+            else:
+                # every block in the chain is full, chain on an overflow block
+                overflow = self.fs.allocate(1)
+                if overflow is None:
+                    return -4 # no space
+                self.write_chain_block(overflow[0], 0, [(filename, inode)])
+                chain[-1][1] = overflow[0]
+                self.write_chain_block(*chain[-1])
             self.num_files += 1
-            self.write(bytes, self.num_files * 9)
-            self.files[filename] = inode
-        
+            if self.num_files > self.num_buckets * DIR_ENTRIES_PER_BLOCK * DIR_LOAD_FACTOR:
+                self.split_bucket()
+            self.write_header()
+            return 0
+
+        # add_file for many (name, inode) pairs at once, see tinyFS.tfs_bulk_write. The
+        # table is split up front to the size the new entries call for, then each bucket
+        # chain they land in is read and rewritten once, and the header written once.
+        # Overflow blocks for every chain are allocated together, so -4 (no space) leaves
+        # the entries as they were.
+        def add_files(self, entries):
+            for filename, _ in entries:
+                if len(filename) > MAX_FILENAME:
+                    return -9 # name too long
+            while self.num_files + len(entries) > self.num_buckets * DIR_ENTRIES_PER_BLOCK * DIR_LOAD_FACTOR:
+                if self.split_bucket() < 0:
+                    break
+            buckets = {}
+            for filename, inode in entries:
+                buckets.setdefault(self.bucket_of(filename), {})[filename] = inode
+            updates = [] # (bucket, entries, chain blocks)
+            added = 0
+            needed = 0
+            for bucket in sorted(buckets):
+                chain = self.read_chain(bucket)
+                merged = dict(entry for link in chain for entry in link[2])
+                added += len(buckets[bucket].keys() - merged.keys())
+                merged.update(buckets[bucket])
+                updates.append((bucket, list(merged.items()), [link[0] for link in chain]))
+                needed += max(0, math.ceil(len(merged) / DIR_ENTRIES_PER_BLOCK) - len(chain))
+            overflow = []
+            if needed:
+                overflow = self.fs.allocate(needed)
+                if overflow is None:
+                    return -4 # no space
+            self.num_files += added
+            for bucket, merged, blocks in updates:
+                extra = max(0, math.ceil(len(merged) / DIR_ENTRIES_PER_BLOCK) - len(blocks))
+                self.write_entries(bucket, merged, blocks[1:] + overflow[:extra])
+                overflow = overflow[extra:]
+            self.write_header()
+            return 0
+
+        # Remove 'filename' and return the inode it pointed to, or None if it was not here
+        def remove_file(self, filename):
+            chain = self.read_chain(self.bucket_of(filename))
+            for position, link in enumerate(chain):
+                for i, (name, inode) in enumerate(link[2]):
+                    if name != filename:
+                        continue
+                    del link[2][i]
+                    if not link[2] and position > 0:
+                        # unlink and free an empty overflow block
+                        chain[position - 1][1] = link[1]
+                        self.write_chain_block(*chain[position - 1])
+                        self.fs.free([link[0]])
+                    else:
+                        self.write_chain_block(*link)
+                    self.num_files -= 1
+                    self.write_header()
+                    return inode
+            return None
+
+        # Split the bucket at the split pointer into itself and a new bucket at the end.
+        # The new bucket's blocks are all in hand before either chain is rewritten, so
+        # on -4 (no space) the table is left as it was, just fuller.
+        def split_bucket(self):
+            old_bucket = self.split
+            new_bucket = self.num_buckets
+            chain = self.read_chain(old_bucket)
+            # once split, the bucket's names hash over twice as many buckets
+            modulus = INITIAL_BUCKETS << (self.level + 1)
+            keep = []
+            move = []
+            for link in chain:
+                for name, inode in link[2]:
+                    (keep if zlib.crc32(name) % modulus == old_bucket else move).append((name, inode))
+            # The old chain's overflow blocks are shared out between the two halves,
+            # which always leaves enough for both along with the new bucket's block
+            overflow = [link[0] for link in chain[1:]]
+            kept = max(1, math.ceil(len(keep) / DIR_ENTRIES_PER_BLOCK)) - 1
+            moved = overflow[kept:]
+            short = max(1, math.ceil(len(move) / DIR_ENTRIES_PER_BLOCK)) - 1 - len(moved)
+            if short > 0:
+                extra = self.fs.allocate(short)
+                if extra is None:
+                    return -4 # no space
+                moved += extra
+            # append the new bucket's block to the directory file
+            error = self.pwrite((1 + new_bucket) * BLOCKSIZE, bytes(BLOCKSIZE))
+            if error < 0:
+                if short > 0:
+                    self.fs.free(moved[-short:])
+                return error
+            self.split += 1
+            if self.split == INITIAL_BUCKETS << self.level:
+                self.level += 1
+                self.split = 0
+            self.write_entries(new_bucket, move, moved)
+            self.write_entries(old_bucket, keep, overflow[:kept])
+            self.write_inode()
+            return 0
+
+        # Rewrite a bucket's chain to hold 'entries', reusing the overflow blocks in
+        # 'overflow' first and freeing any that are left over
+        def write_entries(self, bucket, entries, overflow):
+            blocks = [self.inode.block_at(1 + bucket)] + overflow
+            needed = max(1, math.ceil(len(entries) / DIR_ENTRIES_PER_BLOCK))
+            if needed > len(blocks):
+                new_blocks = self.fs.allocate(needed - len(blocks))
+                if new_blocks is None:
+                    # split_bucket and add_files hand over every block needed up front
+                    return -4 # no space
+                blocks += new_blocks
+            self.fs.free(blocks[needed:])
+            blocks = blocks[:needed]
+            for i, block_num in enumerate(blocks):
+                next_block = blocks[i + 1] if i + 1 < len(blocks) else 0
+                self.write_chain_block(block_num, next_block, entries[i * DIR_ENTRIES_PER_BLOCK:(i + 1) * DIR_ENTRIES_PER_BLOCK])
+            return 0
+
         def __str__(self):
-            return f"Directory(# Files: {self.num_files}, Files: {self.files})"
\ No newline at end of file
+            return f"Directory(# Files: {self.num_files}, Buckets: {self.num_buckets})"
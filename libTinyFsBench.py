@@ -0,0 +1,175 @@
+from libTinyFS import *
+from libAsyncTinyFS import AsyncTinyFS
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+import threading
+
+BENCH_DISK_NAME = "benchDisk"
+
+class SlowDisk:
+    """
+    Wraps a disk library and sleeps before every disk call, to stand in for a
+    device with real access latency. Everything else is passed through.
+    Disk calls are counted by name in 'calls', and the blocks they move in
+    'blocks_read' and 'blocks_written'.
+    """
+
+    def __init__(self, lib, latency):
+        self.lib = lib
+        self.latency = latency
+        self.calls = {}
+        self.blocks_read = 0
+        self.blocks_written = 0
+
+    def __getattr__(self, name):
+        call = getattr(self.lib, name)
+        if name not in ("readBlock", "writeBlock", "readBlocks", "writeBlocks", "readBlockList", "writeBlockList", "syncDisk"):
+            return call
+        def slow_call(*args):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if name in ("readBlock", "writeBlock"):
+                count = 1
+            elif name in ("readBlocks", "writeBlocks"):
+                count = args[2]
+            elif name in ("readBlockList", "writeBlockList"):
+                count = len(args[1])
+            else:
+                count = 0
+            if name.startswith("read"):
+                self.blocks_read += count
+            else:
+                self.blocks_written += count
+            if self.latency > 0:
+                time.sleep(self.latency)
+            return call(*args)
+        return slow_call
+
+# Register 'lib' in DISK_BACKENDS as 'name' for the length of the with block
+@contextlib.contextmanager
+def disk_backend(name, lib):
+    DISK_BACKENDS[name] = lib
+    try:
+        yield name
+    finally:
+        DISK_BACKENDS.pop(name, None)
+
+# Make an image holding 'num_files' files of 'file_size' bytes each
+def make_image(num_files, file_size):
+    fs = tinyFS()
+    fs.tfs_mkfs(BENCH_DISK_NAME, (num_files * (file_size // BLOCKSIZE + 4) + 64) * BLOCKSIZE)
+    fs.tfs_mount(BENCH_DISK_NAME)
+    for i in range(num_files):
+        fd = fs.tfs_open(f"/f{i}")
+        fs.tfs_write(fd, {'bytes': bytes([i % 256]) * file_size})
+        fs.tfs_close(fd)
+    fs.tfs_unmount()
+
+# Read throughput of 'threads' reader threads sharing one thread-safe tinyFS. Each
+# thread opens its own descriptor and reads whole files for 'duration' seconds.
+# Threads read different files when 'shared' is False and the same file otherwise.
+# Returns MB read per second.
+def bench_readers(threads, num_files, file_size, latency, shared=False, duration=1.0):
+    with disk_backend("slow", SlowDisk(ld, latency) if latency > 0 else ld) as backend:
+        fs = tinyFS(cache_blocks=0, threadsafe=True)
+        fs.tfs_mount(BENCH_DISK_NAME, backend)
+        totals = [0] * threads
+        start = threading.Barrier(threads + 1)
+        stop = threading.Event()
+
+        def reader(n):
+            fd = fs.tfs_open(f"/f{0 if shared else n % num_files}")
+            view = bytearray(file_size)
+            start.wait()
+            while not stop.is_set():
+                fs.tfs_seek(fd, 0)
+                totals[n] += fs.tfs_readinto(fd, view)
+            fs.tfs_close(fd)
+
+        workers = [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        start.wait()
+        began = time.perf_counter()
+        time.sleep(duration)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - began
+        fs.tfs_unmount()
+    return sum(totals) / elapsed / 1e6
+
+# Read throughput of 'tasks' asyncio tasks on one AsyncTinyFS with 'workers' pool
+# threads, each task reading a different file 'rounds' times. Returns MB read per
+# second and the block cache counters.
+def bench_async(tasks, workers, num_files, file_size, latency, rounds=20):
+    async def run(backend):
+        afs = AsyncTinyFS(max_workers=workers, cache_blocks=0)
+        await afs.tfs_mount(BENCH_DISK_NAME, backend)
+
+        async def reader(n):
+            fd = await afs.tfs_open(f"/f{n % num_files}")
+            total = 0
+            for _ in range(rounds):
+                await afs.tfs_seek(fd, 0)
+                total += len(await afs.tfs_read(fd, file_size))
+            await afs.tfs_close(fd)
+            return total
+
+        began = time.perf_counter()
+        totals = await asyncio.gather(*(reader(n) for n in range(tasks)))
+        elapsed = time.perf_counter() - began
+        stats = afs.fs.tfs_cache_stats()
+        await afs.tfs_unmount()
+        afs.shutdown()
+        return sum(totals) / elapsed / 1e6, stats
+
+    with disk_backend("slow", SlowDisk(ld, latency) if latency > 0 else ld) as backend:
+        return asyncio.run(run(backend))
+
+# Mount time of an image made by make_image, averaged over 'rounds' mounts. Returns
+# milliseconds per mount and the disk calls one mount makes, by name.
+def bench_mount(rounds=20):
+    disk = SlowDisk(ld, 0)
+    elapsed = 0
+    with disk_backend("counted", disk) as backend:
+        for _ in range(rounds):
+            fs = tinyFS()
+            disk.calls = {}
+            began = time.perf_counter()
+            fs.tfs_mount(BENCH_DISK_NAME, backend=backend)
+            elapsed += time.perf_counter() - began
+            calls = disk.calls
+            fs.tfs_unmount()
+    return elapsed / rounds * 1000, calls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tinyFS mount time and concurrent read benchmarks")
+    parser.add_argument("latency", nargs="?", type=float, default=0.0005, help="seconds each disk call sleeps (default 0.0005)")
+    latency = parser.parse_args().latency
+    print("Mount time, files in the root directory")
+    for count in (100, 1000, 10000):
+        make_image(count, 16)
+        ms, calls = bench_mount()
+        print(f"  {count:5d} files: {ms:6.3f} ms  disk calls {calls}")
+    num_files = 8
+    file_size = 64 * 1024
+    make_image(num_files, file_size)
+    print(f"Reader threads, {num_files} files of {file_size} bytes, {latency * 1000:.2f} ms per disk call, {os.cpu_count()} CPUs")
+    for shared in (False, True):
+        print("same file" if shared else "one file per thread")
+        base = None
+        for threads in (1, 2, 4, 8):
+            rate = bench_readers(threads, num_files, file_size, latency, shared)
+            base = base or rate
+            print(f"  {threads} threads: {rate:8.2f} MB/s  ({rate / base:.2f}x)")
+    print("asyncio tasks, one file each, 4 pool threads")
+    base = None
+    for tasks in (1, 2, 4, 8):
+        rate, _ = bench_async(tasks, 4, num_files, file_size, latency)
+        base = base or rate
+        print(f"  {tasks} tasks: {rate:8.2f} MB/s  ({rate / base:.2f}x)")
+    os.remove(BENCH_DISK_NAME)
@@ -0,0 +1,507 @@
+from libTinyFS import *
+from libCompress import COMPRESSION_CODECS
+from collections import deque
+import argparse
+import json
+import os
+import sys
+
+"""
+FSCK AND DEFRAG
+Checks an unmounted tinyFS image end to end and, with --repair, fixes what it finds.
+The image is mounted like any other, so a committed journal transaction is replayed
+first, but every inode, pointer block, overflow extent block and bucket chain is
+parsed here, with each block number checked before it is read.
+
+Pass 1 walks the namespace from the root directory, one directory and one bucket
+chain at a time. Each inode is checked on its own: file type and codec, size against
+number of blocks, the inline and compressed chunk layouts (see tinyFS.Inode and
+tinyFS.File), holes only where compressed files have them, and every block number
+in range. Every block it owns (inode, pointer or overflow extent blocks, data blocks,
+directory overflow buckets) is marked in a bitmap of referenced blocks. An entry
+pointing at a bad inode, or at a block something else already owns (a second name
+for a file, a directory cycle), is a bad entry.
+Pass 2 compares the referenced bitmap with the free block bitmap on disk: blocks
+marked used that nothing references are leaked, blocks referenced but marked free
+are lost. The superblock's free count is checked against the bitmap.
+
+--repair removes bad entries (their blocks then count as leaked), fixes "." and
+"..", rewrites wrong directory entry counts, and replaces the bitmap and free count
+with the referenced ones, all through the journal. Memory is one bit per block plus
+the directories still to visit and the block list of one file at a time, however
+many files there are.
+
+--defrag (once the image is clean or repaired) moves each regular file whose data
+blocks are not one contiguous run into a single new run, DEFRAG_BATCH blocks at a
+time, and rebuilds its block map, committing after every file so the old blocks
+can be reused. Holes in compressed files stay holes, inline files and directories
+are left alone. The image is checked again afterwards.
+
+python libTinyFsCheck.py image [--repair] [--defrag] [--backend file|mmap] [--json]
+
+Exit status 0 if the image was clean, 1 if problems were found and all repaired,
+4 if some are left.
+"""
+
+MAX_REPORTED = 50 # problems listed one by one, the rest are only counted
+DEFRAG_BATCH = 64 # blocks copied per disk call when defragmenting
+# Problems --repair does not fix
+UNREPAIRABLE = {"superblock", "root", "directory_chain"}
+
+class BadInode(Exception):
+    pass
+
+
+class Fragmentation:
+    """
+    How scattered the data blocks of regular files are: the number of runs of
+    contiguous blocks, and 'fragmentation', the share of steps from one data block
+    of a file to its next that jump somewhere else (0 when every file is one run).
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.data_blocks = 0
+        self.fragmented_files = 0
+        self.runs = 0
+
+    # Count a file whose data blocks, in file order and without holes, are 'blocks'
+    def add(self, blocks):
+        if not blocks:
+            return
+        runs = count_runs(blocks)
+        self.files += 1
+        self.data_blocks += len(blocks)
+        self.runs += runs
+        if runs > 1:
+            self.fragmented_files += 1
+
+    def as_dict(self):
+        steps = self.data_blocks - self.files
+        return {
+            "files": self.files,
+            "data_blocks": self.data_blocks,
+            "fragmented_files": self.fragmented_files,
+            "runs": self.runs,
+            "fragmentation": round((self.runs - self.files) / steps, 4) if steps else 0.0,
+        }
+
+# Number of runs of consecutive block numbers in 'blocks'
+def count_runs(blocks):
+    return 1 + sum(1 for a, b in zip(blocks, blocks[1:]) if b != a + 1) if blocks else 0
+
+
+class Checker:
+
+    def __init__(self, filename, backend="file", cache_blocks=DEFAULT_CACHE_BLOCKS):
+        self.filename = filename
+        self.backend = backend
+        self.fs = tinyFS(cache_blocks=cache_blocks, file_cache=0, readahead_blocks=0)
+
+    # Check the image, then defragment it and check it again if asked. Returns the report.
+    def run(self, repair=False, defrag=False):
+        error = self.fs.tfs_mount(self.filename, self.backend)
+        if error < 0:
+            return {"image": self.filename, "mounted": False, "error": error, "problems": {"superblock": 1},
+                    "details": [f"superblock: mount failed with {error}"], "status": 4}
+        try:
+            report = self.check(repair)
+            if defrag:
+                if report["status"] == 0 or (repair and report["status"] == 1):
+                    report["defragmented_files"] = self.defrag()
+                    report["after"] = self.check(False)
+                else:
+                    report["defragmented_files"] = 0
+                    report["details"].append("defrag skipped, the image has problems")
+        finally:
+            self.fs.tfs_unmount()
+        return report
+
+    def problem(self, kind, detail):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if len(self.details) < MAX_REPORTED:
+            self.details.append(f"{kind}: {detail}")
+
+    # Passes 1 and 2, see FSCK AND DEFRAG
+    def check(self, repair):
+        fs = self.fs
+        self.counts = {}
+        self.details = []
+        self.fragmentation = Fragmentation()
+        self.files = 0
+        self.directories = 0
+
+        superblock = {}
+        fs.cache.readBlock(SUPERBLOCK, superblock)
+        header = Superblock.unpack_from(superblock['block'])
+        self.num_blocks = header.num_blocks
+        self.inline_size = (tinyFS.ExtentInode if fs.inode_format == "extent" else tinyFS.Inode).INLINE_SIZE
+        # Blocks below this are the superblock, root inode, bitmap and journal
+        self.first_block = header.journal_start + header.journal_blocks
+        disk_blocks = os.path.getsize(self.filename) // BLOCKSIZE
+        if header.num_blocks > disk_blocks or header.root != ROOT_INODE or self.first_block > header.num_blocks \
+                or header.journal_start != BITMAP_START + header.spill_blocks:
+            self.problem("superblock", f"{header} does not fit an image of {disk_blocks} blocks")
+            return self.report(repair)
+        self.referenced = bytearray(math.ceil(self.num_blocks / 8))
+        for block in range(self.first_block):
+            self.mark(block)
+
+        # Pass 1
+        try:
+            root = self.check_inode(ROOT_INODE, is_root=True)
+        except BadInode as e:
+            self.problem("root", f"root directory: {e}")
+            return self.report(repair)
+        queue = deque([(ROOT_INODE, ROOT_INODE, "", root)])
+        while queue:
+            self.check_directory(queue, *queue.popleft(), repair)
+
+        # Pass 2
+        bitmap = fs.bitmap
+        step = 4096 # bytes of bitmap compared at once
+        for offset in range(0, len(self.referenced), step):
+            if bitmap.bits[offset:offset + step] == self.referenced[offset:offset + step]:
+                continue
+            for i in range(offset, min(offset + step, len(self.referenced))):
+                on_disk, referenced = bitmap.bits[i], self.referenced[i]
+                for bit in range(8):
+                    block = i * 8 + bit
+                    if block >= self.num_blocks or (on_disk >> bit) & 1 == (referenced >> bit) & 1:
+                        continue
+                    if (referenced >> bit) & 1:
+                        self.problem("lost", f"block {block} is in use but marked free")
+                        if repair:
+                            bitmap.reserve([block])
+                    else:
+                        self.problem("leaked", f"block {block} is marked used but nothing references it")
+                        if repair:
+                            bitmap.free([block])
+        if header.num_free != bitmap.num_free:
+            self.problem("free_count", f"superblock says {header.num_free} free blocks, the bitmap has {bitmap.num_free}")
+            if repair:
+                bitmap.dirty.add(0) # have tinyFS.write_superblock rewrite the free count
+        if repair and self.counts:
+            fs.commit()
+        return self.report(repair)
+
+    def report(self, repair):
+        unrepaired = sum(count for kind, count in self.counts.items() if kind in UNREPAIRABLE or not repair)
+        return {
+            "image": self.filename,
+            "blocks": self.num_blocks,
+            "free_blocks": self.fs.bitmap.num_free if self.fs.block_bitmap is not None else None,
+            "files": self.files,
+            "directories": self.directories,
+            "problems": dict(sorted(self.counts.items())),
+            "details": self.details,
+            "repaired": repair and bool(self.counts),
+            "fragmentation": self.fragmentation.as_dict(),
+            "status": 0 if not self.counts else (4 if unrepaired else 1),
+        }
+
+    def is_marked(self, block):
+        return (self.referenced[block >> 3] >> (block & 7)) & 1
+
+    def mark(self, block):
+        self.referenced[block >> 3] |= 1 << (block & 7)
+
+    def unmark(self, block):
+        self.referenced[block >> 3] &= ~(1 << (block & 7)) & 0xFF
+
+    # Mark 'blocks' referenced, or mark none of them and raise if one already is
+    def claim(self, blocks):
+        for i, block in enumerate(blocks):
+            if self.is_marked(block):
+                for claimed in blocks[:i]:
+                    self.unmark(claimed)
+                raise BadInode(f"block {block} is already in use")
+            self.mark(block)
+
+    # Raise unless 'block' is one files and directories can own
+    def check_block(self, block, what):
+        if not self.first_block <= block < self.num_blocks:
+            raise BadInode(f"{what} {block} is out of range")
+
+    def read_block(self, block):
+        data = {}
+        self.fs.cache.readBlock(block, data)
+        return data['block']
+
+    # Check the inode at 'number' and claim every block it owns. Returns (file type,
+    # data blocks in file order with 0 for holes).
+    def check_inode(self, number, is_root=False):
+        if not is_root:
+            self.check_block(number, "inode")
+        data = self.read_block(number)
+        size, filetype, num_blocks = INODE_LAYOUT.unpack_from(data)
+        filetype, codec = filetype & 0x0F, filetype >> 4
+        if filetype not in (0, 1) or (is_root and filetype != 1):
+            raise BadInode(f"inode {number} has file type {filetype}")
+        if codec not in COMPRESSION_CODECS.values() or (codec and filetype == 1):
+            raise BadInode(f"inode {number} has codec {codec}")
+        if self.fs.inode_format == "extent":
+            map_blocks, blocks = self.extent_map(data, num_blocks)
+        else:
+            map_blocks, blocks = self.indirect_map(data, num_blocks)
+        blocks += [0] * (num_blocks - len(blocks))
+
+        if filetype == 1:
+            if num_blocks < 1 + INITIAL_BUCKETS or size != num_blocks * BLOCKSIZE or 0 in blocks:
+                raise BadInode(f"directory inode {number} has size {size} and {num_blocks} blocks")
+        elif num_blocks == 0:
+            if size > self.inline_size:
+                raise BadInode(f"inline file inode {number} has size {size}")
+        elif codec:
+            self.check_chunks(number, size, blocks)
+        elif num_blocks != math.ceil(size / BLOCKSIZE) or 0 in blocks:
+            raise BadInode(f"inode {number} has size {size} and {num_blocks} blocks")
+
+        owned = [block for block in blocks if block != 0] + map_blocks
+        if not is_root:
+            owned.append(number)
+        self.claim(owned)
+        return filetype, blocks
+
+    # Compressed file layout: chunk c's blocks start its slot, the rest are holes,
+    # and a chunk using fewer than all of them has a header that fits them.
+    def check_chunks(self, number, size, blocks):
+        if len(blocks) != math.ceil(size / CHUNK_SIZE) * COMPRESSED_CHUNK_BLOCKS:
+            raise BadInode(f"compressed inode {number} has size {size} and {len(blocks)} blocks")
+        for slot in range(0, len(blocks), COMPRESSED_CHUNK_BLOCKS):
+            chunk = blocks[slot:slot + COMPRESSED_CHUNK_BLOCKS]
+            count = sum(1 for block in chunk if block != 0)
+            if 0 in chunk[:count]:
+                raise BadInode(f"compressed inode {number} chunk {slot // COMPRESSED_CHUNK_BLOCKS} has a hole inside")
+            if 0 < count < COMPRESSED_CHUNK_BLOCKS:
+                length, = CHUNK_HEADER_LAYOUT.unpack_from(self.read_block(chunk[0]))
+                stored = CHUNK_HEADER_LAYOUT.size + length
+                if not (count - 1) * BLOCKSIZE < stored <= count * BLOCKSIZE:
+                    raise BadInode(f"compressed inode {number} chunk {slot // COMPRESSED_CHUNK_BLOCKS} holds {length} bytes in {count} blocks")
+
+    # Pointer blocks and data blocks of an indirect inode, see tinyFS.Inode
+    def indirect_map(self, data, num_blocks):
+        if num_blocks > MAX_FILE_BLOCKS:
+            raise BadInode(f"{num_blocks} blocks is past the largest file")
+        blocks = unpack_pointers(data, INODE_HEADER, min(num_blocks, NUM_DIRECT_BLOCKS))
+        map_blocks = []
+        base = NUM_DIRECT_BLOCKS
+        for level, top in enumerate(unpack_pointers(data, INDIRECT_START, INDIRECT_LEVELS)):
+            if top != 0:
+                if base >= num_blocks:
+                    raise BadInode(f"indirect block {top} maps nothing")
+                self.walk_pointers(top, level, base, num_blocks, map_blocks, blocks)
+            base += POINTERS_PER_BLOCK ** (level + 1)
+        for block in blocks:
+            if block != 0:
+                self.check_block(block, "data block")
+        return map_blocks, blocks
+
+    # Add pointer block 'block' (mapping from logical block 'base' at 'depth', see
+    # Inode.truncate_pointers) and the blocks under it to 'map_blocks' and 'blocks'
+    def walk_pointers(self, block, depth, base, num_blocks, map_blocks, blocks):
+        self.check_block(block, "pointer block")
+        map_blocks.append(block)
+        span = POINTERS_PER_BLOCK ** depth
+        for slot, child in enumerate(unpack_pointers(self.read_block(block), 0, POINTERS_PER_BLOCK)):
+            child_base = base + slot * span
+            if child_base >= num_blocks:
+                if child != 0:
+                    raise BadInode(f"pointer block {block} maps past the end of the file")
+                continue
+            if depth == 0:
+                blocks.append(child)
+            elif child != 0:
+                self.walk_pointers(child, depth - 1, child_base, num_blocks, map_blocks, blocks)
+            else:
+                blocks.extend([0] * min(span, num_blocks - child_base))
+
+    # Overflow extent blocks and data blocks of an extent inode, see tinyFS.ExtentInode
+    def extent_map(self, data, num_blocks):
+        num_extents, next_block = EXTENT_HEADER_LAYOUT.unpack_from(data, INODE_HEADER)
+        values = unpack_pointers(data, EXTENT_START, min(num_extents, INODE_EXTENTS) * 2)
+        map_blocks = []
+        while len(values) < num_extents * 2:
+            if next_block == 0 or len(map_blocks) >= math.ceil((num_extents - INODE_EXTENTS) / EXTENTS_PER_BLOCK):
+                raise BadInode("the overflow extent chain does not hold every extent")
+            self.check_block(next_block, "overflow extent block")
+            map_blocks.append(next_block)
+            block = self.read_block(next_block)
+            next_block = unpack_pointers(block, 0, 1)[0]
+            values += unpack_pointers(block, BLOCK_NUMBER_SIZE, min(num_extents - len(values) // 2, EXTENTS_PER_BLOCK) * 2)
+        if next_block != 0:
+            raise BadInode(f"overflow extent block {next_block} holds no extents")
+        blocks = []
+        for i in range(0, len(values), 2):
+            start, length = values[i], values[i + 1]
+            if len(blocks) + length > num_blocks:
+                raise BadInode(f"extents map more than {num_blocks} blocks")
+            if start == 0:
+                blocks.extend([0] * length)
+            else:
+                self.check_block(start, "extent")
+                self.check_block(start + length - 1, "extent end")
+                blocks.extend(range(start, start + length))
+        return map_blocks, blocks
+
+    # The (name, inode) entries of the directory whose data blocks are 'blocks', one
+    # bucket chain at a time. Overflow bucket blocks are claimed on the way, when
+    # 'claim' is set.
+    def dir_entries(self, blocks, path, claim=True):
+        for bucket_block in blocks[1:]:
+            block_num = bucket_block
+            chain = 0
+            while block_num != 0:
+                if chain > 0 and claim:
+                    try:
+                        self.check_block(block_num, "overflow bucket")
+                        self.claim([block_num])
+                    except BadInode as e:
+                        self.problem("directory_chain", f"{path or '/'}: {e}")
+                        break
+                block = self.read_block(block_num)
+                next_block, count = BUCKET_HEADER_LAYOUT.unpack_from(block)
+                if count > DIR_ENTRIES_PER_BLOCK:
+                    self.problem("directory_chain", f"{path or '/'}: bucket block {block_num} claims {count} entries")
+                    break
+                for i in range(count):
+                    inode, name = DIR_ENTRY_LAYOUT.unpack_from(block, DIR_BUCKET_HEADER + i * DIR_ENTRY_SIZE)
+                    yield name.rstrip(b"\0"), inode
+                block_num = next_block
+                chain += 1
+
+    # Check directory 'number' (whose parent is 'parent'), queue its subdirectories and
+    # check every file in it
+    def check_directory(self, queue, number, parent, path, inode, repair):
+        self.directories += 1
+        _, blocks = inode
+        num_files, level, split = DIR_HEADER_LAYOUT.unpack_from(self.read_block(blocks[0]))
+        if (INITIAL_BUCKETS << level) + split != len(blocks) - 1:
+            self.problem("directory_chain", f"{path or '/'}: header says level {level} split {split} for {len(blocks) - 1} buckets")
+            return
+        seen = 0
+        bad = []
+        links = {b".": number, b"..": parent}
+        found = {}
+        for name, child in self.dir_entries(blocks, path):
+            seen += 1
+            if name in links:
+                found[name] = child
+                continue
+            try:
+                child_inode = self.check_inode(child)
+            except BadInode as e:
+                self.problem("bad_entry", f"{path}/{name.decode('utf-8', 'replace')}: {e}")
+                bad.append(name)
+                continue
+            if child_inode[0] == 1:
+                queue.append((child, number, f"{path}/{name.decode('utf-8', 'replace')}", child_inode))
+            else:
+                self.files += 1
+                self.fragmentation.add([block for block in child_inode[1] if block != 0])
+        for name, target in links.items():
+            if found.get(name) != target:
+                self.problem("bad_link", f"{path or '/'}: {name.decode('utf-8')} is {found.get(name)} instead of {target}")
+        if seen != num_files:
+            self.problem("entry_count", f"{path or '/'}: header says {num_files} entries, found {seen}")
+        if repair and (bad or seen != num_files or any(found.get(name) != target for name, target in links.items())):
+            directory = self.fs.open_directory(number)
+            for name in bad:
+                directory.remove_file(name)
+            for name, target in links.items():
+                if found.get(name) != target:
+                    directory.add_file(name, target)
+                    seen += name not in found
+            directory.num_files = seen - len(bad)
+            directory.write_header()
+
+    # Move every fragmented regular file into one contiguous run. Returns how many moved.
+    def defrag(self):
+        fs = self.fs
+        moved = 0
+        queue = deque([ROOT_INODE])
+        while queue:
+            directory = fs.get_inode(queue.popleft())
+            blocks = directory.block_list(0, directory.num_blocks)
+            fs.put_inode(directory)
+            for name, child in self.dir_entries(blocks, "", claim=False):
+                if name in (b".", b".."):
+                    continue
+                inode = fs.get_inode(child)
+                if inode.filetype == 1:
+                    queue.append(child)
+                elif self.defrag_file(inode):
+                    moved += 1
+                fs.put_inode(inode)
+        return moved
+
+    # Copy the data blocks of 'inode' into one new run and remap them, if they are in
+    # more than one now and a run that size is free
+    def defrag_file(self, inode):
+        fs = self.fs
+        blocks = inode.block_list(0, inode.num_blocks)
+        data_blocks = [block for block in blocks if block != 0]
+        if count_runs(data_blocks) <= 1:
+            return False
+        # room for the new run and a new set of pointer blocks
+        if fs.bitmap.num_free < len(data_blocks) + len(blocks) // POINTERS_PER_BLOCK + INDIRECT_LEVELS:
+            return False
+        new_blocks = fs.allocate(len(data_blocks))
+        if new_blocks is None or count_runs(new_blocks) > 1:
+            if new_blocks is not None:
+                fs.bitmap.free(new_blocks)
+            return False
+        for i in range(0, len(data_blocks), DEFRAG_BATCH):
+            buffer = {}
+            fs.cache.readBlockList(data_blocks[i:i + DEFRAG_BATCH], buffer)
+            fs.cache.writeBlockList(new_blocks[i:i + DEFRAG_BATCH], buffer, journal=False)
+        # Rebuild the map from scratch, holes are left unmapped
+        num_blocks = inode.num_blocks
+        inode.truncate(0)
+        new_blocks = iter(new_blocks)
+        for i, block in enumerate(blocks):
+            if block != 0:
+                inode.set_block(i, next(new_blocks))
+        inode.num_blocks = num_blocks
+        inode.dirty = True
+        inode.write()
+        # the old blocks are only free once the new map is committed
+        fs.commit()
+        return True
+
+
+def print_report(report):
+    print(f"{report['image']}: {report.get('blocks')} blocks, {report.get('free_blocks')} free, "
+          f"{report.get('files', 0)} files in {report.get('directories', 0)} directories")
+    for detail in report["details"]:
+        print("  " + detail)
+    for kind, count in report["problems"].items():
+        print(f"  {count} {kind}")
+    if "fragmentation" in report:
+        frag = report["fragmentation"]
+        print(f"  fragmentation {frag['fragmentation']:.4f}: {frag['fragmented_files']} of {frag['files']} files fragmented, "
+              f"{frag['runs']} runs for {frag['data_blocks']} data blocks")
+    status = {0: "clean", 1: "repaired", 4: "problems left"}[report["status"]]
+    print(f"  {status}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check, repair and defragment a tinyFS image")
+    parser.add_argument("image")
+    parser.add_argument("--repair", action="store_true", help="fix the problems found")
+    parser.add_argument("--defrag", action="store_true", help="make every file contiguous, then check again")
+    parser.add_argument("--backend", default="file", choices=list(DISK_BACKENDS))
+    parser.add_argument("--cache-blocks", type=int, default=DEFAULT_CACHE_BLOCKS)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    checker = Checker(args.image, args.backend, args.cache_blocks)
+    report = checker.run(args.repair, args.defrag)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+        if "after" in report:
+            print(f"after defragmenting {report['defragmented_files']} files:")
+            print_report(report["after"])
+    sys.exit(report["status"])
@@ -27,6 +27,14 @@ if __name__ == "__main__":
     result = "".join(result)
     print(result)
 
+    print("\nTesting bulk read\n")
+
+    fs.tfs_seek(fd, 0)
+    print(fs.tfs_read(fd, 64))
+    view = memoryview(bytearray(32))
+    count = fs.tfs_readinto(fd, view)
+    print(count, bytes(view[:count]))
+
     print("\nTesting seek\n")
 
     # Test seek
@@ -71,9 +79,24 @@ if __name__ == "__main__":
 
     print("\nOpening hello to delete it\n")
     fd = fs.tfs_open("hello")
-    print(fs.free_block_table)
+    print(fs.bitmap)
+    fs.tfs_delete(fd)
+    print(fs.bitmap)
+
+    print("\nTesting directories\n")
+    fs.tfs_mkdir("/docs")
+    fs.tfs_mkdir("/docs/old")
+    fd = fs.tfs_open("/docs/old/notes")
+    fs.tfs_write(fd, {'bytes': "notes in a subdirectory".encode('utf-8')})
+    fs.tfs_close(fd)
+    print("/docs:", fs.tfs_readdir("/docs"))
+    fs.tfs_rename("/docs/old/notes", "/docs/notes")
+    print("after rename /docs:", fs.tfs_readdir("/docs"), "/docs/old:", fs.tfs_readdir("/docs/old"))
+    fd = fs.tfs_open("/docs/notes")
+    print(fs.tfs_read(fd, 100).decode('utf-8'))
+    fd = fs.tfs_open("/docs/old/")
     fs.tfs_delete(fd)
-    print(fs.free_block_table)
+    print("/:", fs.tfs_readdir("/"))
     # Unmount
     print("\nTesting unmount\n")
     fs.tfs_unmount()
@@ -0,0 +1,468 @@
+from libTinyFS import *
+from libTinyFsBench import SlowDisk, disk_backend
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+"""
+BENCHMARK SUITE
+Times the tinyFS hot paths over a range of disk sizes, file sizes and file counts:
+mkfs, mount, create, open, sequential write and read, random seek + read, delete,
+and directory work (mkdir, readdir, rename, deep path opens), and bulk writes and
+reads of many small files against the same done one file at a time.
+
+Each workload runs on a fresh image behind a SlowDisk with no latency, which counts
+the disk calls and blocks each timed operation makes. Every result reports the
+number of operations, their total time, throughput (ops/s, and MB/s where bytes
+move), per-operation latency percentiles in microseconds and the block I/O.
+A workload ends with a timed tfs_sync, so journal and write-back costs are counted
+in its time and I/O but not in its per-operation latencies.
+
+python libTinyFsSuite.py [--quick] [--backend file|mmap] [--inode-format indirect|extent]
+                         [--output results.json] [--baseline old.json]
+
+A summary table is printed, and the results are written to --output
+(SUITE_RESULTS by default) as JSON with sorted keys and no timestamps, so the
+output of two versions can be diffed. --baseline compares against an earlier output and
+exits with status 1 if throughput dropped or block I/O grew past the thresholds.
+"""
+
+SUITE_DISK_NAME = "suiteDisk"
+COUNTED_BACKEND = "counted"
+SEED = 1837
+CHUNK = 64 * 1024 # bytes per call in the sequential workloads
+DIR_FANOUT = 4 # directories per level in the dirs workload
+SUITE_RESULTS = "suiteResults.json"
+KB = 1024
+MB = 1024 * 1024
+BULK_FILE_SIZE = 4 * KB # bytes per file in the bulk workload
+
+# Parameters of the full run, and of --quick
+FULL = {
+    "disk_sizes": [1 * MB, 16 * MB, 64 * MB],
+    "file_sizes": [4 * KB, 256 * KB, 4 * MB],
+    "file_counts": [100, 1000],
+    "dir_widths": [10, 100],
+    "sequential_bytes": 8 * MB,
+    "random_reads": 2000,
+    "repeats": 10,
+}
+QUICK = {
+    "disk_sizes": [1 * MB, 4 * MB],
+    "file_sizes": [4 * KB, 256 * KB],
+    "file_counts": [100],
+    "dir_widths": [10],
+    "sequential_bytes": 1 * MB,
+    "random_reads": 200,
+    "repeats": 3,
+}
+
+THROUGHPUT_DROP = 0.20 # flag a workload whose throughput fell by more than this
+IO_GROWTH = 0.10 # flag a workload whose blocks read or written grew by more than this
+
+class Measurement:
+    """
+    Latencies and disk I/O of the operations of one workload. Only what runs inside
+    time() is counted, so setup and teardown around it do not skew the results.
+    """
+
+    def __init__(self, disk):
+        self.disk = disk
+        self.latencies = []
+        self.seconds = 0.0
+        self.bytes = 0
+        self.calls = {}
+        self.blocks_read = 0
+        self.blocks_written = 0
+
+    # Run call(*args) and count it. With op=False its time and I/O are counted but it
+    # is not an operation, e.g. the closing tfs_sync.
+    def time(self, call, *args, op=True):
+        calls = dict(self.disk.calls)
+        blocks_read = self.disk.blocks_read
+        blocks_written = self.disk.blocks_written
+        began = time.perf_counter()
+        result = call(*args)
+        elapsed = time.perf_counter() - began
+        self.seconds += elapsed
+        if op:
+            self.latencies.append(elapsed)
+        for name, count in self.disk.calls.items():
+            if count != calls.get(name, 0):
+                self.calls[name] = self.calls.get(name, 0) + count - calls.get(name, 0)
+        self.blocks_read += self.disk.blocks_read - blocks_read
+        self.blocks_written += self.disk.blocks_written - blocks_written
+        return result
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        ops = len(latencies)
+        result = {
+            "ops": ops,
+            "seconds": round(self.seconds, 6),
+            "ops_per_sec": round(ops / self.seconds, 1) if self.seconds > 0 else 0.0,
+            "latency_us": {name: round(percentile(latencies, p) * 1e6, 1) for name, p in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))},
+            "io": {
+                "calls": dict(sorted(self.calls.items())),
+                "blocks_read": self.blocks_read,
+                "blocks_written": self.blocks_written,
+            },
+        }
+        if self.bytes:
+            result["bytes"] = self.bytes
+            result["mb_per_sec"] = round(self.bytes / self.seconds / 1e6, 2) if self.seconds > 0 else 0.0
+        return result
+
+# Nearest-rank percentile of the sorted list 'values', 0 if it is empty
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+def size_name(nBytes):
+    if nBytes >= MB:
+        return f"{nBytes // MB}MB"
+    return f"{nBytes // KB}KB"
+
+
+class Suite:
+    """
+    Runs the workloads and collects their results by name, e.g. "seq_read/file=256KB".
+    """
+
+    def __init__(self, params, backend="file", inode_format="indirect", cache_blocks=DEFAULT_CACHE_BLOCKS):
+        self.params = params
+        self.backend = backend
+        self.inode_format = inode_format
+        self.cache_blocks = cache_blocks
+        self.disk = SlowDisk(DISK_BACKENDS[backend], 0)
+        self.results = {}
+
+    def measurement(self):
+        return Measurement(self.disk)
+
+    # A mounted tinyFS on a fresh image of 'disk_bytes'
+    def fresh(self, disk_bytes):
+        fs = tinyFS(cache_blocks=self.cache_blocks)
+        fs.tfs_mkfs(SUITE_DISK_NAME, disk_bytes, backend=COUNTED_BACKEND, inode_format=self.inode_format)
+        fs.tfs_mount(SUITE_DISK_NAME, backend=COUNTED_BACKEND)
+        return fs
+
+    # Unmount and mount again, so the next workload starts with a cold cache
+    def remount(self, fs):
+        fs.tfs_unmount()
+        fs = tinyFS(cache_blocks=self.cache_blocks)
+        fs.tfs_mount(SUITE_DISK_NAME, backend=COUNTED_BACKEND)
+        return fs
+
+    # Disk big enough for 'count' files of 'file_size' bytes, with room for metadata
+    def disk_for(self, count, file_size):
+        return max(1 * MB, 2 * count * (file_size + 4 * BLOCKSIZE))
+
+    # Make files /f0 ... /f<count - 1> of 'file_size' bytes, untimed
+    def populate(self, fs, count, file_size, prefix="/f"):
+        data = bytes(file_size)
+        for i in range(count):
+            fd = fs.tfs_open(f"{prefix}{i}")
+            if file_size:
+                fs.tfs_write(fd, {'bytes': data})
+            fs.tfs_close(fd)
+
+    def run(self, names=None):
+        workloads = {
+            "mkfs": self.bench_mkfs,
+            "mount": self.bench_mount,
+            "create": self.bench_create,
+            "open": self.bench_open,
+            "seq_write": self.bench_seq_write,
+            "seq_read": self.bench_seq_read,
+            "random_read": self.bench_random_read,
+            "delete": self.bench_delete,
+            "dirs": self.bench_dirs,
+            "bulk": self.bench_bulk,
+        }
+        with disk_backend(COUNTED_BACKEND, self.disk):
+            for name, workload in workloads.items():
+                if names is None or name in names:
+                    workload()
+        if os.path.exists(SUITE_DISK_NAME):
+            os.remove(SUITE_DISK_NAME)
+        return self.results
+
+    def record(self, name, measurement):
+        self.results[name] = measurement.result()
+
+    def bench_mkfs(self):
+        for disk_bytes in self.params["disk_sizes"]:
+            m = self.measurement()
+            for _ in range(self.params["repeats"]):
+                fs = tinyFS(cache_blocks=self.cache_blocks)
+                m.time(fs.tfs_mkfs, SUITE_DISK_NAME, disk_bytes, COUNTED_BACKEND, self.inode_format)
+            self.record(f"mkfs/disk={size_name(disk_bytes)}", m)
+
+    def bench_mount(self):
+        for count in self.params["file_counts"]:
+            fs = self.fresh(self.disk_for(count, BLOCKSIZE))
+            self.populate(fs, count, BLOCKSIZE)
+            fs.tfs_unmount()
+            m = self.measurement()
+            for _ in range(self.params["repeats"]):
+                fs = tinyFS(cache_blocks=self.cache_blocks)
+                m.time(fs.tfs_mount, SUITE_DISK_NAME, COUNTED_BACKEND)
+                fs.tfs_unmount()
+            self.record(f"mount/files={count}", m)
+
+    def bench_create(self):
+        for count in self.params["file_counts"]:
+            fs = self.fresh(self.disk_for(count, 0))
+            m = self.measurement()
+            for i in range(count):
+                m.time(lambda path: fs.tfs_close(fs.tfs_open(path)), f"/f{i}")
+            m.time(fs.tfs_sync, op=False)
+            fs.tfs_unmount()
+            self.record(f"create/files={count}", m)
+
+    def bench_open(self):
+        for count in self.params["file_counts"]:
+            fs = self.fresh(self.disk_for(count, 0))
+            self.populate(fs, count, 0)
+            fs = self.remount(fs)
+            order = list(range(count))
+            random.Random(SEED).shuffle(order)
+            m = self.measurement()
+            for i in order:
+                m.time(lambda path: fs.tfs_close(fs.tfs_open(path)), f"/f{i}")
+            fs.tfs_unmount()
+            self.record(f"open/files={count}", m)
+
+    # Files of 'file_size' bytes adding up to about sequential_bytes
+    def sequential_files(self, file_size):
+        return max(1, self.params["sequential_bytes"] // file_size)
+
+    def bench_seq_write(self):
+        for file_size in self.params["file_sizes"]:
+            count = self.sequential_files(file_size)
+            fs = self.fresh(self.disk_for(count, file_size))
+            chunk = bytes(min(CHUNK, file_size))
+            m = self.measurement()
+            for i in range(count):
+                fd = fs.tfs_open(f"/f{i}")
+                for offset in range(0, file_size, len(chunk)):
+                    m.time(fs.tfs_pwrite, fd, offset, {'bytes': chunk})
+                    m.bytes += len(chunk)
+                fs.tfs_close(fd)
+            m.time(fs.tfs_sync, op=False)
+            fs.tfs_unmount()
+            self.record(f"seq_write/file={size_name(file_size)}", m)
+
+    def bench_seq_read(self):
+        for file_size in self.params["file_sizes"]:
+            count = self.sequential_files(file_size)
+            fs = self.fresh(self.disk_for(count, file_size))
+            self.populate(fs, count, file_size)
+            fs = self.remount(fs)
+            view = memoryview(bytearray(min(CHUNK, file_size)))
+            m = self.measurement()
+            for i in range(count):
+                fd = fs.tfs_open(f"/f{i}")
+                while True:
+                    read = m.time(fs.tfs_readinto, fd, view)
+                    if read <= 0:
+                        break
+                    m.bytes += read
+                fs.tfs_close(fd)
+            fs.tfs_unmount()
+            self.record(f"seq_read/file={size_name(file_size)}", m)
+
+    def bench_random_read(self):
+        rng = random.Random(SEED)
+        for file_size in self.params["file_sizes"]:
+            fs = self.fresh(self.disk_for(1, file_size))
+            self.populate(fs, 1, file_size)
+            fs = self.remount(fs)
+            fd = fs.tfs_open("/f0")
+            view = memoryview(bytearray(BLOCKSIZE))
+            blocks = max(1, file_size // BLOCKSIZE)
+
+            def seek_and_read(offset):
+                fs.tfs_seek(fd, offset)
+                return fs.tfs_readinto(fd, view)
+
+            m = self.measurement()
+            for _ in range(self.params["random_reads"]):
+                m.bytes += m.time(seek_and_read, rng.randrange(blocks) * BLOCKSIZE)
+            fs.tfs_close(fd)
+            fs.tfs_unmount()
+            self.record(f"random_read/file={size_name(file_size)}", m)
+
+    def bench_delete(self):
+        for count in self.params["file_counts"]:
+            fs = self.fresh(self.disk_for(count, BLOCKSIZE))
+            self.populate(fs, count, BLOCKSIZE)
+            fs = self.remount(fs)
+            m = self.measurement()
+            for i in range(count):
+                m.time(lambda path: fs.tfs_delete(fs.tfs_open(path)), f"/f{i}")
+            m.time(fs.tfs_sync, op=False)
+            fs.tfs_unmount()
+            self.record(f"delete/files={count}", m)
+
+    # A tree of directories three deep, DIR_FANOUT wide at the top two levels, with
+    # 'width' files in each leaf: mkdir, then readdir of every directory, opens of
+    # every leaf file by its full path after a remount, and renames of every file
+    # up one directory.
+    def bench_dirs(self):
+        for width in self.params["dir_widths"]:
+            branches = [f"/d{a}/e{b}" for a in range(DIR_FANOUT) for b in range(DIR_FANOUT)]
+            fs = self.fresh(max(4 * MB, len(branches) * width * 4 * BLOCKSIZE))
+            mkdir = self.measurement()
+            for a in range(DIR_FANOUT):
+                mkdir.time(fs.tfs_mkdir, f"/d{a}")
+            for path in branches:
+                mkdir.time(fs.tfs_mkdir, path)
+                mkdir.time(fs.tfs_mkdir, path + "/leaf")
+            mkdir.time(fs.tfs_sync, op=False)
+            self.record(f"mkdir/width={width}", mkdir)
+            for path in branches:
+                self.populate(fs, width, 0, prefix=path + "/leaf/f")
+            fs = self.remount(fs)
+
+            readdir = self.measurement()
+            for path in ["/"] + [f"/d{a}" for a in range(DIR_FANOUT)] + branches + [path + "/leaf" for path in branches]:
+                readdir.time(fs.tfs_readdir, path)
+            self.record(f"readdir/width={width}", readdir)
+
+            deep_open = self.measurement()
+            for path in branches:
+                for i in range(width):
+                    deep_open.time(lambda name: fs.tfs_close(fs.tfs_open(name)), f"{path}/leaf/f{i}")
+            self.record(f"deep_open/width={width}", deep_open)
+
+            rename = self.measurement()
+            for path in branches:
+                for i in range(width):
+                    rename.time(fs.tfs_rename, f"{path}/leaf/f{i}", f"{path}/f{i}")
+            rename.time(fs.tfs_sync, op=False)
+            self.record(f"rename/width={width}", rename)
+            fs.tfs_unmount()
+
+    # 'count' files of BULK_FILE_SIZE bytes, written and then read back after a
+    # remount, first one open/write/close (or open/read/close) at a time, then with
+    # one tfs_bulk_write and one tfs_bulk_read, each on a fresh image
+    def bench_bulk(self):
+        for count in self.params["file_counts"]:
+            files = [(f"/f{i}", bytes([i % 256]) * BULK_FILE_SIZE) for i in range(count)]
+            names = [name for name, _ in files]
+
+            def write_one(name, data):
+                fd = fs.tfs_open(name)
+                fs.tfs_write(fd, {'bytes': data})
+                fs.tfs_close(fd)
+
+            def read_one(name):
+                fd = fs.tfs_open(name)
+                data = fs.tfs_read(fd, BULK_FILE_SIZE)
+                fs.tfs_close(fd)
+                return data
+
+            fs = self.fresh(self.disk_for(count, BULK_FILE_SIZE))
+            m = self.measurement()
+            for name, data in files:
+                m.time(write_one, name, data)
+                m.bytes += len(data)
+            m.time(fs.tfs_sync, op=False)
+            self.record(f"loop_write/files={count}", m)
+            fs = self.remount(fs)
+            m = self.measurement()
+            for name in names:
+                m.bytes += len(m.time(read_one, name))
+            self.record(f"loop_read/files={count}", m)
+            fs.tfs_unmount()
+
+            fs = self.fresh(self.disk_for(count, BULK_FILE_SIZE))
+            m = self.measurement()
+            m.time(fs.tfs_bulk_write, files)
+            m.bytes += count * BULK_FILE_SIZE
+            m.time(fs.tfs_sync, op=False)
+            self.record(f"bulk_write/files={count}", m)
+            fs = self.remount(fs)
+            m = self.measurement()
+            m.bytes += sum(len(data) for data in m.time(fs.tfs_bulk_read, names))
+            self.record(f"bulk_read/files={count}", m)
+            fs.tfs_unmount()
+
+
+# Compare 'results' against 'baseline' (both as written by the suite). Returns a
+# list of report lines and whether anything regressed.
+def compare(baseline, results):
+    lines = []
+    regressed = False
+    for name in sorted(results):
+        if name not in baseline:
+            lines.append(f"{name}: new")
+            continue
+        old = baseline[name]
+        new = results[name]
+        notes = []
+        metric = "mb_per_sec" if "mb_per_sec" in new else "ops_per_sec"
+        if old.get(metric):
+            ratio = new[metric] / old[metric]
+            notes.append(f"{metric} {old[metric]} -> {new[metric]} ({ratio:.2f}x)")
+            if ratio < 1 - THROUGHPUT_DROP:
+                notes.append("SLOWER")
+                regressed = True
+        for io in ("blocks_read", "blocks_written"):
+            before = old["io"][io]
+            after = new["io"][io]
+            if after != before:
+                notes.append(f"{io} {before} -> {after}")
+                if after > before * (1 + IO_GROWTH):
+                    notes.append("MORE I/O")
+                    regressed = True
+        lines.append(f"{name}: " + ", ".join(notes))
+    for name in sorted(set(baseline) - set(results)):
+        lines.append(f"{name}: missing")
+    return lines, regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tinyFS benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer repeats")
+    parser.add_argument("--backend", default="file", choices=["file", "mmap"])
+    parser.add_argument("--inode-format", default="indirect", choices=list(INODE_FORMATS))
+    parser.add_argument("--cache-blocks", type=int, default=DEFAULT_CACHE_BLOCKS)
+    parser.add_argument("--only", nargs="+", help="run only these workloads (mkfs mount create open seq_write seq_read random_read delete dirs bulk)")
+    parser.add_argument("--output", default=SUITE_RESULTS, help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against the JSON results of an earlier run")
+    args = parser.parse_args()
+
+    params = QUICK if args.quick else FULL
+    suite = Suite(params, args.backend, args.inode_format, args.cache_blocks)
+    results = suite.run(args.only)
+    report = {
+        "config": {
+            "backend": args.backend,
+            "inode_format": args.inode_format,
+            "cache_blocks": args.cache_blocks,
+            "quick": args.quick,
+            "blocksize": BLOCKSIZE,
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+    for name, result in results.items():
+        rate = f"{result['mb_per_sec']:9.2f} MB/s" if "mb_per_sec" in result else f"{result['ops_per_sec']:9.1f} op/s"
+        latency = result["latency_us"]
+        print(f"{name:28s} {result['ops']:6d} ops {rate}  p50 {latency['p50']:9.1f} us  p99 {latency['p99']:9.1f} us  "
+              f"read {result['io']['blocks_read']:7d}  written {result['io']['blocks_written']:7d} blocks")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, regressed = compare(json.load(f)["results"], results)
+        print("\n".join(lines))
+        sys.exit(1 if regressed else 0)
@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from collections import namedtuple
+
+# One disk call: seconds since the tracer started, the tfs_ call it belongs to (None
+# outside of one), "read", "write" or "sync", the disk library function and the
+# block numbers it moved
+TraceEvent = namedtuple("TraceEvent", "time op kind call blocks")
+
+class OpStats:
+    """
+    Counters for one tfs_ call: how often it ran, its total and longest time, and
+    the disk calls and blocks it caused, group commits it triggered included.
+    """
+
+    __slots__ = ("calls", "seconds", "max_seconds", "disk_calls", "blocks_read", "blocks_written", "syncs")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.disk_calls = 0
+        self.blocks_read = 0
+        self.blocks_written = 0
+        self.syncs = 0
+
+    def as_dict(self):
+        stats = {name: getattr(self, name) for name in self.__slots__}
+        stats["mean_us"] = round(self.seconds / self.calls * 1e6, 1) if self.calls else 0.0
+        return stats
+
+
+class Tracer:
+    """
+    INSTRUMENTATION
+    Pass one to tinyFS(tracer=...) to see where a workload spends its time. Every
+    tfs_ call is timed and the disk I/O it causes is counted against it (a call
+    made from inside another, like the commit tfs_close can trigger, counts
+    towards the outer one). Allocator activity is counted too, and
+    tinyFS.tfs_stats() adds the block cache counters.
+
+    'hook' is called with a TraceEvent for every disk call, and 'trace_file' is a
+    path to write the same events to as JSON lines. Without either, only the
+    counters are kept. Without a tracer at all, tinyFS only pays an "is None"
+    check per tfs_ call.
+
+    tracer = Tracer(trace_file="trace.jsonl")
+    fs = tinyFS(tracer=tracer)
+    ...
+    fs.tfs_stats()["ops"]["tfs_open"]["blocks_read"]
+    tracer.close()
+    """
+
+    def __init__(self, hook=None, trace_file=None):
+        self.hook = hook
+        self.trace_file = open(trace_file, "w") if trace_file is not None else None
+        self.events = hook is not None or self.trace_file is not None
+        self.started = time.perf_counter()
+        self.ops = {} # tfs_ call name -> OpStats
+        self.outside = OpStats() # disk I/O made outside any tfs_ call
+        self.local = threading.local() # the OpStats of the call each thread is in
+        self.lock = threading.Lock()
+        self.allocations = 0
+        self.allocation_failures = 0
+        self.blocks_allocated = 0
+        self.blocks_freed = 0
+
+    # Disk library 'lib' with every call counted by this tracer
+    def wrap(self, lib):
+        return TracedDisk(lib, self)
+
+    # Run method(*args, **kwargs) as tfs_ call 'name', see traced in libTinyFS
+    def call(self, name, method, *args, **kwargs):
+        if getattr(self.local, "op", None) is not None:
+            return method(*args, **kwargs)
+        with self.lock:
+            stats = self.ops.get(name)
+            if stats is None:
+                stats = self.ops[name] = OpStats()
+        self.local.op = stats
+        self.local.name = name
+        began = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - began
+            self.local.op = None
+            with self.lock:
+                stats.calls += 1
+                stats.seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    # Count a disk call of function 'call' moving 'blocks' (a list of block numbers)
+    def disk_call(self, kind, call, blocks):
+        stats = getattr(self.local, "op", None)
+        with self.lock:
+            target = stats if stats is not None else self.outside
+            target.disk_calls += 1
+            if kind == "read":
+                target.blocks_read += len(blocks)
+            elif kind == "write":
+                target.blocks_written += len(blocks)
+            else:
+                target.syncs += 1
+        if self.events:
+            event = TraceEvent(time.perf_counter() - self.started, self.local.name if stats is not None else None, kind, call, blocks)
+            if self.hook is not None:
+                self.hook(event)
+            if self.trace_file is not None:
+                with self.lock:
+                    self.trace_file.write(json.dumps(event._asdict()) + "\n")
+
+    # Count an allocation that returned 'blocks', None if it failed
+    def allocated(self, blocks):
+        with self.lock:
+            self.allocations += 1
+            if blocks is None:
+                self.allocation_failures += 1
+            else:
+                self.blocks_allocated += len(blocks)
+
+    def freed(self, num_blocks):
+        with self.lock:
+            self.blocks_freed += num_blocks
+
+    def report(self):
+        with self.lock:
+            return {
+                "ops": {name: stats.as_dict() for name, stats in sorted(self.ops.items())},
+                "outside_ops": self.outside.as_dict(),
+                "allocator": {
+                    "allocations": self.allocations,
+                    "allocation_failures": self.allocation_failures,
+                    "blocks_allocated": self.blocks_allocated,
+                    "blocks_freed": self.blocks_freed,
+                },
+            }
+
+    # Zero every counter, e.g. after setting up a workload
+    def reset(self):
+        with self.lock:
+            self.ops = {}
+            self.outside = OpStats()
+            self.allocations = self.allocation_failures = 0
+            self.blocks_allocated = self.blocks_freed = 0
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+            self.events = self.hook is not None
+
+
+class TracedDisk:
+    """
+    A disk library (libDisk or libDiskMmap) whose block calls are reported to a
+    Tracer. Anything else is passed through.
+    """
+
+    def __init__(self, lib, tracer):
+        self.lib = lib
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self.lib, name)
+
+    def readBlock(self, disk, bNum, buffer):
+        self.tracer.disk_call("read", "readBlock", [bNum])
+        return self.lib.readBlock(disk, bNum, buffer)
+
+    def writeBlock(self, disk, bNum, buffer):
+        self.tracer.disk_call("write", "writeBlock", [bNum])
+        return self.lib.writeBlock(disk, bNum, buffer)
+
+    def readBlocks(self, disk, bNum, count, buffer):
+        self.tracer.disk_call("read", "readBlocks", list(range(bNum, bNum + count)))
+        return self.lib.readBlocks(disk, bNum, count, buffer)
+
+    def writeBlocks(self, disk, bNum, count, buffer):
+        self.tracer.disk_call("write", "writeBlocks", list(range(bNum, bNum + count)))
+        return self.lib.writeBlocks(disk, bNum, count, buffer)
+
+    def readBlockList(self, disk, bNums, buffer):
+        self.tracer.disk_call("read", "readBlockList", list(bNums))
+        return self.lib.readBlockList(disk, bNums, buffer)
+
+    def writeBlockList(self, disk, bNums, buffer):
+        self.tracer.disk_call("write", "writeBlockList", list(bNums))
+        return self.lib.writeBlockList(disk, bNums, buffer)
+
+    def syncDisk(self, disk):
+        self.tracer.disk_call("sync", "syncDisk", [])
+        return self.lib.syncDisk(disk)
@@ -0,0 +1,93 @@
+import os
+import random
+import sys
+from libTinyFS import *
+from libTinyFsCheck import Checker
+
+"""
+COMPRESSION CHECK
+Random writes, overwrites, appends and reads across chunk boundaries on files
+compressed with each codec, against a model, with chunks that compress, chunks
+that do not (stored as is) and chunks of zeros (stored as holes). The files must
+read back the same before and after a remount, take fewer blocks than their
+size when they compress, and libTinyFsCheck must find the image clean.
+"""
+
+TEST_DISK_NAME = "testCompressionDisk"
+STEPS = 400
+
+# 'size' bytes of text, random bytes or zeros
+def contents(rng, size):
+    kind = rng.choice(("text", "random", "zeros"))
+    if kind == "text":
+        return (b"the quick brown fox %d " % rng.randrange(100) * (size // 20 + 1))[:size]
+    if kind == "random":
+        return rng.randbytes(size)
+    return bytes(size)
+
+def check(inode_format, codec):
+    rng = random.Random(1837)
+    found = []
+    fs = tinyFS(chunk_cache=4)
+    fs.tfs_mkfs(TEST_DISK_NAME, 8 << 20, inode_format=inode_format)
+    fs.tfs_mount(TEST_DISK_NAME)
+    model = {f"/f{i}": bytearray() for i in range(4)}
+    fds = {path: fs.tfs_open(path, codec) for path in model}
+    for step in range(STEPS):
+        path = rng.choice(sorted(model))
+        fd = fds[path]
+        data = model[path]
+        op = rng.random()
+        if op < 0.3:
+            offset = rng.randrange(len(data) + CHUNK_SIZE)
+            new = contents(rng, rng.choice((1, 100, BLOCKSIZE, CHUNK_SIZE, 3 * CHUNK_SIZE)))
+            fs.tfs_pwrite(fd, offset, {'bytes': new})
+            data.extend(bytes(max(0, offset + len(new) - len(data))))
+            data[offset:offset + len(new)] = new
+        elif op < 0.4:
+            new = contents(rng, rng.randrange(5 * CHUNK_SIZE))
+            fs.tfs_write(fd, {'bytes': new})
+            data[:] = new
+        elif op < 0.5:
+            new = contents(rng, rng.randrange(2 * CHUNK_SIZE))
+            fs.tfs_append(fd, {'bytes': new})
+            data.extend(new)
+        elif data:
+            offset = rng.randrange(len(data))
+            fs.tfs_seek(fd, offset)
+            read = fs.tfs_read(fd, rng.choice((1, 300, CHUNK_SIZE + 7)))
+            if read != data[offset:offset + len(read)] or not read:
+                found.append(f"step {step}: {path} read at {offset} differs")
+    for fd in fds.values():
+        fs.tfs_close(fd)
+    fs.tfs_unmount()
+
+    fs = tinyFS()
+    fs.tfs_mount(TEST_DISK_NAME)
+    paths = sorted(model)
+    for path, data in zip(paths, fs.tfs_bulk_read(paths)):
+        if data != model[path]:
+            found.append(f"{path} differs after a remount")
+    fd = fs.tfs_open("/text", codec)
+    text = b"compress me " * 20000
+    fs.tfs_write(fd, {'bytes': text})
+    used = sum(1 for block in fs.fd_file(fd).inode.data_blocks if block != 0)
+    if used * BLOCKSIZE >= len(text):
+        found.append(f"text took {used} blocks, not compressed")
+    fs.tfs_close(fd)
+    fs.tfs_unmount()
+    report = Checker(TEST_DISK_NAME).run()
+    if report["status"] != 0:
+        found.append(f"fsck: {report['problems']}")
+    return found
+
+if __name__ == "__main__":
+    failed = False
+    for inode_format in INODE_FORMATS:
+        for codec in ("zlib", "lzma"):
+            found = check(inode_format, codec)
+            print(f"{inode_format}, {codec}: {found[:5] if found else 'ok'}")
+            failed = failed or bool(found)
+    os.remove(TEST_DISK_NAME)
+    print("FAILED" if failed else "ok")
+    sys.exit(1 if failed else 0)
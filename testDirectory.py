@@ -0,0 +1,142 @@
+import os
+import random
+import sys
+import zlib
+from libTinyFS import *
+from libTinyFsCheck import Checker
+
+"""
+DIRECTORY CHECK
+Fills directories through bucket splits and overflow chains and checks that
+every entry made is still there, and nothing else, after each of:
+- random creates and deletes against a model
+- names that all hash to one bucket, so its chain overflows and a split moves
+  a whole chain over
+- the same, with every allocation a split makes after its first one failing:
+  the split must leave the table as it was rather than drop the moved entries
+- creates on a disk that runs out of space
+libTinyFsCheck must find every image clean.
+"""
+
+TEST_DISK_NAME = "testDirectoryDisk"
+
+# 'count' names of at most MAX_FILENAME bytes that all hash to 2 modulo 4: they
+# share bucket 0 until it splits for the second time, then all move to bucket 2
+def colliding_names(count):
+    names = []
+    i = 0
+    while len(names) < count:
+        name = f"c{i}".encode()
+        if zlib.crc32(name) % 4 == 2:
+            names.append(name.decode())
+        i += 1
+    return names
+
+def fresh(nBytes=4 << 20):
+    fs = tinyFS()
+    fs.tfs_mkfs(TEST_DISK_NAME, nBytes)
+    fs.tfs_mount(TEST_DISK_NAME)
+    fs.tfs_mkdir("/d")
+    return fs
+
+def create(fs, name):
+    fd = fs.tfs_open("/d/" + name)
+    if fd < 0:
+        return fd
+    fs.tfs_close(fd)
+    return 0
+
+# Problems with directory /d of 'fs' holding exactly 'names', then fsck's findings
+def problems(fs, names):
+    found = []
+    listed = set(fs.tfs_readdir("/d"))
+    if listed != names:
+        found.append(f"{len(names - listed)} entries lost, {len(listed - names)} unexpected")
+    directory = fs.open_directory(fs.resolve([b"d"]))
+    missing = [name for name in names if directory.lookup(name.encode()) is None]
+    if missing:
+        found.append(f"{len(missing)} entries not found by lookup")
+    if directory.num_files != len(names) + 2:
+        found.append(f"entry count {directory.num_files}, expected {len(names) + 2}")
+    fs.tfs_unmount()
+    report = Checker(TEST_DISK_NAME).run()
+    if report["status"] != 0:
+        found.append(f"fsck: {report['problems']}")
+    return found
+
+def check_random():
+    rng = random.Random(1837)
+    fs = fresh()
+    names = set()
+    for _ in range(3000):
+        name = f"{rng.randrange(16 ** 6):x}"
+        if name in names:
+            continue
+        create(fs, name)
+        names.add(name)
+        if rng.random() < 0.3:
+            victim = rng.choice(sorted(names))
+            fs.tfs_delete(fs.tfs_open("/d/" + victim))
+            names.discard(victim)
+    return problems(fs, names)
+
+def check_collisions():
+    fs = fresh()
+    names = colliding_names(200)
+    for name in names:
+        create(fs, name)
+    for name in names[::3]:
+        fs.tfs_delete(fs.tfs_open("/d/" + name))
+    return problems(fs, set(names) - set(names[::3]))
+
+def check_split_without_space():
+    fs = fresh()
+    split_bucket = tinyFS.Directory.split_bucket
+    allocate = fs.allocate
+    splitting = []
+    # a split gets the block it appends to the directory, and nothing after it
+    def failing_allocate(num_blocks):
+        if splitting and splitting[-1] > 0:
+            return None
+        if splitting:
+            splitting[-1] += 1
+        return allocate(num_blocks)
+    def counted_split(directory):
+        splitting.append(0)
+        try:
+            return split_bucket(directory)
+        finally:
+            splitting.pop()
+    fs.allocate = failing_allocate
+    tinyFS.Directory.split_bucket = counted_split
+    try:
+        names = colliding_names(60)
+        for name in names:
+            create(fs, name)
+    finally:
+        tinyFS.Directory.split_bucket = split_bucket
+    fs.allocate = allocate
+    return problems(fs, set(names))
+
+def check_full_disk():
+    fs = fresh(96 * 1024)
+    rng = random.Random(7)
+    names = set()
+    for _ in range(2000):
+        name = f"{rng.randrange(16 ** 6):x}"
+        if name not in names and create(fs, name) == 0:
+            names.add(name)
+    if fs.bitmap.num_free > 0:
+        return ["the disk never filled up"]
+    return problems(fs, names)
+
+if __name__ == "__main__":
+    failed = False
+    for name, check in (("random", check_random), ("collisions", check_collisions),
+                        ("split without space", check_split_without_space), ("full disk", check_full_disk)):
+        found = check()
+        print(f"{name}: {found if found else 'ok'}")
+        failed = failed or bool(found)
+    os.remove(TEST_DISK_NAME)
+    print("FAILED" if failed else "ok")
+    sys.exit(1 if failed else 0)
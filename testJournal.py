@@ -0,0 +1,136 @@
+import os
+import random
+import sys
+import libTinyFS
+from libTinyFS import *
+from libTinyFsCheck import Checker
+
+"""
+JOURNAL REPLAY CHECK
+Makes a batch of changes, commits them, makes more and then "crashes" (drops the
+mounted tinyFS without unmounting) at three points of the next commit:
+- before it starts: the image must come back as of the first commit
+- right after the journal record is on disk, before any block is written home:
+  mounting must replay the record and bring back every change
+- halfway through writing the journal record: the torn record must be ignored
+  and the image come back as of the first commit
+Each time the files must read back as expected and libTinyFsCheck must find the
+image clean, with no leaked or lost blocks.
+"""
+
+TEST_DISK_NAME = "testJournalDisk"
+TRIALS = 4
+
+class Crash(Exception):
+    pass
+
+# Apply 'count' random creates, overwrites, appends, deletes, mkdirs and renames,
+# keeping 'model' (path -> contents, None for a directory) in step
+def mutate(fs, model, rng, count):
+    for _ in range(count):
+        op = rng.random()
+        files = sorted(path for path, data in model.items() if data is not None)
+        dirs = [""] + sorted(path for path, data in model.items() if data is None)
+        if op < 0.4 or not files:
+            path = rng.choice(dirs) + f"/f{rng.randrange(30)}"
+            if path in model:
+                continue
+            data = rng.randbytes(rng.randrange(6000))
+            fd = fs.tfs_open(path)
+            fs.tfs_write(fd, {'bytes': data})
+            fs.tfs_close(fd)
+            model[path] = data
+        elif op < 0.5:
+            path = rng.choice(dirs) + f"/d{rng.randrange(5)}"
+            if path in model:
+                continue
+            fs.tfs_mkdir(path)
+            model[path] = None
+        elif op < 0.7:
+            path = rng.choice(files)
+            fs.tfs_delete(fs.tfs_open(path))
+            del model[path]
+        elif op < 0.8:
+            path = rng.choice(files)
+            new = rng.choice(dirs) + f"/r{rng.randrange(30)}"
+            if new in model:
+                continue
+            fs.tfs_rename(path, new)
+            model[new] = model.pop(path)
+        else:
+            path = rng.choice(files)
+            data = rng.randbytes(rng.randrange(1, 900))
+            fd = fs.tfs_open(path)
+            fs.tfs_append(fd, {'bytes': data})
+            fs.tfs_close(fd)
+            model[path] += data
+
+# Commit, dying at 'point': "before", "journaled" or "torn"
+def crash(fs, point):
+    if point == "journaled":
+        def checkpoint(bNums):
+            raise Crash()
+        fs.cache.checkpoint = checkpoint
+    elif point == "torn":
+        journal_lib = fs.journal.lib
+        class TornLib:
+            def __getattr__(self, name):
+                return getattr(journal_lib, name)
+            def writeBlocks(self, disk, bNum, count, buffer):
+                journal_lib.writeBlocks(disk, bNum, count // 2, buffer)
+                raise Crash()
+        fs.journal.lib = TornLib()
+    if point != "before":
+        try:
+            fs.tfs_sync()
+        except Crash:
+            pass
+    fs.current_disk.close()
+
+# Problems found in the image: files that differ from 'model', and fsck's findings
+def problems(model):
+    found = []
+    fs = tinyFS()
+    if fs.tfs_mount(TEST_DISK_NAME) < 0:
+        return ["mount failed"]
+    paths = sorted(path for path, data in model.items() if data is not None)
+    for path, data in zip(paths, fs.tfs_bulk_read(paths)):
+        if data != model[path]:
+            found.append(f"{path} differs")
+    for path in sorted(path for path, data in model.items() if data is None):
+        if not isinstance(fs.tfs_readdir(path), list):
+            found.append(f"{path} missing")
+    fs.tfs_unmount()
+    report = Checker(TEST_DISK_NAME).run()
+    if report["status"] != 0:
+        found.append(f"fsck: {report['problems']}")
+    return found
+
+if __name__ == "__main__":
+    # only commit when asked to
+    libTinyFS.COMMIT_BATCH = 10 ** 9
+    libTinyFS.COMMIT_INTERVAL = 10 ** 9
+    rng = random.Random(1837)
+    failed = False
+    for point in ("before", "journaled", "torn"):
+        point_failed = False
+        for inode_format in INODE_FORMATS:
+            for trial in range(TRIALS):
+                fs = tinyFS()
+                fs.tfs_mkfs(TEST_DISK_NAME, 768 * 1024, inode_format=inode_format, journal_blocks=400)
+                fs.tfs_mount(TEST_DISK_NAME)
+                model = {}
+                mutate(fs, model, rng, 40)
+                fs.tfs_sync()
+                committed = dict(model)
+                mutate(fs, model, rng, 25)
+                crash(fs, point)
+                found = problems(model if point == "journaled" else committed)
+                if found:
+                    point_failed = True
+                    print(f"crash {point}, {inode_format}, trial {trial}: {found}")
+        print(f"crash {point}: {'FAILED' if point_failed else 'ok'}")
+        failed = failed or point_failed
+    os.remove(TEST_DISK_NAME)
+    print("FAILED" if failed else "ok")
+    sys.exit(1 if failed else 0)
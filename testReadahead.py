@@ -0,0 +1,81 @@
+import os
+import sys
+import threading
+import time
+import libDisk
+from libTinyFS import *
+
+"""
+READ-AHEAD CONSISTENCY CHECK
+In thread-safe mode read-ahead reads blocks on a background thread, after the
+reader has dropped the file's lock. A write that lands while that read is in
+flight must not be undone by it: the read-ahead would otherwise cache the old
+contents, and later reads (and the read-modify-write of partial block writes)
+would see them. The read-ahead thread's reads are made to finish late so the
+write always lands in the middle of one.
+"""
+
+TEST_DISK_NAME = "testReadaheadDisk"
+FILE_BLOCKS = 100
+
+class LateReadahead:
+    """
+    libDisk, except that the read-ahead thread's reads hand back their data
+    0.2 s after reading it.
+    """
+
+    def __getattr__(self, name):
+        call = getattr(libDisk, name)
+        if name not in ("readBlock", "readBlocks"):
+            return call
+        def late(*args):
+            error = call(*args)
+            if threading.current_thread().name.startswith("tinyfs-readahead"):
+                time.sleep(0.2)
+            return error
+        return late
+
+# Read two blocks of a file of old bytes to start a read-ahead, overwrite the file
+# (whole or in part) while it is in flight, and return the logical blocks a read
+# after it finishes gets wrong.
+def stale_blocks(cache_blocks, whole):
+    fs = tinyFS(cache_blocks=cache_blocks, threadsafe=True)
+    fs.tfs_mkfs(TEST_DISK_NAME, 1 << 20, backend="late", journal_blocks=0)
+    fs.tfs_mount(TEST_DISK_NAME, "late")
+    fd = fs.tfs_open("/f")
+    fs.tfs_write(fd, {'bytes': b"o" * (FILE_BLOCKS * BLOCKSIZE)})
+    fs.tfs_close(fd)
+    fs.tfs_unmount()
+
+    fs = tinyFS(cache_blocks=cache_blocks, threadsafe=True)
+    fs.tfs_mount(TEST_DISK_NAME, "late")
+    fd = fs.tfs_open("/f")
+    expected = bytearray(b"o" * (FILE_BLOCKS * BLOCKSIZE))
+    # two sequential reads start a read-ahead of the blocks after them
+    fs.tfs_read(fd, BLOCKSIZE)
+    fs.tfs_read(fd, BLOCKSIZE)
+    time.sleep(0.05)
+    if whole:
+        fs.tfs_write(fd, {'bytes': b"n" * (FILE_BLOCKS * BLOCKSIZE)})
+        expected[:] = b"n" * (FILE_BLOCKS * BLOCKSIZE)
+    else:
+        fs.tfs_pwrite(fd, 2 * BLOCKSIZE, {'bytes': b"n" * (10 * BLOCKSIZE)})
+        expected[2 * BLOCKSIZE:12 * BLOCKSIZE] = b"n" * (10 * BLOCKSIZE)
+    time.sleep(0.5) # let the read-ahead finish
+    fs.tfs_seek(fd, 0)
+    data = fs.tfs_read(fd, FILE_BLOCKS * BLOCKSIZE)
+    fs.tfs_close(fd)
+    fs.tfs_unmount()
+    return sorted({i // BLOCKSIZE for i in range(len(expected)) if data[i] != expected[i]})
+
+if __name__ == "__main__":
+    DISK_BACKENDS["late"] = LateReadahead()
+    failed = False
+    for cache_blocks in (16, 64):
+        for whole in (True, False):
+            stale = stale_blocks(cache_blocks, whole)
+            print(f"cache {cache_blocks}, {'write' if whole else 'pwrite'}: stale blocks {stale}")
+            failed = failed or bool(stale)
+    os.remove(TEST_DISK_NAME)
+    print("FAILED" if failed else "ok")
+    sys.exit(1 if failed else 0)